@@ -0,0 +1,63 @@
+import numpy as np
+
+# The render kernel accumulates the samples of each pixel as fixed point integers, so that sums of samples
+# do not depend on the order in which they are added: renders of disjoint sample ranges, by different
+# processes or machines, add up to exactly the buffer of a single render of the whole range.
+ACCUM_SCALE = 2 ** 20  # fixed point scale of the accumulated samples
+
+BUFFER_ARRAYS = ("accum", "accum_sq", "sample_count")
+
+def resolve(accum: np.ndarray, sample_count: np.ndarray) -> np.ndarray:
+    ''' Image of an accumulation buffer
+    Args:
+        accum (np.ndarray): (width, height, 3) fixed point sums of the samples of each pixel
+        sample_count (np.ndarray): (width, height) number of samples of each pixel
+    Returns:
+        np.ndarray: (width, height, 3) average colour of each pixel, as float32
+
+        The image is a transposed view of a (height, width, 3) array, i.e., it is stored row by row from
+        the bottom, so that it is written as .npy or .pfm without a copy (see output.save_image).
+    '''
+    width, height = sample_count.shape
+    image = np.empty((height, width, 3), dtype=np.float32)
+    count = np.maximum(sample_count, 1).T[..., None] * float(ACCUM_SCALE)
+    np.divide(accum.transpose(1, 0, 2), count, out=image, casting="unsafe")  # divided in float64
+    return image.transpose(1, 0, 2)
+
+def save(path, buffer: dict):
+    ''' Save an accumulation buffer to a path or file object, its arrays (BUFFER_ARRAYS) and metadata (seed, sampler, samples, sample_range, scene) '''
+    np.savez(path, **buffer)
+
+def load(path: str) -> dict:
+    with np.load(path) as data:
+        buffer = {name: data[name] for name in data.files}
+    for name in ("seed", "samples", "sampler", "scene"):
+        buffer[name] = buffer[name].item()
+    buffer["sample_range"] = tuple(int(i) for i in buffer["sample_range"])
+    return buffer
+
+def merge(buffers: list) -> dict:
+    ''' Sum accumulation buffers of disjoint sample ranges of the same render
+    Args:
+        buffers (list): buffers as returned by load
+    Returns:
+        dict: merged buffer, covering the union of the sample ranges
+    '''
+    first = buffers[0]
+    for buffer in buffers[1:]:
+        for name in ("seed", "samples", "sampler", "scene"):
+            if buffer[name] != first[name]:
+                raise ValueError(f"cannot merge buffers with different {name}: {first[name]} and {buffer[name]}")
+        if buffer["accum"].shape != first["accum"].shape:
+            raise ValueError(f"cannot merge buffers with different resolutions: {first['accum'].shape} and {buffer['accum'].shape}")
+    ranges = sorted(buffer["sample_range"] for buffer in buffers)
+    for (a0, a1), (b0, b1) in zip(ranges, ranges[1:]):
+        if b0 < a1:
+            raise ValueError(f"cannot merge overlapping sample ranges [{a0}, {a1}) and [{b0}, {b1})")
+    merged = {name: first[name] for name in ("seed", "samples", "sampler", "scene")}
+    for name in BUFFER_ARRAYS:
+        merged[name] = np.sum([buffer[name].astype(np.int64) for buffer in buffers], axis=0)
+    merged["sample_range"] = (ranges[0][0], ranges[-1][1])
+    if any(b0 != a1 for (a0, a1), (b0, b1) in zip(ranges, ranges[1:])):
+        print("Warning: the merged sample ranges", ranges, "leave gaps")
+    return merged
@@ -0,0 +1,118 @@
+import numpy as np
+import os
+import pathlib
+import tempfile
+import taichi.math as tm
+from pyglm import glm
+
+from camera import Camera
+import scene
+
+# A bundle is a scene compiled by compile_scene.py: the numpy columns of its primitives (see parser.primitive_columns),
+# the arrays of its meshes and the BVH over its primitives, along with its camera and render settings, in a single
+# npz file.  Loading a bundle does none of the work of parser.load_scene (json decoding, materials, transformation
+# matrices, mesh files and BVH builds), the arrays are given as they are to the Scene.
+BUNDLE_VERSION = 1  # bump when the content of bundles changes, older bundles must then be compiled again
+BUNDLE_SUFFIX = ".npz"
+BUNDLE_COLUMNS = ("lights", "spheres", "planes", "aaboxes", "meshes", "meshes_bvh", "bvh_nodes")  # dictionaries of columns of the Scene
+BUNDLE_ARRAYS = ("meshes_verts", "meshes_faces", "bvh_prims")
+BUNDLE_COUNTS = ("nb_lights", "nb_spheres", "nb_planes", "nb_aaboxes", "nb_meshes")
+
+def is_bundle(path: str) -> bool:
+    return pathlib.Path(path).suffix == BUNDLE_SUFFIX
+
+def bundle_path(scene_file_name: str, outdir_name: str = None) -> str:
+    ''' Path of the bundle of a scene file, next to it or in outdir '''
+    path = pathlib.Path(scene_file_name)
+    return str(pathlib.Path(outdir_name or path.parent) / path.stem) + BUNDLE_SUFFIX
+
+def flatten(columns: dict, prefix: str) -> dict:
+    ''' Arrays of nested dictionaries of columns, named by their path of keys, e.g., spheres/material/diffuse '''
+    arrays = {}
+    for key, value in columns.items():
+        if isinstance(value, dict):
+            arrays.update(flatten(value, prefix + "/" + key))
+        else:
+            arrays[prefix + "/" + key] = value
+    return arrays
+
+def unflatten(arrays: dict, prefix: str) -> dict:
+    columns = {}
+    for name, value in arrays.items():
+        keys = name.split("/")
+        if keys[0] != prefix:
+            continue
+        nested = columns
+        for key in keys[1:-1]:
+            nested = nested.setdefault(key, {})
+        nested[keys[-1]] = value
+    return columns
+
+def save(path: str, full_scene: scene.Scene):
+    ''' Save a scene as a bundle, written in a temporary file and renamed so that a crash never leaves a partial one
+    Args:
+        path (str): path of the bundle, see bundle_path
+        full_scene (scene.Scene): scene loaded at the resolution of its file (an image_scale_factor of 1)
+    '''
+    camera = full_scene.camera
+    arrays = {"version": BUNDLE_VERSION, "jitter": full_scene.jitter, "samples": full_scene.samples,
+              "sampler_name": full_scene.sampler_name, "ambient": np.array(tuple(full_scene.ambient)),
+              "resolution": np.array([camera.width, camera.height]), "eye_position": np.array(tuple(camera.eye_position)),
+              "lookat": np.array(tuple(camera.lookat)), "up": np.array(tuple(camera.up)), "fovy": camera.fovy}
+    for name in BUNDLE_COUNTS + BUNDLE_ARRAYS:
+        arrays[name] = getattr(full_scene, name)
+    for name in BUNDLE_COLUMNS:
+        arrays.update(flatten(getattr(full_scene, name), name))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp_path, 0o644)  # mkstemp makes the file private to its owner
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def read(path: str) -> dict:
+    ''' Arrays of a bundle, with its settings and counts as Python values '''
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    if "version" not in arrays or arrays["version"].item() != BUNDLE_VERSION:
+        raise ValueError(f"{path} is not a scene bundle of version {BUNDLE_VERSION}, compile the scene again with compile_scene.py")
+    for name in ("jitter", "samples", "sampler_name", "fovy") + BUNDLE_COUNTS:
+        arrays[name] = arrays[name].item()
+    return arrays
+
+def load(path: str, image_scale_factor: float = 1.0) -> scene.Scene:
+    ''' Load a scene from a bundle
+    Args:
+        path (str): path to the bundle
+        image_scale_factor (float): scale factor for image resolution
+    Returns:
+        scene.Scene: the scene, the same as loaded by parser.load_scene from the file it was compiled from
+    '''
+    print("Loading bundle:", path)
+    arrays = read(path)
+    width = int(image_scale_factor * arrays["resolution"][0])
+    height = int(image_scale_factor * arrays["resolution"][1])
+    camera = Camera(width, height, glm.vec3(*arrays["eye_position"]), glm.vec3(*arrays["lookat"]), glm.vec3(*arrays["up"]), arrays["fovy"])
+    columns = {name: unflatten(arrays, name) for name in BUNDLE_COLUMNS}
+    return scene.Scene( arrays["jitter"], arrays["samples"], arrays["sampler_name"],  # General settings
+                camera,  # Camera settings
+                tm.vec3(arrays["ambient"].tolist()), columns["lights"], arrays["nb_lights"],  # Light settings
+                columns["spheres"], arrays["nb_spheres"],
+                columns["planes"], arrays["nb_planes"],
+                columns["aaboxes"], arrays["nb_aaboxes"],
+                columns["meshes"], arrays["nb_meshes"], arrays["meshes_verts"], arrays["meshes_faces"], columns["meshes_bvh"],  # Geometry settings
+                scene_bvh=(columns["bvh_nodes"], arrays["bvh_prims"]))
+
+def estimate_cost(path: str, image_scale_factor: float = 1.0) -> float:
+    ''' Rough relative cost of rendering the scene of a bundle, as parser.estimate_cost but with the actual number of faces of each mesh '''
+    arrays = read(path)
+    pixels = int(image_scale_factor * arrays["resolution"][0]) * int(image_scale_factor * arrays["resolution"][1])
+    rays = pixels * max(1, arrays["samples"]) * (1 + arrays["nb_lights"])
+    nb_bounded = arrays["nb_spheres"] + arrays["nb_aaboxes"] + arrays["nb_meshes"]
+    mesh_depth = np.log2(2 + arrays["meshes/faces_ids_count"]).sum() if arrays["nb_meshes"] > 0 else 0.0
+    return rays * (arrays["nb_planes"] + np.log2(2 + nb_bounded) + mesh_depth)
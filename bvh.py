@@ -0,0 +1,211 @@
+import numpy as np
+
+import records
+
+import taichi as ti
+import taichi.math as tm
+
+BVH_STACK_SIZE = 32     # size of the fixed traversal stack, also bounds the depth of the tree
+BVH_MAX_LEAF_SIZE = 4   # nodes with this many primitives or fewer become leaves
+BVH_NB_BINS = 12        # number of bins per axis used to evaluate the surface area heuristic
+
+@ti.dataclass
+class BVHNode:
+    bbox_min: tm.vec3
+    bbox_max: tm.vec3
+    left_first: ti.i32  # index of the left child (the right child follows it), or first primitive for a leaf
+    count: ti.i32       # number of primitives in a leaf, 0 for inner nodes
+
+read_node = records.reader(BVHNode)  # node i of an ndarray of nodes packed by records.pack, as read_node(nodes, i)
+
+@ti.func
+def intersectBounds(bbox_min: tm.vec3, bbox_max: tm.vec3, origin: tm.vec3, inv_dir: tm.vec3, t_min: float, t_max: float) -> float:
+    ''' Slab test of a ray against an axis aligned bounding box
+    Args:
+        bbox_min (tm.vec3): lower corner of the box
+        bbox_max (tm.vec3): upper corner of the box
+        origin (tm.vec3): ray origin
+        inv_dir (tm.vec3): component-wise inverse of the ray direction
+        t_min (float): minimum t value for valid intersection
+        t_max (float): maximum t value for valid intersection
+    Returns:
+        float: entry distance of the ray in the box, or inf if the box is missed
+    '''
+    t0 = (bbox_min - origin) * inv_dir
+    t1 = (bbox_max - origin) * inv_dir
+    t_near = ti.max(tm.min(t0, t1).max(), t_min)
+    t_far = ti.min(tm.max(t0, t1).min(), t_max)
+    return ti.select(t_near <= t_far, t_near, float('inf'))
+
+def empty_bvh() -> dict:
+    ''' A single leaf with no primitives, for scenes without any bounded primitive '''
+    return {"bbox_min": np.zeros((1, 3), dtype=np.float32),
+            "bbox_max": np.zeros((1, 3), dtype=np.float32),
+            "left_first": np.zeros(1, dtype=np.int32),
+            "count": np.zeros(1, dtype=np.int32)}
+
+def transform_bounds(local_min: np.ndarray, local_max: np.ndarray, M: np.ndarray) -> (np.ndarray, np.ndarray):
+    ''' World space bounds of boxes given in local space
+    Args:
+        local_min (np.ndarray): (n, 3) lower corners in local space
+        local_max (np.ndarray): (n, 3) upper corners in local space
+        M (np.ndarray): (n, 4, 4) local to world transformation matrices
+    Returns:
+        (np.ndarray, np.ndarray): (n, 3) lower and upper corners of the transformed boxes
+    '''
+    n = local_min.shape[0]
+    corners = np.ones((n, 8, 4), dtype=np.float64)
+    for c in range(8):
+        corners[:, c, 0] = np.where(c & 1, local_max[:, 0], local_min[:, 0])
+        corners[:, c, 1] = np.where(c & 2, local_max[:, 1], local_min[:, 1])
+        corners[:, c, 2] = np.where(c & 4, local_max[:, 2], local_min[:, 2])
+    world = np.einsum('nij,ncj->nci', M, corners)[:, :, :3]
+    return world.min(axis=1), world.max(axis=1)
+
+def build_mesh_bvh(verts: np.ndarray, faces: np.ndarray) -> (dict, np.ndarray):
+    ''' Build the BVH over the triangles of a mesh, in the local space of the mesh
+    Args:
+        verts (np.ndarray): (n, 3) vertices of the mesh
+        faces (np.ndarray): (m, 3) vertex indices of each triangle
+    Returns:
+        (dict, np.ndarray): numpy columns of the BVHNode nodes, and the order in which
+        the leaves reference the faces (faces must be reordered accordingly)
+    '''
+    triangles = verts[faces]
+    return build_bvh(triangles.min(axis=1), triangles.max(axis=1))
+
+def _surface_area(bbox_min: np.ndarray, bbox_max: np.ndarray) -> np.ndarray:
+    d = np.maximum(bbox_max - bbox_min, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+def build_bvh(bbox_min: np.ndarray, bbox_max: np.ndarray,
+              max_leaf_size: int = BVH_MAX_LEAF_SIZE,
+              max_depth: int = BVH_STACK_SIZE - 1) -> (dict, np.ndarray):
+    ''' Build a bounding volume hierarchy over a set of primitive bounds
+    Args:
+        bbox_min (np.ndarray): (n, 3) lower corners of the primitives
+        bbox_max (np.ndarray): (n, 3) upper corners of the primitives
+        max_leaf_size (int): nodes with at most this many primitives become leaves
+        max_depth (int): nodes at this depth become leaves regardless of their size
+    Returns:
+        (dict, np.ndarray): numpy columns of the BVHNode nodes (as packed by records.pack),
+        and the order in which the leaves reference the primitives
+
+        The tree is built one level at a time, with all the nodes of a level split at once
+        with binned surface area heuristic (SAH) evaluated by numpy, so that the build cost
+        does not depend on Python per node.  The two children of a node are always stored
+        next to each other, and the root is node 0.
+    '''
+    n = bbox_min.shape[0]
+    if n == 0:
+        return empty_bvh(), np.zeros(0, dtype=np.int64)
+
+    bbox_min = np.asarray(bbox_min, dtype=np.float64)
+    bbox_max = np.asarray(bbox_max, dtype=np.float64)
+    centroids = 0.5 * (bbox_min + bbox_max)
+    order = np.arange(n)
+    B = BVH_NB_BINS
+
+    nodes_min, nodes_max, nodes_left_first, nodes_count = [], [], [], []
+    nb_nodes = 1
+    # nodes of the current level: node index, first primitive in order, number of primitives
+    level_nodes = np.zeros(1, dtype=np.int64)
+    level_start = np.zeros(1, dtype=np.int64)
+    level_count = np.full(1, n, dtype=np.int64)
+    depth = 0
+    while level_nodes.size > 0:
+        k = level_nodes.size
+        offsets = np.concatenate(([0], np.cumsum(level_count)[:-1]))
+        seg = np.repeat(np.arange(k), level_count)              # segment of each primitive of this level
+        pos = level_start[seg] + np.arange(seg.size) - offsets[seg]  # position of each primitive in order
+        prims = order[pos]
+
+        node_min = np.minimum.reduceat(bbox_min[prims], offsets, axis=0)
+        node_max = np.maximum.reduceat(bbox_max[prims], offsets, axis=0)
+        nodes_min.append((level_nodes, node_min))
+        nodes_max.append((level_nodes, node_max))
+
+        split = level_count > max_leaf_size
+        if depth >= max_depth:
+            split[:] = False
+        leaves = ~split
+        nodes_left_first.append((level_nodes[leaves], level_start[leaves]))
+        nodes_count.append((level_nodes[leaves], level_count[leaves]))
+        if not split.any():
+            break
+
+        # only the nodes that are split take part in the rest of the level
+        level_nodes, level_start, level_count = level_nodes[split], level_start[split], level_count[split]
+        k = level_nodes.size
+        keep = split[seg]
+        seg = np.cumsum(split)[seg[keep]] - 1
+        pos = pos[keep]
+        prims = prims[keep]
+        offsets = np.concatenate(([0], np.cumsum(level_count)[:-1]))
+        p_min = [np.ascontiguousarray(bbox_min[prims, axis]) for axis in range(3)]
+        p_max = [np.ascontiguousarray(bbox_max[prims, axis]) for axis in range(3)]
+
+        # binned SAH over the three axes, evaluated for all the nodes of the level at once
+        c = centroids[prims]
+        c_min = np.minimum.reduceat(c, offsets, axis=0)
+        c_max = np.maximum.reduceat(c, offsets, axis=0)
+        extent = c_max - c_min
+        scale = np.where(extent > 0.0, B / np.where(extent > 0.0, extent, 1.0), 0.0)
+        bins = np.clip(((c - c_min[seg]) * scale[seg]).astype(np.int64), 0, B - 1)
+        costs = np.full((k, 3, B - 1), np.inf)
+        for axis in range(3):
+            key = seg * B + bins[:, axis]
+            counts = np.bincount(key, minlength=k * B).reshape(k, B)
+            b_min = np.full((3, k * B), np.inf)
+            b_max = np.full((3, k * B), -np.inf)
+            for j in range(3):
+                np.minimum.at(b_min[j], key, p_min[j])
+                np.maximum.at(b_max[j], key, p_max[j])
+            b_min = b_min.T.reshape(k, B, 3)
+            b_max = b_max.T.reshape(k, B, 3)
+            left_n = np.cumsum(counts, axis=1)[:, :-1]
+            right_n = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            left_area = _surface_area(np.minimum.accumulate(b_min, axis=1), np.maximum.accumulate(b_max, axis=1))[:, :-1]
+            right_area = _surface_area(np.minimum.accumulate(b_min[:, ::-1], axis=1)[:, ::-1],
+                                       np.maximum.accumulate(b_max[:, ::-1], axis=1)[:, ::-1])[:, 1:]
+            with np.errstate(invalid='ignore'):
+                cost = left_n * left_area + right_n * right_area
+            costs[:, axis, :] = np.where((left_n > 0) & (right_n > 0), cost, np.inf)
+        costs = costs.reshape(k, -1)
+        best = costs.argmin(axis=1)
+        best_axis = best // (B - 1)
+        best_bin = best % (B - 1)
+        has_sah_split = np.isfinite(costs[np.arange(k), best])
+
+        # primitives go right when past the best bin, or past the middle of the node when no
+        # split is possible (e.g., all centroids are the same)
+        go_right = np.where(has_sah_split[seg],
+                            bins[np.arange(seg.size), best_axis[seg]] > best_bin[seg],
+                            (pos - level_start[seg]) >= level_count[seg] // 2)
+        regroup = np.lexsort((go_right, seg))  # stable, keeps segments in place
+        order[pos] = prims[regroup]
+        left_count = level_count - np.bincount(seg, weights=go_right, minlength=k).astype(np.int64)
+
+        # children of split nodes are allocated in pairs after all the existing nodes
+        children = nb_nodes + 2 * np.arange(k)
+        nb_nodes += 2 * k
+        nodes_left_first.append((level_nodes, children))
+        nodes_count.append((level_nodes, np.zeros(k, dtype=np.int64)))
+
+        level_nodes = np.stack((children, children + 1), axis=1).ravel()
+        level_start = np.stack((level_start, level_start + left_count), axis=1).ravel()
+        level_count = np.stack((left_count, level_count - left_count), axis=1).ravel()
+        depth += 1
+
+    all_min = np.zeros((nb_nodes, 3))
+    all_max = np.zeros((nb_nodes, 3))
+    nodes = {"left_first": np.zeros(nb_nodes, dtype=np.int32),
+             "count": np.zeros(nb_nodes, dtype=np.int32)}
+    for ids, values in nodes_min: all_min[ids] = values
+    for ids, values in nodes_max: all_max[ids] = values
+    for ids, values in nodes_left_first: nodes["left_first"][ids] = values
+    for ids, values in nodes_count: nodes["count"][ids] = values
+    # round outwards so that float32 bounds still enclose the primitives
+    nodes["bbox_min"] = np.nextafter(all_min.astype(np.float32), np.float32(-np.inf))
+    nodes["bbox_max"] = np.nextafter(all_max.astype(np.float32), np.float32(np.inf))
+    return nodes, order
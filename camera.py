@@ -4,7 +4,39 @@ from pyglm import glm
 import taichi.math as tm
 import random
 
-@ti.data_oriented
+@ti.dataclass
+class CameraParams:
+    ''' Camera state read by the render kernel at run time, so that it is not compiled into the kernel '''
+    width: ti.i32
+    height: ti.i32
+    distance_to_plane: float
+    u: tm.vec3
+    v: tm.vec3
+    w: tm.vec3
+    left: float
+    right: float
+    bottom: float
+    top: float
+    eye_position: tm.vec3
+
+    @ti.func
+    def create_ray(self, x, y, offset) -> Ray:
+        ''' Create a ray going through pixel (x,y) in image space, at the given offset in [0, 1)^2 in the pixel (see sampler.py) '''
+
+        #normalize pixel coordinates to [0, 1]
+        u_norm = (x + offset.x) / self.width
+        v_norm = (y + offset.y) / self.height
+
+        #map to viewport coordinates
+        u_coord = self.left + u_norm * (self.right - self.left)
+        v_coord = self.bottom + v_norm * (self.top - self.bottom)
+
+        direction = u_coord * self.u +v_coord * self.v -self.distance_to_plane * self.w
+
+        #normalize direction and return ray
+        direction = tm.normalize(direction)
+        return Ray(self.eye_position, direction)
+
 class Camera:
     def __init__(self, width, height, eye_position:glm.vec3, lookat:glm.vec3, up:glm.vec3, fovy) -> None:
         '''	Initialize the camera with given parameters.
@@ -25,6 +57,25 @@ class Camera:
         self.width = width
         self.height = height		
         self.distance_to_plane = 1.0
+        self.set_pose(eye_position, lookat, up, fovy)
+
+    def set_pose(self, eye_position:glm.vec3, lookat:glm.vec3, up:glm.vec3, fovy=None) -> None:
+        '''	Move the camera, the new pose is used by the next render of the scene without compiling the kernel again
+		Args:
+			eye_position (glm.vec3): position of the camera in world space
+			lookat (glm.vec3): point the camera is looking at
+			up (glm.vec3): up direction for the camera
+			fovy (float): vertical field of view in degrees, unchanged if None
+
+			The image of the scene holds the average of the previous renders, so the render
+			following a change of pose should start again from an iteration count of 1.
+		'''
+        if fovy is None:
+            fovy = self.fovy
+        self.lookat = glm.vec3(lookat)
+        self.up = glm.vec3(up)
+        self.fovy = fovy
+        width, height = self.width, self.height
 
         # TODO: Objective 1: Compute camera frame basis vectors, and top bottom left right for ray generation
         # NOTE: glm vectors are passed in to permit the work to be done here in python, but stored vectors must be tm.vec3
@@ -51,24 +102,8 @@ class Camera:
         # Store eye position in world space
         self.eye_position = tm.vec3(eye_position.x, eye_position.y, eye_position.z)
 
-    @ti.func
-    def create_ray(self, x, y, jitter=False) -> Ray:
-        ''' Create a ray going through pixel (x,y) in image space '''
-
-        #normalize pixel coordinates to [0, 1]
-        u_norm = x / self.width
-        v_norm = y / self.height
-
-        if jitter:
-            u_norm += (ti.random() / self.width)
-            v_norm += (ti.random() / self.height)
-
-        #map to viewport coordinates
-        u_coord = self.left + u_norm * (self.right - self.left)
-        v_coord = self.bottom + v_norm * (self.top - self.bottom)
-
-        direction = u_coord * self.u +v_coord * self.v -self.distance_to_plane * self.w
-
-        #normalize direction and return ray
-        direction = tm.normalize(direction)
-        return Ray(self.eye_position, direction)
+    def params(self) -> CameraParams:
+        ''' Camera state given to every launch of the render kernel '''
+        return CameraParams(width=self.width, height=self.height, distance_to_plane=self.distance_to_plane,
+                            u=self.u, v=self.v, w=self.w, left=self.left, right=self.right,
+                            bottom=self.bottom, top=self.top, eye_position=self.eye_position)
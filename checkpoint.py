@@ -0,0 +1,53 @@
+import os
+import pathlib
+import tempfile
+
+import accumulation
+
+# A checkpoint is the accumulation buffer of a render in progress (see Scene.accumulation_buffer), along with
+# the iteration to continue from, the hash of the scene it belongs to, and the progress counter.  The sampler
+# has no state besides its seed, which is in the buffer: a sample only depends on the seed, its pixel and its
+# index (see sampler.sample_pixel), so a resumed render is the same as one that was never interrupted.
+CHECKPOINT_VERSION = 1  # bump when the content of checkpoints changes, to ignore old ones
+
+def checkpoint_path(scene_file_name: str, outdir_name: str) -> str:
+    return str(pathlib.Path(outdir_name) / pathlib.Path(scene_file_name).stem) + ".checkpoint.npz"
+
+def save(path: str, buffer: dict, iteration: int, scene_hash: str, progress: int):
+    ''' Save a checkpoint, written in a temporary file and renamed so that a crash never leaves a partial one
+    Args:
+        path (str): path of the checkpoint, see checkpoint_path
+        buffer (dict): accumulation buffer of the scene, as returned by Scene.accumulation_buffer
+        iteration (int): iteration count of the next sample to render
+        scene_hash (str): hash of the scene and its render settings, see Scene.content_hash
+        progress (int): progress counter of the scene, see Scene.progress
+    '''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            accumulation.save(f, dict(buffer, version=CHECKPOINT_VERSION, iteration=iteration,
+                                      scene_hash=scene_hash, progress=progress))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)  # mkstemp makes the file private to its owner
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def load(path: str) -> dict:
+    ''' Load a checkpoint
+    Returns:
+        dict: the accumulation buffer with iteration, scene_hash and progress, or None if there is no
+        checkpoint at path or it was written by another version
+    '''
+    try:
+        buffer = accumulation.load(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    if "version" not in buffer or buffer["version"].item() != CHECKPOINT_VERSION:
+        return None
+    for name in ("version", "iteration", "scene_hash", "progress"):
+        buffer[name] = buffer[name].item()
+    return buffer
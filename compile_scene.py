@@ -0,0 +1,27 @@
+import argparse
+import time
+
+import bundle
+import meshcache
+import parser
+
+parse = argparse.ArgumentParser(description="Compile scene json files into bundles, which main.py loads without parsing the scene and its meshes (see bundle.py)")
+parse.add_argument("infile", nargs='+', type=str, help="Scene json files to compile")
+parse.add_argument("-o", "--outdir", type=str, default=None, help="Directory of the bundles, default is the directory of each scene file")
+parse.add_argument('--mesh-cache', type=str, default=".cache/meshes", help="Directory of the binary cache of parsed meshes, default is ./.cache/meshes")
+parse.add_argument('--no-mesh-cache', action='store_true', help="Always parse mesh files instead of using the mesh cache")
+
+args = parse.parse_args()
+
+if __name__ == "__main__":
+    cache = None if args.no_mesh_cache else meshcache.MeshCache(args.mesh_cache)
+    for scene_file_name in args.infile:
+        if bundle.is_bundle(scene_file_name):
+            parse.error(f"{scene_file_name} is already a bundle")
+        start = time.perf_counter()
+        full_scene = parser.load_scene(scene_file_name, cache=cache)  # at full resolution, scaled when the bundle is loaded
+        path = bundle.bundle_path(scene_file_name, args.outdir)
+        bundle.save(path, full_scene)
+        print(f"bundle name={scene_file_name} compile_sec={time.perf_counter() - start:.2f} file={path}")
+    if cache is not None:
+        cache.report()
@@ -0,0 +1,356 @@
+import accumulation
+import output
+import sampler
+from progress import ProgressReporter
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import queue
+import secrets
+import socket
+import threading
+import time
+import traceback
+
+import numpy as np
+
+# A coordinator splits the images into jobs of whole rows of tiles and hands them out to worker processes,
+# each with its own Taichi runtime.  The workers parse and compile the scenes once and then render jobs
+# until there are none left, so that the accumulation buffers they send back are stitched into the images.
+# Workers are started locally (--workers), and more can join from other machines with --connect.  Since a
+# sample only depends on the seed, its pixel and its index (see sampler.sample_pixel), the stitched image
+# is the same as the one rendered by main.py, whichever worker renders each job.
+
+def parse_address(address: str) -> (str, int):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+class Job:
+    ''' Rows of tiles first_row to last_row (excluded) of a scene, and the number of times they were tried '''
+    def __init__(self, job_id: int, scene_index: int, first_row: int, last_row: int):
+        self.job_id = job_id
+        self.scene_index = scene_index
+        self.first_row = first_row
+        self.last_row = last_row
+        self.attempts = 0
+
+def render_job(full_scene, job: tuple, batch: int) -> (dict, int):
+    ''' Render all the samples of the pixels of a job
+    Args:
+        full_scene (scene.Scene): scene of the job, bound to its ndarrays
+        job (tuple): job id, scene index, first and last rows of tiles, as sent by the coordinator
+        batch (int): number of samples per pixel rendered in each kernel launch, see Scene.samples_per_launch
+    Returns:
+        (dict, int): accumulation buffer of the rows of pixels of the job (see Scene.rows_to_numpy), and the
+        number of pixels rendered, one per pixel and sample
+    '''
+    _, _, first_row, last_row = job
+    nb_tiles_x, _ = full_scene.nb_tiles()
+    tiles = (first_row * nb_tiles_x, last_row * nb_tiles_x)
+    samples = max(1, full_scene.samples)  # just do one iteration when requesting infinite samples
+    progress = full_scene.progress
+    batch = full_scene.samples_per_launch(batch)
+    for iteration in range(1, samples + 1, batch):
+        nb_samples = min(batch, samples - iteration + 1)
+        if full_scene.render_samples(iteration, nb_samples, tiles) == 0:
+            break  # adaptive sampling converged everywhere
+    y0 = first_row * full_scene.tile_size
+    y1 = min(last_row * full_scene.tile_size, full_scene.camera.height)
+    return full_scene.rows_to_numpy(y0, y1), full_scene.progress - progress
+
+def worker_main(address: tuple, authkey: bytes, spawned: bool, threads: int = None):
+    ''' Render jobs from a coordinator until it has none left
+    Args:
+        address (tuple): host and port of the coordinator
+        authkey (bytes): key shared with the coordinator
+        spawned (bool): whether the worker was started by the coordinator on its machine
+        threads (int): number of render threads, chosen by the coordinator when None
+    '''
+    conn = multiprocessing.connection.Client(address, authkey=authkey)
+    conn.send(("hello", {"host": socket.gethostname(), "pid": os.getpid(), "cpus": os.cpu_count(),
+                         "threads": threads, "spawned": spawned}))
+    message = conn.recv()
+    if message[0] != "setup":
+        return
+    config = message[1]
+    try:
+        # imported here so that the coordinator, which shares this module, never starts a Taichi runtime
+        import taichi as ti
+        import parser
+        import meshcache
+        import scene
+
+        if config["cpus"] is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, config["cpus"])  # keep the threads of the worker on the same socket
+        kernel_cache = {"offline_cache": config["kernel_cache"] is not None}
+        if config["kernel_cache"] is not None:
+            kernel_cache["offline_cache_file_path"] = config["kernel_cache"]
+        arch = {"vulkan": ti.vulkan, "cuda": ti.cuda, "metal": ti.metal}.get(config["taichi"], ti.cpu)
+        ti.init(arch, cpu_max_num_threads=config["threads"], **kernel_cache)
+        if arch == ti.cpu:
+            scene.render_threads = config["threads"]
+        if config["mesh_cache"] is not None:
+            parser.mesh_cache = meshcache.MeshCache(config["mesh_cache"])
+
+        start = time.perf_counter()
+        scenes = [parser.load_scene(scene_file_name, image_scale_factor=config["factor"]) for scene_file_name in config["infile"]]
+        for full_scene in scenes:
+            full_scene.tile_size = config["tile_size"]
+            if config["sampler"] is not None:
+                full_scene.sampler_name = config["sampler"]
+            full_scene.seed = config["seed"]
+            full_scene.adaptive_threshold = config["adaptive"]
+            full_scene.adaptive_min_samples = config["adaptive_min_samples"]
+            full_scene.compile()
+        conn.send(("ready", [(s.camera.width, s.camera.height, s.samples) for s in scenes], time.perf_counter() - start))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break  # the coordinator gave up
+        if message[0] != "job":
+            break
+        job = message[1:]
+        try:
+            rows, pixels = render_job(scenes[job[1]], job, config["batch"])
+            conn.send(("done", job[0], rows, pixels))
+        except Exception:
+            conn.send(("failed", job[0], traceback.format_exc()))
+    if config["kernel_cache"] is not None:
+        ti.reset()  # the offline cache is written when the program is finalized
+    conn.close()
+
+class Coordinator:
+    ''' Hand out the jobs of a batch of scenes to the workers that connect to the listener, and stitch their results
+
+        Each connected worker is served by a thread of the coordinator, which takes the next job from a
+        shared queue, waits for its result and takes another one.  A job that fails, or whose worker is
+        lost, goes back in the queue until it has been tried retries + 1 times.
+    '''
+    def __init__(self, args, listener: multiprocessing.connection.Listener, nb_spawned: int):
+        self.args = args
+        self.listener = listener
+        self.nb_spawned = nb_spawned
+        # CPUs of this machine split in contiguous blocks between the spawned workers, so that each one stays on a socket
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        self.cpu_blocks = [block.tolist() for block in np.array_split(cpus, max(1, min(nb_spawned, len(cpus))))]
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()  # (worker name, message) from the worker threads
+        self.lock = threading.Lock()
+        self.resolutions = None  # (width, height, samples) of each scene, as loaded by the first ready worker
+        self.nb_workers = 0  # workers currently connected
+        self.nb_connected = 0  # workers connected so far
+        self.finished = threading.Event()
+
+    def config(self, hello: dict, index: int) -> dict:
+        ''' Settings of the index-th worker to connect, the same for all workers but for the render threads '''
+        args = self.args
+        cpus = None
+        threads = hello["threads"]
+        if hello["spawned"] and threads is None:
+            cpus = self.cpu_blocks[index % len(self.cpu_blocks)]
+            threads = len(cpus)
+        return {"infile": args.infile, "factor": args.factor, "sampler": args.sampler, "seed": args.seed,
+                "adaptive": args.adaptive, "adaptive_min_samples": args.adaptive_min_samples, "batch": args.batch,
+                "tile_size": args.tile_size, "taichi": args.taichi,
+                "kernel_cache": None if args.no_kernel_cache else str(pathlib.Path(args.kernel_cache).resolve()),
+                "mesh_cache": None if args.no_mesh_cache else str(pathlib.Path(args.mesh_cache).resolve()),
+                "threads": threads or hello["cpus"], "cpus": cpus}
+
+    def accept(self):
+        while not self.finished.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, multiprocessing.AuthenticationError):
+                continue  # closed when the render is finished, or a client with the wrong key
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn: multiprocessing.connection.Connection):
+        ''' Setup a worker and send it jobs until there are none left '''
+        job = None
+        name = "unknown"
+        with self.lock:
+            index = self.nb_connected
+            self.nb_connected += 1
+            self.nb_workers += 1
+        try:
+            message = conn.recv()
+            hello = message[1]
+            name = f"{hello['host']}:{hello['pid']}"
+            config = self.config(hello, index)
+            conn.send(("setup", config))
+            message = conn.recv()
+            if message[0] != "ready":
+                self.results.put((name, ("lost", None, message[1])))
+                return
+            with self.lock:
+                if self.resolutions is None:
+                    self.resolutions = message[1]
+                    self.results.put((name, ("resolutions", None)))
+                consistent = self.resolutions == message[1]
+            if not consistent:
+                conn.send(("stop",))
+                self.results.put((name, ("lost", None, f"scenes loaded with a different resolution {message[1]}")))
+                return
+            print(f"worker name={name} threads={config['threads']} ready_sec={message[2]:.2f}", flush=True)
+            while True:
+                job = self.next_job()
+                if job is None:
+                    break
+                conn.send(("job", job.job_id, job.scene_index, job.first_row, job.last_row))
+                message = conn.recv()
+                self.results.put((name, message + (job,)))
+                job = None
+            conn.send(("stop",))
+        except (OSError, EOFError) as e:
+            self.results.put((name, ("lost", job, repr(e))))
+        finally:
+            with self.lock:
+                self.nb_workers -= 1
+            conn.close()
+
+    def next_job(self):
+        while not self.finished.is_set():
+            try:
+                return self.jobs.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def make_jobs(self) -> list:
+        ''' Jobs of job_rows rows of tiles each, scene after scene '''
+        jobs = []
+        for scene_index, (width, height, samples) in enumerate(self.resolutions):
+            nb_rows = -(-height // self.args.tile_size)
+            for first_row in range(0, nb_rows, self.args.job_rows):
+                jobs.append(Job(len(jobs), scene_index, first_row, min(first_row + self.args.job_rows, nb_rows)))
+        return jobs
+
+    def run(self, processes: list):
+        ''' Render all the scenes and save their images, returns the number of retries '''
+        args = self.args
+        threading.Thread(target=self.accept, daemon=True).start()
+        buffers, remaining, jobs = None, None, []
+        nb_retries = 0
+        progress, pixels = None, 0
+        try:
+            while buffers is None or any(remaining):
+                try:
+                    name, message = self.results.get(timeout=1.0)
+                except queue.Empty:
+                    with self.lock:
+                        nb_workers = self.nb_workers
+                    if nb_workers == 0 and args.listen is None and not any(p.is_alive() for p in processes):
+                        raise RuntimeError("all the workers exited before the end of the render")
+                    continue
+                kind = message[0]
+                if kind == "resolutions":
+                    jobs = self.make_jobs()
+                    remaining = [0] * len(self.resolutions)
+                    for job in jobs:
+                        remaining[job.scene_index] += 1
+                        self.jobs.put(job)
+                    buffers = [{"accum": np.zeros((w, h, 3), dtype=np.int64), "accum_sq": np.zeros((w, h), dtype=np.int64),
+                                "sample_count": np.zeros((w, h), dtype=np.int32)} for w, h, _ in self.resolutions]
+                    progress = ProgressReporter("distributed", sum(w * h * max(1, s) for w, h, s in self.resolutions), args.progress)
+                    progress.start()
+                elif kind == "done":
+                    _, _, rows, job_pixels, job = message
+                    y0 = job.first_row * args.tile_size
+                    for array in accumulation.BUFFER_ARRAYS:
+                        buffers[job.scene_index][array][:, y0:y0 + rows[array].shape[1]] = rows[array]
+                    pixels += job_pixels
+                    progress.update(pixels)
+                    remaining[job.scene_index] -= 1
+                    if remaining[job.scene_index] == 0:
+                        buffer = buffers[job.scene_index]
+                        scene_file_name = args.infile[job.scene_index]
+                        output.save_image(accumulation.resolve(buffer["accum"], buffer["sample_count"]), scene_file_name, args.outdir, args.format)
+                        buffers[job.scene_index] = None
+                elif kind in ("failed", "lost"):
+                    job = message[-1] if kind == "failed" else message[1]
+                    error = message[2].strip().splitlines()[-1] if message[2] else ""
+                    if job is None:
+                        print(f"worker name={name} lost error={error!r}", flush=True)
+                        continue
+                    job.attempts += 1
+                    if job.attempts > args.retries:
+                        raise RuntimeError(f"job {job.job_id} of {args.infile[job.scene_index]} failed {job.attempts} times: {message[2]}")
+                    nb_retries += 1
+                    print(f"retry job={job.job_id} name={args.infile[job.scene_index]} rows={job.first_row}-{job.last_row} "
+                          f"attempt={job.attempts + 1} worker={name} error={error!r}", flush=True)
+                    self.jobs.put(job)
+        finally:
+            self.finished.set()
+            if progress is not None:
+                progress.stop()
+        print(f"distributed scenes={len(args.infile)} jobs={len(jobs)} workers={self.nb_connected} retries={nb_retries}", flush=True)
+        return nb_retries
+
+
+if __name__ == "__main__":
+
+    parse = argparse.ArgumentParser(description="Render scenes on several worker processes, possibly on several machines")
+    parse.add_argument("-i", "--infile", nargs='+', type=str, help="Name of json file that will define the scene, or of its bundle compiled by compile_scene.py")
+    parse.add_argument("-o", "--outdir", type=str, default="out", help="directory for output files, default is ./out")
+    parse.add_argument('--format', nargs='+', choices=output.IMAGE_FORMATS, default=["png"], help="Formats of the saved images, 8 bit png, or float npy or pfm, default is png")
+    parse.add_argument('-f', '--factor', type=float, default=1.0, help="Scale factor for resolution")
+    parse.add_argument('-b', '--batch', type=int, default=16, help="Number of samples per pixel rendered in each kernel launch, default is 16")
+    parse.add_argument('-t', '--tile-size', type=int, default=16, help="Width and height of the tiles, a power of two, default is 16")
+    parse.add_argument('--job-rows', type=int, default=1, help="Number of rows of tiles in each job handed to a worker, default is 1")
+    parse.add_argument('--sampler', type=str, choices=sorted(sampler.SAMPLER_BY_NAME), help="Sampler of the jittered pixel offsets, overrides AA_sampler of the scene")
+    parse.add_argument('--seed', type=int, default=0, help="Seed of the sampler, renders with the same seed are identical, default is 0")
+    parse.add_argument('-a', '--adaptive', type=float, default=0.0, help="Adaptive sampling threshold (see main.py), default is 0 (disabled)")
+    parse.add_argument('--adaptive-min-samples', type=int, default=8, help="Number of samples of each pixel before adaptive sampling estimates its error, default is 8")
+    parse.add_argument('-w', '--workers', type=int, default=1, help="Number of worker processes started on this machine, each with an equal share of its CPUs, default is 1")
+    parse.add_argument('--listen', type=str, help="HOST:PORT on which to also accept workers started on other machines with --connect")
+    parse.add_argument('--connect', type=str, help="Run as a worker of the coordinator listening on HOST:PORT")
+    parse.add_argument('--authkey', type=str, help="Key shared by the coordinator and its workers, required with --listen and --connect")
+    parse.add_argument('--threads', type=int, help="With --connect, number of render threads of the worker, default is all the CPUs")
+    parse.add_argument('--retries', type=int, default=2, help="Number of times a failed job is tried again before giving up, default is 2")
+    parse.add_argument('-p', '--progress', type=float, default=1.0, help="Seconds between two progress reports, default is 1")
+    parse.add_argument('--mesh-cache', type=str, default=".cache/meshes", help="Directory of the binary cache of parsed meshes, default is ./.cache/meshes")
+    parse.add_argument('--no-mesh-cache', action='store_true', help="Always parse mesh files instead of using the mesh cache")
+    parse.add_argument('--kernel-cache', type=str, default=".cache/kernels", help="Directory of the Taichi offline cache of compiled kernels, default is ./.cache/kernels")
+    parse.add_argument('--no-kernel-cache', action='store_true', help="Compile the kernels on every run instead of using the offline cache")
+    parse.add_argument('-ti', '--taichi', type=str, default='cpu', help="Taichi backend 'cpu', 'vulkan', 'cuda', 'metal', cpu is default")
+    args = parse.parse_args()
+
+    if (args.listen is not None or args.connect is not None) and args.authkey is None:
+        parse.error("--listen and --connect need an --authkey shared by the coordinator and its workers")
+    if args.connect is not None:
+        worker_main(parse_address(args.connect), args.authkey.encode(), False, args.threads)
+        raise SystemExit(0)
+    if args.infile is None:
+        parse.error("the following arguments are required: -i/--infile")
+    if args.tile_size < 1 or args.tile_size & (args.tile_size - 1) != 0:
+        parse.error("the tile size must be a power of two")
+    if args.workers < 0 or args.job_rows < 1:
+        parse.error("the number of workers must be 0 or more, and the rows of tiles per job 1 or more")
+    if args.workers == 0 and args.listen is None:
+        parse.error("no workers to render, start local workers with --workers or accept remote ones with --listen")
+
+    # local workers only need a random key, workers of other machines are given the key explicitly
+    authkey = args.authkey.encode() if args.authkey is not None else secrets.token_bytes(16)
+    listener = multiprocessing.connection.Listener(parse_address(args.listen) if args.listen else ("127.0.0.1", 0), authkey=authkey)
+    print(f"coordinator address={listener.address[0]}:{listener.address[1]} workers={args.workers}", flush=True)
+    context = multiprocessing.get_context("spawn")  # a fresh interpreter for each Taichi runtime
+    processes = [context.Process(target=worker_main, args=(listener.address, authkey, True), daemon=True)
+                 for _ in range(args.workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    coordinator = Coordinator(args, listener, args.workers)
+    try:
+        coordinator.run(processes)
+    finally:
+        listener.close()
+        for process in processes:
+            process.join(timeout=30)
+    print(f"distributed total_sec={time.perf_counter() - start:.2f}", flush=True)
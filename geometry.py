@@ -1,4 +1,5 @@
 from helperclasses import Ray, Intersection, Material, changeRayFrame, getRayPoint, changeIntersectFrame
+import bvh
 
 import taichi as ti
 import taichi.math as tm
@@ -73,6 +74,21 @@ def intersectSphere(sphere: Sphere, ray: Ray, t_min: float, t_max: float) -> Int
 
     return changeIntersectFrame(hit, sphere.M, sphere.M_inv)
 
+@ti.func
+def occludeSphere(sphere: Sphere, ray: Ray, t_min: float, t_max: float) -> bool:
+    ''' Ray-sphere occlusion test, same as intersectSphere but only reports if there is a hit '''
+    ray_local = changeRayFrame(ray, sphere.M_inv)
+    p = ray_local.origin
+    d = ray_local.direction
+    a = tm.dot(d, d)
+    b = 2.0 * tm.dot(p, d)
+    c = tm.dot(p, p) - sphere.radius * sphere.radius
+    discriminant = b * b - 4.0 * a * c
+    sqrt_disc = ti.sqrt(ti.max(0.0, discriminant))
+    t1 = (-b - sqrt_disc) / (2.0 * a)
+    t2 = (-b + sqrt_disc) / (2.0 * a)
+    return discriminant >= 0.0 and ((t_min < t1 and t1 < t_max) or (t_min < t2 and t2 < t_max))
+
 
 @ti.dataclass
 class Plane:
@@ -130,7 +146,7 @@ def intersectPlane(plane: Plane, ray: Ray, t_min: float, t_max: float) -> Inters
         point_local = getRayPoint(ray_local, t)
         hit.position = point_local
         hit.normal = plane.normal
-        hit.t = tm.length(getRayPoint(ray, t) - ray.origin)
+        hit.t = t
         
         #checkerboard pattern
         if plane.two_materials:
@@ -145,6 +161,17 @@ def intersectPlane(plane: Plane, ray: Ray, t_min: float, t_max: float) -> Inters
 
     return changeIntersectFrame(hit, plane.M, plane.M_inv)
 
+@ti.func
+def occludePlane(plane: Plane, ray: Ray, t_min: float, t_max: float) -> bool:
+    ''' Ray-plane occlusion test, same as intersectPlane but only reports if there is a hit '''
+    ray_local = changeRayFrame(ray, plane.M_inv)
+    denominator = tm.dot(plane.normal, ray_local.direction)
+    is_hit = False
+    if ti.abs(denominator) >= 1e-6:
+        t = (-1.0 * (tm.dot(plane.normal, ray_local.origin))) / denominator
+        is_hit = t > 0 and t_min < t and t_max > t
+    return is_hit
+
 @ti.dataclass
 class AABox:
     id: int
@@ -163,6 +190,12 @@ def intersectAABox(aabox: AABox, ray: Ray, t_min: float, t_max: float) -> Inters
 
     return hit
 
+@ti.func
+def occludeAABox(aabox: AABox, ray: Ray, t_min: float, t_max: float) -> bool:
+    ''' Ray-box occlusion test '''
+    # boxes are cheap to intersect, so this only forwards the hit flag of the full intersection
+    return intersectAABox(aabox, ray, t_min, t_max).is_hit
+
 
 @ti.dataclass
 class Mesh:
@@ -170,13 +203,38 @@ class Mesh:
     material: Material
     faces_ids_start: ti.i32  # index of the first face in the global face array
     faces_ids_count: ti.i32  # number of faces in this mesh
+    bvh_start: ti.i32        # index of the root of this mesh's BVH in the global BVH node array
+    bvh_count: ti.i32        # number of BVH nodes of this mesh
     M: tm.mat4
     M_inv: tm.mat4
 
+@ti.func
+def intersectTriangle(v0: tm.vec3, v1: tm.vec3, v2: tm.vec3, ray: Ray, t_min: float, t_max: float) -> float:
+    ''' Ray-triangle intersection (Moller-Trumbore)
+    Returns:
+        float: t value of the intersection, or inf if there is no valid intersection
+    '''
+    t = float('inf')
+    e1 = v1 - v0
+    e2 = v2 - v0
+    p = tm.cross(ray.direction, e2)
+    det = tm.dot(e1, p)
+    if ti.abs(det) > EPSILON * EPSILON:
+        inv_det = 1.0 / det
+        s = ray.origin - v0
+        u = tm.dot(s, p) * inv_det
+        q = tm.cross(s, e1)
+        v = tm.dot(ray.direction, q) * inv_det
+        t_hit = tm.dot(e2, q) * inv_det
+        if u >= 0.0 and v >= 0.0 and u + v <= 1.0 and t_min < t_hit and t_hit < t_max:
+            t = t_hit
+    return t
+
 @ti.func
 def intersectMesh(mesh: Mesh,                  # data for this mesh (start face and number of faces, etc.)
                   meshes_verts: ti.template(), # all vertices (for all meshes)
                   meshes_faces: ti.template(), # all faces (for all meshes)
+                  meshes_bvh: ti.template(),   # all BVH nodes (for all meshes), packed by records.pack
                   ray: Ray,
                   t_min: float,
                   t_max: float
@@ -186,5 +244,77 @@ def intersectMesh(mesh: Mesh,                  # data for this mesh (start face
 
     # TODO: Objective 8: Implement ray-mesh intersection
 
+    ray_local = changeRayFrame(ray, mesh.M_inv)
+    inv_dir = 1.0 / ray_local.direction
+
+    # walk the BVH of the mesh with a small fixed stack, nearest child first
+    stack = ti.Vector([0] * bvh.BVH_STACK_SIZE, dt=ti.i32)
+    stack_t = ti.Vector([0.0] * bvh.BVH_STACK_SIZE, dt=float)  # entry distance of each stacked node
+    stack_size = 0
+    best_face = -1
+    root = bvh.read_node(meshes_bvh, mesh.bvh_start)
+    root_t = bvh.intersectBounds(root.bbox_min, root.bbox_max, ray_local.origin, inv_dir, t_min, t_max)
+    if mesh.faces_ids_count > 0 and root_t < float('inf'):
+        stack[0] = mesh.bvh_start; stack_t[0] = root_t; stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = bvh.read_node(meshes_bvh, stack[stack_size])
+        if stack_t[stack_size] > t_max:
+            continue # a closer hit was found since this node was stacked
+        if node.count > 0:
+            for f in range(node.left_first, node.left_first + node.count):
+                face = meshes_faces[f]
+                t = intersectTriangle(meshes_verts[face.x], meshes_verts[face.y], meshes_verts[face.z], ray_local, t_min, t_max)
+                if t < t_max: t_max = t; best_face = f
+        else:
+            left = bvh.read_node(meshes_bvh, node.left_first)
+            right = bvh.read_node(meshes_bvh, node.left_first + 1)
+            t_left = bvh.intersectBounds(left.bbox_min, left.bbox_max, ray_local.origin, inv_dir, t_min, t_max)
+            t_right = bvh.intersectBounds(right.bbox_min, right.bbox_max, ray_local.origin, inv_dir, t_min, t_max)
+            # push the farther child first so that the nearer one is visited next
+            near, far = node.left_first, node.left_first + 1
+            if t_right < t_left:
+                near, far = far, near
+                t_left, t_right = t_right, t_left
+            if t_right < float('inf'):
+                stack[stack_size] = far; stack_t[stack_size] = t_right; stack_size += 1
+            if t_left < float('inf'):
+                stack[stack_size] = near; stack_t[stack_size] = t_left; stack_size += 1
+
+    if best_face >= 0:
+        face = meshes_faces[best_face]
+        v0 = meshes_verts[face.x]
+        out_intersect.is_hit = True
+        out_intersect.t = t_max
+        out_intersect.position = getRayPoint(ray_local, t_max)
+        out_intersect.normal = tm.normalize(tm.cross(meshes_verts[face.y] - v0, meshes_verts[face.z] - v0))
+        out_intersect.mat = mesh.material
+
+    return changeIntersectFrame(out_intersect, mesh.M, mesh.M_inv)
 
-    return out_intersect
+@ti.func
+def occludeMesh(mesh: Mesh, meshes_verts: ti.template(), meshes_faces: ti.template(), meshes_bvh: ti.template(),
+                ray: Ray, t_min: float, t_max: float) -> bool:
+    ''' Ray-mesh occlusion test, stops at the first triangle found between t_min and t_max '''
+    ray_local = changeRayFrame(ray, mesh.M_inv)
+    inv_dir = 1.0 / ray_local.direction
+
+    # any hit will do, so children are visited in any order
+    stack = ti.Vector([0] * bvh.BVH_STACK_SIZE, dt=ti.i32)
+    stack_size = 0
+    if mesh.faces_ids_count > 0:
+        stack[0] = mesh.bvh_start; stack_size = 1
+    is_hit = False
+    while stack_size > 0 and not is_hit:
+        stack_size -= 1
+        node = bvh.read_node(meshes_bvh, stack[stack_size])
+        if bvh.intersectBounds(node.bbox_min, node.bbox_max, ray_local.origin, inv_dir, t_min, t_max) < float('inf'):
+            if node.count > 0:
+                for f in range(node.left_first, node.left_first + node.count):
+                    face = meshes_faces[f]
+                    if intersectTriangle(meshes_verts[face.x], meshes_verts[face.y], meshes_verts[face.z], ray_local, t_min, t_max) < t_max:
+                        is_hit = True
+                        break
+            else:
+                stack[stack_size] = node.left_first; stack[stack_size + 1] = node.left_first + 1; stack_size += 2
+    return is_hit
@@ -18,9 +18,11 @@ def getRayPoint(ray: Ray, t: float) -> tm.vec3:
 def changeRayFrame(ray: Ray, M: tm.mat4) -> Ray:
     # TODO: Objective 4: Ray and Geometry Transformations
    
+    # The direction is not normalized in the new frame so that t values are the same in both frames, and the
+    # hits of all the primitives can be compared, and bound the ray, in world space
     d_local = M @ tm.vec4(ray.direction,0.0)
     o_local = M @ tm.vec4(ray.origin,1.0)
-    new_ray = Ray(o_local.xyz, tm.normalize(d_local.xyz))
+    new_ray = Ray(o_local.xyz, d_local.xyz)
 
     return new_ray 
 
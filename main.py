@@ -1,63 +1,332 @@
 import parser
 import argparse
-import matplotlib
-import matplotlib.pyplot as plt
+import meshcache
+import scene
+import sampler
+import output
+import checkpoint
+import pipeline
+from progress import ProgressReporter
+import os
+import multiprocessing
 import pathlib
+import signal
+import threading
+import time
 import taichi as ti
 import numpy as np
 
 parse = argparse.ArgumentParser()
-parse.add_argument("-i", "--infile", nargs='+', type=str, help="Name of json file that will define the scene", required = True)
+parse.add_argument("-i", "--infile", nargs='+', type=str, help="Name of json file that will define the scene, or of its bundle compiled by compile_scene.py")
 parse.add_argument("-o", "--outdir", type=str, default="out", help="directory for output files, default is ./out")
+parse.add_argument('--format', nargs='+', choices=output.IMAGE_FORMATS, default=["png"], help="Formats of the saved images, 8 bit png, or float npy or pfm, default is png")
+parse.add_argument('--save-queue', type=int, default=2, help="Number of outputs waiting to be saved by the background writer before the render waits for it, default is 2")
 parse.add_argument('-s', '--show', action='store_true', help="Show the image in a window")
 parse.add_argument('-f', '--factor', type=float, default=1.0, help="Scale factor for resolution")
+parse.add_argument('-b', '--batch', type=int, default=16, help="Number of samples per pixel rendered in each kernel launch, default is 16")
+parse.add_argument('-t', '--tile-size', type=int, default=16, help="Width and height of the tiles taken by the render workers, a power of two, default is 16")
+parse.add_argument('--tile-timings', action='store_true', help="Time the render of each tile before rendering, report a summary and save the timings as a .npy file in outdir")
+parse.add_argument('--sampler', type=str, choices=sorted(sampler.SAMPLER_BY_NAME), help="Sampler of the jittered pixel offsets, overrides AA_sampler of the scene (default is random)")
+parse.add_argument('--seed', type=int, default=0, help="Seed of the sampler, renders with the same seed are identical, default is 0")
+parse.add_argument('--sample-range', type=int, nargs=2, metavar=('FIRST', 'LAST'), help="Only render the samples [FIRST, LAST) of each pixel and save the accumulation buffer (.npz) instead of the image, see merge.py")
+parse.add_argument('-a', '--adaptive', type=float, default=0.0, help="Adaptive sampling: stop sampling pixels once the standard error of their luminance is below this threshold (e.g., 0.005), default is 0 (disabled)")
+parse.add_argument('--adaptive-min-samples', type=int, default=8, help="Number of samples of each pixel before adaptive sampling estimates its error, default is 8")
+parse.add_argument('--checkpoint-interval', type=float, default=0.0, help="Seconds between two checkpoints of the accumulation buffer saved in outdir, default is 0 (only on SIGINT or SIGTERM)")
+parse.add_argument('--resume', action='store_true', help="Continue the render of each scene from its checkpoint in outdir, if it matches the scene and settings")
+parse.add_argument('-p', '--progress', type=float, default=1.0, help="Seconds between two progress reports, default is 1")
+parse.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes rendering the scenes in parallel, each on its share of the CPUs, the most expensive scenes first, default is 1")
+parse.add_argument('--pipeline', type=int, default=0, help="Number of scenes loaded ahead by a background process while the current one renders, default is 0 (load all the scenes first)")
+parse.add_argument('--mesh-cache', type=str, default=".cache/meshes", help="Directory of the binary cache of parsed meshes, default is ./.cache/meshes")
+parse.add_argument('--no-mesh-cache', action='store_true', help="Always parse mesh files instead of using the mesh cache")
+parse.add_argument('--kernel-cache', type=str, default=".cache/kernels", help="Directory of the Taichi offline cache of compiled kernels, default is ./.cache/kernels")
+parse.add_argument('--no-kernel-cache', action='store_true', help="Compile the kernels on every run instead of using the offline cache")
+parse.add_argument('--prewarm', action='store_true', help="Compile the render kernels into the kernel cache without rendering, they are the same for all the scenes so no infile is needed")
 parse.add_argument('-ti', '--taichi', type=str, default='cpu', help="Taichi backend 'cpu', 'vulkan', 'cuda', 'metal', cpu is default")
 
 args = parse.parse_args()
+if args.infile is None and not args.prewarm:
+    parse.error("the following arguments are required: -i/--infile")
+if args.adaptive_min_samples < 2:
+    parse.error("adaptive sampling needs at least 2 samples per pixel to estimate the error")
+if args.sample_range is not None and (args.adaptive > 0 or args.show):
+    parse.error("a range of samples can not be rendered with adaptive sampling or in a window")
+if args.sample_range is not None and not 0 <= args.sample_range[0] < args.sample_range[1]:
+    parse.error("the sample range must be non empty and start at 0 or more")
+if args.tile_size < 1 or args.tile_size & (args.tile_size - 1) != 0:
+    parse.error("the tile size must be a power of two")
+if args.resume and args.show:
+    parse.error("a render can not be resumed in a window")
+if args.jobs > 1 and (args.show or args.pipeline > 0):
+    parse.error("parallel jobs can not show the images in a window or load the scenes with --pipeline")
 
-def save_image( image: ti.Vector.field, scene_file_name: str, outdir_name: str ):
-        img = image.to_numpy()
-        # remove the path and extension from scene file, put it in outdir with png extension
-        outdir = pathlib.Path(outdir_name)
-        outdir.mkdir(exist_ok=True) # Create output directory if it doesn't exist
-        fout = str(outdir / pathlib.Path(scene_file_name).stem) + ".png"
-        print("Saving image to", fout)
-        img = np.clip(img, 0, 1)           # Clamp to [0,1]
-        img = np.swapaxes(img, 0, 1)       # Change shape to (H, W, 3)        
-        img = np.flip(img, axis=0)         # Flip vertically (up/down)
-        matplotlib.image.imsave(fout, img, vmin=0, vmax=1)
+stop_requested = threading.Event()  # set by SIGINT or SIGTERM, the render saves a checkpoint and stops after the current launch
 
+def request_stop( signum, frame ):
+        if stop_requested.is_set():
+            raise KeyboardInterrupt  # interrupted twice, do not wait for the checkpoint
+        stop_requested.set()
+        print(f"Received {signal.Signals(signum).name}, saving a checkpoint after the current launch (send again to quit now)", flush=True)
 
-if __name__ == "__main__":
+def count_cached_kernels( cache_dir: str ) -> int:
+        ''' Number of compiled kernels stored in the Taichi offline cache directory '''
+        return len(list(pathlib.Path(cache_dir).glob("**/*.tic")))
 
-    if args.taichi == 'vulkan':
-        ti.init(ti.vulkan)
-    elif args.taichi == 'cuda':
-        ti.init(ti.cuda)
-    elif args.taichi == 'metal':
-        ti.init(ti.metal)
-    else:
-        ti.init(ti.cpu)
+def report_tile_timings( timings: np.ndarray, scene_file_name: str, outdir_name: str, tile_size: int ):
+        ''' Print a summary of the render time of the tiles and save them, to compare tile sizes '''
+        outdir = pathlib.Path(outdir_name)
+        outdir.mkdir(exist_ok=True)
+        fout = str(outdir / pathlib.Path(scene_file_name).stem) + "_tiles.npy"
+        np.save(fout, timings)
+        print(f"tiles name={scene_file_name} tile_size={tile_size} tiles={timings.shape[1]}x{timings.shape[0]} "
+              f"total_sec={timings.sum():.3f} mean_ms={1e3 * timings.mean():.3f} median_ms={1e3 * np.median(timings):.3f} "
+              f"max_ms={1e3 * timings.max():.3f} max_over_mean={timings.max() / timings.mean():.1f} file={fout}")
+
+def save_sample_counts( sample_count: np.ndarray, scene_file_name: str, outdir_name: str, samples: int ):
+        ''' Report the number of rays of an adaptive render, and save the number of samples of each pixel (.npy and .png) '''
+        outdir = pathlib.Path(outdir_name)
+        outdir.mkdir(exist_ok=True)
+        fout = str(outdir / pathlib.Path(scene_file_name).stem) + "_samples"
+        np.save(fout + ".npy", sample_count)
+        output.write_png(fout + ".png", sample_count.shape[1], sample_count.shape[0], 1,
+                         output.float_rows(sample_count[..., None] / max(samples, 1)))  # grey levels from 0 to samples
+        rays = int(sample_count.sum())
+        uniform_rays = sample_count.size * samples
+        print(f"adaptive name={scene_file_name} rays={rays} uniform_rays={uniform_rays} "
+              f"reduction={uniform_rays / max(rays, 1):.2f} file={fout}.npy")
+
+def render_scene( scene_file_name: str, full_scene: scene.Scene, writer: output.AsyncWriter ) -> bool:
+        ''' Render a scene with the settings of the command line and submit its outputs to the writer
+        Returns:
+            bool: False if the render was interrupted by SIGINT or SIGTERM, after saving a checkpoint
+        '''
+        # the first launch compiles the kernels, or loads them from the cache when they are in it
+        compile_start = time.perf_counter()
+        full_scene.compile()
+        print(f"kernels scene={scene_file_name} ready_sec={time.perf_counter() - compile_start:.2f}")
 
-    for scene_file_name in args.infile:
-        full_scene = parser.load_scene(scene_file_name, image_scale_factor=args.factor)
-        print("Scene Loaded")
+        full_scene.tile_size = args.tile_size
+        if args.sampler is not None:
+            full_scene.sampler_name = args.sampler
+        full_scene.seed = args.seed
+        full_scene.adaptive_threshold = args.adaptive
+        full_scene.adaptive_min_samples = args.adaptive_min_samples
+        batch = full_scene.samples_per_launch(args.batch)
+        if args.tile_timings:
+            report_tile_timings(full_scene.profile_tiles(), scene_file_name, args.outdir, args.tile_size)
 
         if args.show:
             gui = ti.GUI('Image', (full_scene.camera.width, full_scene.camera.height)) 
             iteration = 1
+            progress = ProgressReporter(scene_file_name, full_scene.camera.width * full_scene.camera.height * max(0, full_scene.samples), args.progress)
+            progress.start()
             while gui.running:
                 if iteration <= full_scene.samples and full_scene.samples > 0:
-                    full_scene.render(iteration)
-                    print(f"Completed {iteration-1} / {full_scene.samples} samples per pixel")
-                    iteration += 1
-                gui.set_image( full_scene.image )
+                    nb_samples = min(batch, full_scene.samples - iteration + 1)
+                    nb_sampled_pixels = full_scene.render_samples(iteration, nb_samples)
+                    iteration += nb_samples
+                    if nb_sampled_pixels == 0:
+                        iteration = full_scene.samples + 1  # adaptive sampling converged everywhere
+                    progress.update(full_scene.progress)
+                    if iteration > full_scene.samples:
+                        progress.stop()
+                gui.set_image( full_scene.image_to_numpy() )
                 gui.show()
-            save_image( full_scene.image, scene_file_name, args.outdir )
+            if iteration <= full_scene.samples:
+                progress.stop()  # window closed before the end of the render
+            writer.submit( output.save_image, full_scene.image_to_numpy(), scene_file_name, args.outdir, args.format )
+            if args.adaptive > 0:
+                writer.submit( save_sample_counts, full_scene.sample_count_to_numpy(), scene_file_name, args.outdir, full_scene.samples )
         else:
             if full_scene.samples < 0:
                 full_scene.samples = 1  # just do one iteration if not showing and requesting infinite samples
-            for iteration in range(1, full_scene.samples + 1):
-                full_scene.render( iteration )
-                print(f"Completed {iteration} / {full_scene.samples} samples per pixel")        
-            save_image( full_scene.image, scene_file_name, args.outdir )
+            first_sample, last_sample = 0, full_scene.samples
+            if args.sample_range is not None:
+                first_sample, last_sample = args.sample_range
+            full_scene.first_sample = first_sample
+            nb_samples_total = last_sample - first_sample
+
+            # the hash covers the scene and every setting that changes its samples, so that a checkpoint is only
+            # resumed by the same render
+            checkpoint_file = checkpoint.checkpoint_path(scene_file_name, args.outdir)
+            scene_hash = full_scene.content_hash()
+            first_iteration = 1
+            if args.resume:
+                saved = checkpoint.load(checkpoint_file)
+                if saved is None:
+                    print(f"checkpoint name={scene_file_name} resumed=none file={checkpoint_file}")
+                elif saved["scene_hash"] != scene_hash:
+                    print(f"checkpoint name={scene_file_name} resumed=none reason=scene_or_settings_changed file={checkpoint_file}")
+                else:
+                    full_scene.restore(saved, saved["progress"])
+                    first_iteration = saved["iteration"]
+                    print(f"checkpoint name={scene_file_name} resumed_iteration={first_iteration} file={checkpoint_file}")
+
+            previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+            last_checkpoint = time.perf_counter()
+            interrupted = False
+            with ProgressReporter(scene_file_name, full_scene.camera.width * full_scene.camera.height * nb_samples_total, args.progress,
+                                  initial_pixels=full_scene.progress) as progress:
+                for iteration in range(first_iteration, nb_samples_total + 1, batch):
+                    nb_samples = min(batch, nb_samples_total - iteration + 1)
+                    # launched by ranges of tiles, so that the progress is reported while a long batch renders
+                    nb_sampled_pixels = full_scene.render_samples_in_chunks( iteration, nb_samples, args.progress, progress.update )
+                    if nb_sampled_pixels == 0:
+                        break  # adaptive sampling converged everywhere
+                    if stop_requested.is_set() or (args.checkpoint_interval > 0 and time.perf_counter() - last_checkpoint >= args.checkpoint_interval):
+                        save_start = time.perf_counter()
+                        checkpoint.save(checkpoint_file, full_scene.accumulation_buffer(scene_file_name), iteration + nb_samples,
+                                        scene_hash, full_scene.progress)
+                        last_checkpoint = time.perf_counter()
+                        print(f"checkpoint name={scene_file_name} iteration={iteration + nb_samples} "
+                              f"save_sec={last_checkpoint - save_start:.3f} file={checkpoint_file}", flush=True)
+                        if stop_requested.is_set():
+                            interrupted = True
+                            break
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            if interrupted:
+                return False  # continued by a run with --resume
+            if args.sample_range is not None:
+                writer.submit( output.save_accumulation, full_scene.accumulation_buffer(scene_file_name), scene_file_name, args.outdir )
+            else:
+                writer.submit( output.save_image, full_scene.image_to_numpy(), scene_file_name, args.outdir, args.format )
+                if args.adaptive > 0:
+                    writer.submit( save_sample_counts, full_scene.sample_count_to_numpy(), scene_file_name, args.outdir, full_scene.samples )
+            if os.path.exists(checkpoint_file):
+                writer.submit( os.remove, checkpoint_file )  # the render is complete once its outputs are written
+        return True
+
+def init_taichi( threads: int = None ) -> int:
+        ''' Start the Taichi runtime, on at most threads CPU threads (all of them if None)
+        Returns:
+            int: number of kernels in the offline cache, to report the misses when finished
+        '''
+        kernel_cache = {"offline_cache": not args.no_kernel_cache}
+        nb_cached_kernels = 0
+        if not args.no_kernel_cache:
+            kernel_cache["offline_cache_file_path"] = str(pathlib.Path(args.kernel_cache).resolve())
+            nb_cached_kernels = count_cached_kernels(args.kernel_cache)
+            print(f"kernel cache dir={args.kernel_cache} kernels={nb_cached_kernels}")
+        if threads is not None:
+            kernel_cache["cpu_max_num_threads"] = threads
+
+        if args.taichi == 'vulkan':
+            ti.init(ti.vulkan, **kernel_cache)
+        elif args.taichi == 'cuda':
+            ti.init(ti.cuda, **kernel_cache)
+        elif args.taichi == 'metal':
+            ti.init(ti.metal, **kernel_cache)
+        else:
+            ti.init(ti.cpu, **kernel_cache)
+            scene.render_threads = threads or os.cpu_count()  # the default of cpu_max_num_threads
+
+        if not args.no_mesh_cache:
+            parser.mesh_cache = meshcache.MeshCache(args.mesh_cache)
+        return nb_cached_kernels
+
+def finish_taichi( nb_cached_kernels: int ):
+        if not args.no_kernel_cache:
+            ti.reset()  # the offline cache is written when the program is finalized
+            nb_new_kernels = count_cached_kernels(args.kernel_cache) - nb_cached_kernels
+            print(f"kernel cache dir={args.kernel_cache} misses={nb_new_kernels} kernels={nb_cached_kernels + nb_new_kernels}")
+        # with --pipeline the meshes are loaded, and reported, by the SceneLoader process
+        if parser.mesh_cache is not None and parser.mesh_cache.hits + parser.mesh_cache.misses > 0:
+            parser.mesh_cache.report()
+
+def render_worker( cpus: list, scene_files ):
+        ''' Worker process of --jobs, render the scenes taken from the queue until it gets None
+        Args:
+            cpus (list): CPUs of the worker, its render threads are pinned to them
+            scene_files (multiprocessing.Queue): scene files to render, shared by all the workers
+        '''
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        nb_cached_kernels = init_taichi(len(cpus))
+        with output.AsyncWriter(args.save_queue) as writer:
+            while True:
+                scene_file_name = scene_files.get()
+                if scene_file_name is None:
+                    break
+                full_scene = parser.load_scene(scene_file_name, image_scale_factor=args.factor)
+                rendered = render_scene(scene_file_name, full_scene, writer)
+                full_scene.release()
+                if not rendered:
+                    break
+        finish_taichi(nb_cached_kernels)
+        if stop_requested.is_set():
+            raise SystemExit(130)
+
+def render_jobs( nb_jobs: int ) -> int:
+        ''' Render the scenes on nb_jobs worker processes, each with a disjoint share of the CPUs
+        Returns:
+            int: exit status, 130 if a worker was interrupted, 1 if one failed
+
+            The workers take the scenes from a shared queue, from the most expensive to the least (see
+            parser.estimate_cost), so that a long scene does not start last and keep a single worker busy
+            while the others are idle.
+        '''
+        costs = {scene_file_name: parser.estimate_cost(scene_file_name, args.factor) for scene_file_name in args.infile}
+        order = sorted(args.infile, key=lambda scene_file_name: costs[scene_file_name], reverse=True)
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        blocks = [block.tolist() for block in np.array_split(cpus, min(nb_jobs, len(cpus)))]
+        print(f"jobs workers={nb_jobs} threads={[len(blocks[i % len(blocks)]) for i in range(nb_jobs)]} "
+              f"order={[pathlib.Path(scene_file_name).stem for scene_file_name in order]}", flush=True)
+
+        context = multiprocessing.get_context("spawn")  # a fresh interpreter for each Taichi runtime
+        scene_files = context.Queue()
+        for scene_file_name in order + [None] * nb_jobs:
+            scene_files.put(scene_file_name)
+        workers = [context.Process(target=render_worker, args=(blocks[i % len(blocks)], scene_files)) for i in range(nb_jobs)]
+        for worker in workers:
+            worker.start()
+        # the workers get the signals of the terminal too, this process only waits for their checkpoints
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        for worker in workers:
+            worker.join()
+        exit_codes = [worker.exitcode for worker in workers]
+        if any(code not in (0, 130) for code in exit_codes):
+            print(f"jobs failed exit_codes={exit_codes}", flush=True)
+            return 1
+        return 130 if 130 in exit_codes else 0
+
+
+if __name__ == "__main__":
+
+    if args.jobs > 1:
+        raise SystemExit(render_jobs(args.jobs))
+
+    nb_cached_kernels = init_taichi()
+
+    if args.prewarm:
+        compile_start = time.perf_counter()
+        scene.compile_kernels()
+        print(f"kernels prewarm ready_sec={time.perf_counter() - compile_start:.2f}")
+        finish_taichi(nb_cached_kernels)
+        raise SystemExit(0)
+
+    if args.pipeline > 0:
+        # scenes are loaded while the previous ones render
+        loader = pipeline.SceneLoader(args.infile, args.factor, None if args.no_mesh_cache else args.mesh_cache, args.pipeline)
+        scene_batch = loader
+    else:
+        # all the scenes are loaded first
+        scenes = []
+        for scene_file_name in args.infile:
+            scenes.append(parser.load_scene(scene_file_name, image_scale_factor=args.factor))
+            print("Scene Loaded")
+        scene_batch = zip(args.infile, scenes)
+
+    # images are saved by a background thread while the next scene renders, and all written before exiting
+    with output.AsyncWriter(args.save_queue) as writer:
+        for scene_file_name, full_scene in scene_batch:
+            rendered = render_scene(scene_file_name, full_scene, writer)
+            full_scene.release()  # its outputs are copies, and the next scenes do not need its ndarrays
+            if not rendered:
+                break
+    if args.pipeline > 0:
+        loader.close()
+
+    finish_taichi(nb_cached_kernels)
+    if stop_requested.is_set():
+        raise SystemExit(130)
@@ -0,0 +1,20 @@
+import accumulation
+import output
+import argparse
+
+parse = argparse.ArgumentParser(description="Merge the accumulation buffers of disjoint sample ranges of a render (see main.py --sample-range)")
+parse.add_argument("buffers", nargs='+', type=str, help="Accumulation buffers (.npz) to merge")
+parse.add_argument("-o", "--outdir", type=str, default="out", help="directory for output files, default is ./out")
+parse.add_argument("--format", nargs='+', choices=output.IMAGE_FORMATS, default=["png"], help="Formats of the merged image, 8 bit png, or float npy or pfm, default is png")
+parse.add_argument("--accum", action='store_true', help="Also save the merged accumulation buffer, to merge it again later")
+
+args = parse.parse_args()
+
+if __name__ == "__main__":
+    buffers = [accumulation.load(path) for path in args.buffers]
+    merged = accumulation.merge(buffers)
+    first, last = merged["sample_range"]
+    print("Merged", len(buffers), "buffers of", merged["scene"], "samples", f"[{first}, {last})")
+    if args.accum:
+        output.save_accumulation(merged, merged["scene"], args.outdir)
+    output.save_image(accumulation.resolve(merged["accum"], merged["sample_count"]), merged["scene"], args.outdir, args.format)
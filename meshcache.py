@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import bvh
+
+CACHE_VERSION = 1  # bump when the cached arrays or the BVH build change, to invalidate old entries
+MESH_ARRAYS = ("verts", "faces", "bbox_min", "bbox_max", "left_first", "count")
+
+def parse_mesh(path: str) -> (np.ndarray, np.ndarray, dict):
+    ''' Parse a mesh file and build its BVH
+    Args:
+        path (str): path to the mesh file (any format supported by trimesh)
+    Returns:
+        (np.ndarray, np.ndarray, dict): vertices (float32), faces (int32) in the order in which the leaves
+        of the BVH reference them, and numpy columns of the BVH nodes in mesh-local space
+    '''
+    import trimesh  # slow to import, only needed when a mesh is not in the cache
+    mesh = trimesh.load_mesh(path)
+    verts = np.asarray(mesh.vertices, dtype=np.float32)
+    faces = np.asarray(mesh.faces, dtype=np.int32)
+    nodes, order = bvh.build_mesh_bvh(verts, faces)
+    return verts, faces[order], nodes
+
+class MeshCache:
+    ''' On-disk cache of parsed meshes and their BVH
+
+        Each mesh is stored as uncompressed .npy files in a directory named after the hash of the
+        mesh file content, and is memory mapped when loaded.  An index entry per mesh path records
+        the modification time and size of the file along with its hash, so that unchanged files
+        are found without being read.  Modified files are hashed again, and only parsed if no
+        entry exists for their new content.
+    '''
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0  # meshes loaded from the cache
+        self.misses = 0  # meshes parsed and added to the cache
+
+    def _index_path(self, path: str) -> str:
+        key = hashlib.sha1(path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, "index", key + ".json")
+
+    def _entry_dir(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"v{CACHE_VERSION}", content_hash)
+
+    def _content_hash(self, path: str, stat: os.stat_result) -> str:
+        index_path = self._index_path(path)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index["mtime_ns"] == stat.st_mtime_ns and index["size"] == stat.st_size:
+                return index["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        index = {"path": path, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "hash": h.hexdigest()}
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+        return index["hash"]
+
+    def load(self, path: str) -> (np.ndarray, np.ndarray, dict):
+        ''' Load a mesh from the cache, parsing it and adding it to the cache on a miss
+        Args:
+            path (str): path to the mesh file
+        Returns:
+            (np.ndarray, np.ndarray, dict): same as parse_mesh, but the arrays are read-only memory maps on a hit
+        '''
+        path = os.path.realpath(path)
+        entry_dir = self._entry_dir(self._content_hash(path, os.stat(path)))
+        try:
+            arrays = {name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r") for name in MESH_ARRAYS}
+            self.hits += 1
+        except (OSError, ValueError):
+            self.misses += 1
+            verts, faces, nodes = parse_mesh(path)
+            arrays = dict(nodes, verts=verts, faces=faces)
+            self._store(entry_dir, arrays)
+        nodes = {name: arrays[name] for name in bvh.empty_bvh()}
+        return arrays["verts"], arrays["faces"], nodes
+
+    def report(self):
+        ''' Print the hits and misses of the meshes loaded so far, for the summary of a run '''
+        print(f"mesh cache dir={self.cache_dir} hits={self.hits} misses={self.misses}", flush=True)
+
+    def _store(self, entry_dir: str, arrays: dict):
+        # written in a temporary directory and renamed, so that readers never see a partial entry
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), suffix=".tmp")
+        for name in MESH_ARRAYS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(arrays[name]))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # stored concurrently by another process
+            for name in MESH_ARRAYS:
+                os.remove(os.path.join(tmp_dir, name + ".npy"))
+            os.rmdir(tmp_dir)
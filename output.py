@@ -0,0 +1,186 @@
+import numpy as np
+import concurrent.futures
+import os
+import pathlib
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import accumulation
+
+IMAGE_FORMATS = ("png", "npy", "pfm")
+PNG_BAND_BYTES = 1 << 18  # uncompressed size of the bands of rows compressed by each zlib thread
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    ''' Adler-32 of the concatenation of two buffers, from their checksums and the length of the second one '''
+    base = 65521
+    s1 = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+    s2 = ((adler1 >> 16) + (adler2 >> 16) + len2 * ((adler1 & 0xffff) - 1)) % base
+    return (s2 << 16) | s1
+
+def float_rows(img: np.ndarray):
+    ''' Rows of a float image quantized to 8 bits, as read by write_png
+    Args:
+        img (np.ndarray): (width, height, channels) image with values in [0, 1], y going up as rendered
+    Returns:
+        function: rows(y0, y1) returning the rows y0 to y1 from the top as a (y1 - y0, width, channels) uint8 array
+
+        The image is flipped and transposed as a view, and each band of rows is clipped, scaled and
+        converted while it is in cache, instead of making a full frame copy at each step.
+    '''
+    top_down = img.transpose(1, 0, 2)[::-1]
+    def rows(y0: int, y1: int) -> np.ndarray:
+        band = np.clip(top_down[y0:y1], 0, 1).astype(np.float32, copy=False)
+        band *= 255
+        return band.astype(np.uint8)  # truncated, as matplotlib did
+    return rows
+
+def _png_band(rows, y0: int, y1: int, level: int, last: bool) -> (bytes, int, int):
+    # rows use the Up filter (difference with the row above), which needs the last row of the previous band
+    pixels = rows(max(y0 - 1, 0), y1)
+    pixels = pixels.reshape(pixels.shape[0], -1)
+    filtered = np.empty((y1 - y0, pixels.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    if y0 == 0:
+        filtered[0, 1:] = pixels[0]
+        np.subtract(pixels[1:], pixels[:-1], out=filtered[1:, 1:])
+    else:
+        np.subtract(pixels[1:], pixels[:-1], out=filtered[:, 1:])
+    data = filtered.data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)  # raw deflate, the bands are concatenated
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data), filtered.size
+
+def write_png(path: str, height: int, width: int, channels: int, rows, threads: int = None, level: int = 6):
+    ''' Write an 8 bit PNG image, compressing bands of rows on several threads
+    Args:
+        path (str): file to write
+        height (int): number of rows
+        width (int): number of pixels per row
+        channels (int): 1 for grey, 3 for RGB
+        rows (function): rows(y0, y1) returns the rows y0 to y1 from the top, a (y1 - y0, width, channels) uint8 array
+        threads (int): number of compression threads, all the CPUs if None
+        level (int): zlib compression level
+
+        Each band is a raw deflate stream ending on a byte boundary (a sync flush), so the streams can be
+        concatenated into the single zlib stream of the image, whose checksum is combined from those of
+        the bands.  zlib releases the GIL while compressing, so the threads run in parallel.
+    '''
+    row_bytes = width * channels + 1
+    band_rows = max(1, PNG_BAND_BYTES // row_bytes)
+    bands = [(y0, min(y0 + band_rows, height)) for y0 in range(0, height, band_rows)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        results = list(executor.map(lambda band: _png_band(rows, band[0], band[1], level, band[1] == height), bands))
+    adler = 1
+    for _, band_adler, size in results:
+        adler = adler32_combine(adler, band_adler, size)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+    colour_type = {1: 0, 3: 2}[channels]
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0)))
+        f.write(chunk(b"IDAT", b"".join([b"\x78\x9c"] + [compressed for compressed, _, _ in results] + [struct.pack(">I", adler)])))
+        f.write(chunk(b"IEND", b""))
+
+def write_pfm(path: str, img: np.ndarray):
+    ''' Write a float image as PFM, whose rows go from the bottom up like those of the render
+    Args:
+        img (np.ndarray): (width, height, 3) image, written without a copy when it is a view of a (height, width, 3) array (see accumulation.resolve)
+    '''
+    rows = np.ascontiguousarray(img.transpose(1, 0, 2), dtype=np.float32)
+    with open(path, "wb") as f:
+        scale = -1.0 if sys.byteorder == "little" else 1.0  # the sign of the scale gives the byte order
+        f.write(f"PF\n{rows.shape[1]} {rows.shape[0]}\n{scale}\n".encode())
+        rows.tofile(f)
+
+def save_image( img: np.ndarray, scene_file_name: str, outdir_name: str, formats: tuple = ("png",) ):
+        ''' Save an image in outdir, named after the scene file
+        Args:
+            img (np.ndarray): (width, height, 3) image, as returned by accumulation.resolve
+            scene_file_name (str): the path and extension are replaced by outdir and the extension of each format
+            outdir_name (str): output directory, created if it does not exist
+            formats (tuple): IMAGE_FORMATS to save, 8 bit png, or the float values as npy (an array of shape
+                (height, width, 3) with the bottom row first) or pfm
+        '''
+        outdir = pathlib.Path(outdir_name)
+        outdir.mkdir(exist_ok=True) # Create output directory if it doesn't exist
+        stem = str(outdir / pathlib.Path(scene_file_name).stem)
+        for fmt in formats:
+            fout = stem + "." + fmt
+            print("Saving image to", fout)
+            if fmt == "png":
+                write_png(fout, img.shape[1], img.shape[0], 3, float_rows(img))
+            elif fmt == "npy":
+                np.save(fout, np.ascontiguousarray(img.transpose(1, 0, 2)))
+            elif fmt == "pfm":
+                write_pfm(fout, img)
+            else:
+                raise ValueError(f"unknown image format {fmt}, expected one of {IMAGE_FORMATS}")
+
+def save_accumulation( buffer: dict, scene_file_name: str, outdir_name: str ) -> str:
+        ''' Save the accumulation buffer of a range of samples in outdir, named after the scene and the range '''
+        outdir = pathlib.Path(outdir_name)
+        outdir.mkdir(exist_ok=True)
+        first, last = buffer["sample_range"]
+        fout = str(outdir / pathlib.Path(scene_file_name).stem) + f"_{first}_{last}.npz"
+        print("Saving accumulation buffer to", fout)
+        accumulation.save(fout, buffer)
+        return fout
+
+class AsyncWriter:
+    ''' Run the saving of outputs on a background thread, so that encoding and writing an image overlaps
+        the loading and rendering of the next scene
+
+        Saves are run in the order in which they are submitted.  The queue is bounded, so that a render
+        faster than the disk waits for a slot instead of keeping every image in memory.  The arrays given
+        to a save must not be modified afterwards, which holds for those returned by the Scene methods
+        (they are copies of the ndarrays of the scene).  numpy and zlib release the GIL, so a thread is enough.
+    '''
+    def __init__(self, max_pending: int = 2):
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.error = None  # first exception raised by a save, raised again in the main thread
+        self.nb_saves = 0
+        self.blocked_sec = 0.0  # time the main thread waited for a slot in the queue
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(raise_error=exc[0] is None)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            function, args = task
+            if self.error is None:  # later saves are skipped once one fails
+                try:
+                    function(*args)
+                except BaseException as e:
+                    self.error = e
+
+    def submit(self, function, *args):
+        ''' Call function(*args) on the writer thread, waiting when max_pending saves are already queued '''
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put((function, args))
+        self.blocked_sec += time.perf_counter() - start
+        self.nb_saves += 1
+
+    def close(self, raise_error: bool = True):
+        ''' Wait for all the saves to be written, and raise the error of the first one that failed '''
+        start = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        print(f"output saves={self.nb_saves} blocked_sec={self.blocked_sec:.3f} flush_sec={time.perf_counter() - start:.3f}", flush=True)
+        if raise_error and self.error is not None:
+            raise self.error
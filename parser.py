@@ -1,33 +1,60 @@
-import json5 as json
-import helperclasses as hc
+import json
+import json5
+import os
 from camera import Camera
-import geometry as geom
+import bvh
+import bundle
+import meshcache
 import scene
-import trimesh
+import sampler
 import numpy as np
+import re
 import taichi.math as tm
 from pyglm import glm
 
-geom_id = -1  # global geometry ID counter
-meshes_total_nb_verts = 0  # global counter of total number of mesh vertices in the scene
-meshes_total_nb_faces = 0  # global counter of total number of mesh faces in the scene
-scene_meshes_verts = np.empty((0, 3), dtype=np.float32)
-scene_meshes_faces = np.empty((0, 3), dtype=np.int32)
+mesh_cache = None  # meshcache.MeshCache used by default to load mesh files, or None to always parse them
 
-def load_scene(infile: str, image_scale_factor: float = 1.0) -> scene.Scene:
-    ''' Load a scene from a json file 
+ROW_MEMBERS = {"sphere": ("id", "material", "radius"),
+               "plane": ("id", "two_materials", "material1", "material2", "normal"),
+               "box": ("id", "material", "minpos", "maxpos")}  # members of the primitives loaded by LoadContext.add_row
+ROW_FLOATS = {"sphere": ("radius",), "plane": ("normal",), "box": ("minpos", "maxpos")}  # floats, also when the json numbers are integers
+ROW_BLOCK = 1 << 16  # rows of primitives converted to numpy columns at once
+
+# Primitives are loaded as dictionaries of the members of their Taichi dataclass (with materials given by
+# their index in the material table), and are given to the Scene as struct-of-arrays numpy columns.
+# The spheres, planes and boxes at the root of the scene, which are most of the primitives of large scenes, are
+# instead added as rows of values that are converted to columns by blocks (see LoadContext.add_row), or when
+# they follow one like them in a strict json file, read from the text as numpy arrays (see LoadContext.add_run).
+
+def load_scene(infile: str, image_scale_factor: float = 1.0, cache: meshcache.MeshCache = None) -> scene.Scene:
+    ''' Load a scene from a json file, or from a bundle compiled from one (see bundle.py)
     Args:
-        infile (str): path to the scene json file
+        infile (str): path to the scene json file, or to its bundle
         image_scale_factor (float): scale factor for image resolution
+        cache (meshcache.MeshCache): cache to load the mesh files from, the module mesh_cache if None
     Returns:
         scene.Scene: the loaded scene object
 
         The json file can define a hierarchy of nodes, but they will be flattend into a list of geometries in the returned scene
         by accumulating the transformation matrices down the hierarchy.  Instances are provided as a convenience for
+
+        Strict json files are read by the C decoder of the json module, one object of the scene at a time (see
+        read_scene_json), other files by json5, which is much slower.
     '''
+    if bundle.is_bundle(infile):
+        return bundle.load(infile, image_scale_factor)
     print("Parsing file:", infile)
-    f = open(infile)
-    data = json.load(f)
+    with open(infile) as f:
+        text = f.read()
+    cache = mesh_cache if cache is None else cache
+    try:
+        data, scene_objects = read_scene_json(text)
+        context = load_objects(data, scene_objects, cache)
+    except json.JSONDecodeError:
+        # not strict json (e.g., comments or trailing commas), decoded as a whole, with a new context
+        data = json5.loads(text)
+        context = load_objects(data, data["objects"], cache)
+    print("Loaded", context.geom_id + 1, "geometric objects")
 
     # Loading resolution
     default_resolution = [1280, 720]    
@@ -47,109 +74,376 @@ def load_scene(infile: str, image_scale_factor: float = 1.0) -> scene.Scene:
     # Loading Anti-Aliasing options    
     jitter = data.get( "AA_jitter", False ) # default to no jitter
     samples = data.get( "AA_samples", 1 ) # default to no supersampling
+    sampler_name = data.get( "AA_sampler", "random" ) # sampler of the jittered offsets, see sampler.SAMPLER_BY_NAME
+    if sampler_name not in sampler.SAMPLER_BY_NAME:
+        print("Unknown sampler", sampler_name, ", using random")
+        sampler_name = "random"
     
     # Loading scene lights
     lights_tmp = []
     for light in data.get("lights", []):
         l_type = light["type"]
         l_name = light["name"]
-        l_colour = tm.vec3(light["colour"])
+        l_colour = np.array(light["colour"], dtype=np.float32)
         l_power = light.get( "power", 1.0 ) # The power scales the specified light colour
         if l_type == "point":
-            l_vector = tm.vec3(light["position"])
-            l_attenuation = tm.vec3(0,0,1) if "attenuation" not in light else tm.vec3( light["attenuation"] )
+            l_vector = np.array(light["position"], dtype=np.float32)
+            l_attenuation = [0,0,1] if "attenuation" not in light else light["attenuation"]
             l_type = 1
         elif l_type == "directional":
-            l_vector = tm.normalize(tm.vec3(light["direction"]))
-            l_attenuation = tm.vec3(0,0,0)
+            l_vector = np.array(light["direction"], dtype=np.float32)
+            l_vector /= np.linalg.norm(l_vector)
+            l_attenuation = [0,0,0]
             l_type = 0
             if "attenuation" in light:
                 print("Directional light", l_name, "has attenuation, ignoring")
         else:
             print("Unkown light type", l_type, ", skipping initialization")
             continue
-        lights_tmp.append(hc.Light(l_type, len(lights_tmp), l_colour * l_power, l_vector, l_attenuation))
+        lights_tmp.append({"ltype": l_type, "id": len(lights_tmp), "colour": l_colour * l_power,
+                           "vector": l_vector, "attenuation": l_attenuation})
 
-    # Taichi does not accept a zero-length field, so we create a field of size 1 if the list is empty.
-    # This means we need to keep track of the actual number of lights separately.
     nb_lights = len(lights_tmp)
-    lights = hc.Light.field(shape=max(1, nb_lights))
-    for i in range(len(lights_tmp)):
-        lights[i] = lights_tmp[i]
-
-    # Loading materials
-    material_by_name = {} # materials dictionary
-    mat_id = 0
-    for material in data["materials"]:
-        mat_name = material["name"]
-        mat_diffuse = tm.vec3(material["diffuse"])
-        mat_specular = tm.vec3(material["specular"])
-        mat_shininess = 0 if "shininess" not in material else material["shininess"]
-        material_by_name[mat_name] = hc.Material(mat_id, mat_diffuse, mat_specular, mat_shininess)
-        mat_id += 1
-
-    # load geometires
-    objects = {"sphere": [],
-               "plane": [],
-               "box": [],
-               "mesh": []}  # lists of loaded object geometries and hierarchy roots
-    node_by_name = {}  # dictionary of geometries by name (for instances)
-
-    M_parent = tm.mat4(np.eye(4))  # identity matrix as the initial parent transformation
-
-    for geometry in data["objects"]:
-        if geometry["type"] == "node":
-            g = load_node(geometry, material_by_name, node_by_name, M_parent)
+    lights = primitive_columns(lights_tmp)
+
+    # the number of objects is kept separately, the columns of a kind of primitive without any are an empty dictionary
+    spheres, nb_spheres = context.columns("sphere")
+    planes, nb_planes = context.columns("plane")
+    boxes, nb_boxes = context.columns("box")
+    meshes, nb_meshes = context.columns("mesh")
+
+    meshes_verts, meshes_faces, meshes_bvh = context.mesh_arrays()
+
+    return scene.Scene( jitter, samples, sampler_name,  # General settings
+                camera,  # Camera settings
+                ambient, lights, nb_lights,  # Light settings
+                spheres, nb_spheres,
+                planes, nb_planes,
+                boxes, nb_boxes,
+                meshes, nb_meshes, meshes_verts, meshes_faces, meshes_bvh)  # Geometry settings
+
+def is_json_number(value) -> bool:
+    return type(value) in (int, float)  # not bool, which is a subclass of int
+
+class JsonRun:
+    ''' Elements of a json array read at once as numpy arrays, after an element which they are like (see JsonStream.elements)
+
+        The elements of a run have the same keys as the element they follow, in the same order, with the same strings and
+        the same number of values, only their numbers and the strings of the variable keys differ.
+    Args:
+        like (dict): the element followed by the run
+        layout (list): (key, kind, length) of each member of the elements, kind is "number", "numbers", "string" or "strings"
+            (the strings of a variable key)
+        values (np.ndarray): (n, k) numbers of the n elements of the run, in the order of the text
+        strings (np.ndarray): (n, s) strings of the variable keys of the elements, as utf-8 bytes, in the order of the text
+    '''
+    def __init__(self, like: dict, layout: list, values: np.ndarray, strings: np.ndarray):
+        self.like = like
+        self.layout = layout
+        self.values = values
+        self.strings = strings
+
+    def members(self) -> dict:
+        ''' Numbers and variable strings of each key of the elements, (n,) arrays for single numbers, (n, length) for lists '''
+        members = {}
+        i, j = 0, 0
+        for key, kind, length in self.layout:
+            if kind == "number":
+                members[key] = self.values[:, i]
+            elif kind == "numbers":
+                members[key] = self.values[:, i:i + length]
+            elif kind == "strings":
+                members[key] = self.strings[:, j:j + length]
+            i += length if kind.startswith("number") else 0
+            j += length if kind == "strings" else 0
+        return members
+
+class JsonStream:
+    ''' Strict json text decoded one value at a time by the C decoder of the json module '''
+    whitespace = re.compile(r'[ \t\n\r]*')
+    separator = re.compile(r'[ \t\n\r]*,[ \t\n\r]*')
+    object_array_end = re.compile(r'\}[ \t\n\r]*\]')
+    number_marks = bytes.maketrans(b"0123456789.+-eE", b"0" * 15)  # characters of numbers, all replaced by 0 in the structure
+    punctuation = bytes.maketrans(b'{}[],:"', b" " * 7)  # replaced by spaces between the numbers of a run
+    run_chunk = 1 << 22  # most characters of text read at once as a JsonRun
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def peek(self) -> str:
+        ''' Next character after the whitespace, which is skipped '''
+        self.pos = self.whitespace.match(self.text, self.pos).end()
+        return self.text[self.pos:self.pos + 1]
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.text, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        value, self.pos = self.decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def elements(self, run_keys=None):
+        ''' Iterate over the elements of an array, each decoded when it is reached
+        Args:
+            run_keys (function): called with each decoded element, returns the keys whose strings may differ in a JsonRun
+                of the elements that follow it, or None to decode them one at a time
+
+            The runs are read by chunks of text, from 64 elements to run_chunk characters.  A chunk that is not a run
+            (e.g., its elements have other keys or another type, or it is not strict json) is read again in halves,
+            down to 64 elements, whose elements are then decoded one at a time, and a run may only follow the
+            first element past them.
+        '''
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        scan_once = self.decoder.scan_once  # raw_decode without its checks, this loop runs once per object of a scene
+        array_end = -1  # end of the last element of the array, where runs end
+        run_start = 0  # runs may only follow the elements after this position
+        while True:
+            start = self.pos
+            try:
+                value, self.pos = scan_once(self.text, self.pos)
+            except StopIteration as e:
+                raise json.JSONDecodeError("Expecting value", self.text, e.value) from None
+            yield value
+            variable_keys = run_keys(value) if run_keys is not None and start >= run_start else None
+            template = None if variable_keys is None else self.template(value, start, variable_keys)
+            if template is not None:
+                if array_end < self.pos:
+                    # the first '}]' ends the array unless the elements have arrays of objects, then runs stop there
+                    match = self.object_array_end.search(self.text, self.pos - 1)
+                    array_end = len(self.text) if match is None else match.start() + 1
+                min_size = size = 64 * (self.pos - start)
+                while self.pos < array_end:
+                    end = self.text.find("}", self.pos + size) + 1
+                    if end <= 0 or end > array_end:
+                        end = array_end
+                    run = self.read_run(value, template, end)
+                    if run is None and size > min_size:
+                        size //= 2
+                        continue
+                    if run is None:
+                        run_start = end
+                        break
+                    yield run
+                    size = min(2 * size, self.run_chunk)
+            separator = self.separator.match(self.text, self.pos)
+            if separator is None:
+                break
+            self.pos = separator.end()
+        self.expect("]")
+
+    def keys(self):
+        ''' Iterate over the keys of an object, the value of each key must be read before the next one '''
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name", self.text, self.pos)
+            self.expect(":")
+            yield key
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.expect("}")
+
+    def end(self):
+        if self.peek() != "":
+            raise json.JSONDecodeError("Extra data", self.text, self.pos)
+
+    def structure(self, outside: bytes) -> bytes:
+        ''' Text of json values without their strings, whitespace and numbers, as compared to find runs: the strings are
+            empty, each number is a single 0, e.g., {"":"","":[0,0,0]} for {"type": "sphere", "position": [1.5, -2, 3e4]}
+        Args:
+            outside (bytes): the text with its strings emptied
+        '''
+        marked = np.frombuffer(outside.translate(self.number_marks, b" \t\n\r"), dtype=np.uint8)
+        digits = marked == ord("0")
+        keep = np.ones(len(marked), dtype=bool)
+        keep[1:] = ~(digits[1:] & digits[:-1])
+        return marked[keep].tobytes()
+
+    def template(self, like, start: int, variable_keys) -> tuple:
+        ''' Structure of the runs that may follow the element decoded from start to the current position (see read_run),
+            or None if its members are not numbers, strings, or lists of either
+        '''
+        if not isinstance(like, dict):
+            return None
+        layout = []
+        strings = [] # strings of each element, None for those of the variable keys
+        for key, value in like.items():
+            strings.append(key)
+            if is_json_number(value):
+                layout.append((key, "number", 1))
+            elif isinstance(value, str):
+                layout.append((key, "string", 1))
+                strings.append(value)
+            elif isinstance(value, list) and all(is_json_number(v) for v in value):
+                layout.append((key, "numbers", len(value)))
+            elif isinstance(value, list) and key in variable_keys and all(isinstance(v, str) for v in value):
+                layout.append((key, "strings", len(value)))
+                strings += [None] * len(value)
+            else:
+                return None
+        text = self.text[start:self.pos].encode()
+        parts = text.split(b'"')
+        if b"\\" in text or len(parts) != 2 * len(strings) + 1:
+            return None  # escaped characters, the strings of the text would not be those of like
+        constants = [(i, raw) for i, (raw, string) in enumerate(zip(parts[1::2], strings)) if string is not None]
+        variables = [i for i, string in enumerate(strings) if string is None]
+        nb_values = sum(length for _, kind, length in layout if kind.startswith("number"))
+        return layout, b"," + self.structure(b'""'.join(parts[0::2])), len(strings), constants, variables, nb_values
+
+    def read_run(self, like: dict, template: tuple, end: int) -> JsonRun:
+        ''' Read the elements of the text from the current position to end as a JsonRun, if they all have the structure of
+            the template (see template), or return None without reading them
+
+            The numbers are read by numpy, which is more lenient than json: numbers that json5 reads too (e.g., +1, .5)
+            are read as the json5 fallback would, numbers with leading zeros (e.g., 01) are read as decimals.
+        '''
+        layout, structure, nb_strings, constants, variables, nb_values = template
+        text = self.text[self.pos:end].encode()
+        parts = text.split(b'"')
+        outside = b'""'.join(parts[0::2])
+        text_structure = self.structure(outside)
+        n = len(text_structure) // len(structure)
+        if n == 0 or b"\\" in text or len(parts) != 2 * n * nb_strings + 1 or text_structure != structure * n:
+            return None
+        strings = np.array(parts[1::2], dtype=object).reshape(n, nb_strings)
+        if any((strings[:, i] != raw).any() for i, raw in constants):
+            return None
+        try:
+            # the structure has no numbers when there are none, numpy would read the blank text as [-1.0]
+            values = np.fromstring(outside.translate(self.punctuation), sep=" ") if nb_values > 0 else np.zeros(0)
+        except ValueError:
+            return None  # not a number, e.g., 1-2
+        if values.size != n * nb_values:
+            return None
+        self.pos = end
+        return JsonRun(like, layout, values.reshape(n, nb_values), strings[:, variables])
+
+def read_scene_json(text: str) -> (dict, object):
+    ''' Decode a strict json scene, streaming its objects
+    Args:
+        text (str): content of the scene file
+    Returns:
+        (dict, iterable): the members of the scene other than objects, and its objects
+
+        When the objects come after the materials, as in all the scene files, they are decoded one at a time as
+        they are iterated, so that the objects of a large scene are never all held as dictionaries.  The spheres,
+        planes and boxes at the root of the scene that follow one like them are given as a JsonRun instead (see
+        root_run_keys).  The members after the objects are only in the dictionary once they have all been iterated.
+        A json.JSONDecodeError is raised, possibly while iterating, if the text is not strict json.
+    '''
+    stream = JsonStream(text)
+    data = {}
+    keys = stream.keys()
+    for key in keys:
+        if key == "objects" and "materials" in data:
+            def objects():
+                yield from stream.elements(root_run_keys)
+                for key in keys:
+                    data[key] = stream.value()
+                stream.end()
+            return data, objects()
+        data[key] = stream.value()
+    stream.end()
+    return data, data.pop("objects")
+
+def root_run_keys(geometry) -> tuple:
+    ''' Keys whose strings may differ in a JsonRun of the objects that follow a sphere, plane or box added by LoadContext.add_row '''
+    if isinstance(geometry, dict) and geometry.get("type") in ROW_MEMBERS and "name" not in geometry:
+        return ("materials",)
+    return None
+
+def read_json(infile: str) -> dict:
+    ''' Read a json file with the C decoder of the json module, or with json5 if it is not strict json '''
+    with open(infile) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json5.loads(text)
+
+def load_objects(data: dict, scene_objects, cache: meshcache.MeshCache) -> "LoadContext":
+    ''' Load the materials and the geometry of a scene
+    Args:
+        data (dict): the scene, whose materials are read
+        scene_objects (iterable): the objects at the root of the scene
+        cache (meshcache.MeshCache): cache to load the mesh files from, or None to always parse them
+    Returns:
+        LoadContext: the loaded primitives, see LoadContext.columns
+    '''
+    context = LoadContext(data["materials"], cache)
+
+    M_parent = np.eye(4)  # identity matrix as the initial parent transformation
+
+    for geometry in scene_objects:
+        if isinstance(geometry, JsonRun):
+            context.add_run(geometry)
+        elif geometry["type"] in ROW_MEMBERS and "name" not in geometry:
+            context.add_row(geometry)
+        elif geometry["type"] == "node":
+            g = context.load_node(geometry, M_parent)
             for obj_type, obj in g:
-                objects[obj_type].append(obj)
+                context.add(obj_type, obj)
         elif geometry["type"] == "instance":
-            g = load_instance(geometry, node_by_name)
+            g = context.load_instance(geometry)
             for obj_type, obj in g:
-                objects[obj_type].append(obj)
+                context.add(obj_type, obj)
         else:
-            g = load_geometry(geometry, material_by_name, M_parent)
+            g = context.load_geometry(geometry, M_parent)
             if g is not None:
-                objects[geometry["type"]].append(g)
+                context.add(geometry["type"], g)
                 # check if "name" field exists
                 if "name" in geometry:
-                    node_by_name[geometry["name"]] = g
-
-    print("Loaded", geom_id + 1, "geometric objects")
-
-    # Taichi does not accept a zero-length field, so we create a field of size 1 if the list is empty.
-    # This means we need to keep track of the actual number of objects separately.
-    nb_spheres = len(objects["sphere"])
-    spheres = geom.Sphere.field(shape=max(1, nb_spheres))
-    for i in range(len(objects["sphere"])):
-        spheres[i] = objects["sphere"][i]
-
-    nb_planes = len(objects["plane"])
-    planes = geom.Plane.field(shape=max(1, nb_planes))
-    for i in range(len(objects["plane"])):
-        planes[i] = objects["plane"][i]
+                    context.node_by_name[geometry["name"]] = [(geometry["type"], g)]
+    return context
 
-    nb_boxes = len(objects["box"])
-    boxes = geom.AABox.field(shape=max(1, nb_boxes))
-    for i in range(len(objects["box"])):
-        boxes[i] = objects["box"][i]
+def record_columns(records: list) -> dict:
+    ''' Numpy columns of a list of primitives given as dictionaries of the members of their Taichi dataclass '''
+    return {key: np.array([record[key] for record in records]) for key in records[0]}
 
-    nb_meshes = len(objects["mesh"])
-    meshes = geom.Mesh.field(shape=max(1, nb_meshes))
-    for i in range(len(objects["mesh"])):
-        meshes[i] = objects["mesh"][i]
+def primitive_columns(records: list, materials: dict = None) -> dict:
+    ''' Struct-of-arrays numpy columns of a list of primitives, as packed in ndarrays by records.pack
+    Args:
+        records (list): primitives as dictionaries of the members of their Taichi dataclass
+        materials (dict): numpy columns of the material table, to expand the material indices
+    Returns:
+        dict: one numpy array per member, with nested dictionaries for the materials
+    '''
+    return concatenate_columns([record_columns(records)] if len(records) > 0 else [], materials)
 
-    return scene.Scene( jitter, samples,  # General settings
-                camera,  # Camera settings
-                ambient, lights, nb_lights,  # Light settings
-                spheres, nb_spheres,
-                planes, nb_planes,
-                boxes, nb_boxes,
-                meshes, nb_meshes, scene_meshes_verts, scene_meshes_faces)  # Geometry settings
+def concatenate_columns(blocks: list, materials: dict = None) -> dict:
+    ''' Struct-of-arrays numpy columns of blocks of primitives, as returned by record_columns, see primitive_columns '''
+    columns = {}
+    if len(blocks) == 0:
+        return columns
+    for key in blocks[0]:
+        column = np.concatenate([block[key] for block in blocks]) if len(blocks) > 1 else blocks[0][key]
+        # the render kernel uses 32 bit types, converting here avoids a lossy conversion when they are packed
+        if np.issubdtype(column.dtype, np.floating):
+            column = column.astype(np.float32, copy=False)
+        elif np.issubdtype(column.dtype, np.integer):
+            column = column.astype(np.int32, copy=False)
+        if key.startswith("material"):
+            column = {member: values[column] for member, values in materials.items()}
+        columns[key] = column
+    return columns
 
-def mat4_glm_to_ti( M_glm: glm.mat4 ) -> tm.mat4:
-    return tm.mat4( glm.transpose(M_glm).to_list() )
+def mat4_glm_to_np( M_glm: glm.mat4 ) -> np.ndarray:
+    return np.array( glm.transpose(M_glm).to_list() )
 
-def load_geometry_transformation_matrix(geometry, M_parent: tm.mat4) -> (tm.mat4, tm.mat4):
+def load_geometry_transformation_matrix(geometry, M_parent: np.ndarray) -> (np.ndarray, np.ndarray):
     g_pos = glm.vec3(geometry.get("position", [0, 0, 0]))
     g_r = glm.vec3(geometry.get("rotation", [0, 0, 0]))  # not really useful for a sphere...
     g_s = geometry.get("scale", [1, 1, 1])
@@ -161,98 +455,299 @@ def load_geometry_transformation_matrix(geometry, M_parent: tm.mat4) -> (tm.mat4
     rot_y = glm.rotate( glm.radians(g_r.y), glm.vec3(0,1,0) )
     rot_z = glm.rotate( glm.radians(g_r.z), glm.vec3(0,0,1) )
     translate = glm.translate( g_pos )
-    M_parent_glm = glm.mat4( M_parent.to_numpy() )
+    M_parent_glm = glm.mat4( M_parent )
     M = M_parent_glm * translate * rot_x * rot_y * rot_z * scale
     M_inv = glm.inverse(M)
-    return mat4_glm_to_ti(M), mat4_glm_to_ti(M_inv)
-
-def load_geometry(geometry, material_by_name, M_parent: tm.mat4 ):
-    global geom_id, meshes_total_nb_verts, meshes_total_nb_faces, scene_meshes_verts, scene_meshes_faces
-
-    # Elements common to all objects: name, type, and material(s)
-    g_type = geometry["type"]
-    g_materials = [ material_by_name[material_name] for material_name in geometry.get("materials",[]) ]
-
-    geom_id += 1
-
-    if g_type == "sphere":
-        g_radius = geometry.get("radius",1)
-        M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
-        return geom.Sphere(geom_id, g_materials[0], g_radius, M, M_inv)
-    elif g_type == "plane":
-        g_normal = tm.vec3(geometry.get("normal",[0,1,0]))
-        M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
-        two_materials = True if len(g_materials) > 1 else False
-        mat1 = g_materials[0]
-        mat2 = g_materials[1] if two_materials else g_materials[0]
-        return geom.Plane(geom_id, two_materials, mat1, mat2, g_normal, M, M_inv)
-    elif g_type == "box":
-        minpos = tm.vec3(geometry.get("min",[-1,-1,-1]))
-        maxpos = tm.vec3(geometry.get("max",[1,1,1]))
-        M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
-        return geom.AABox(geom_id, g_materials[0], minpos, maxpos, M, M_inv)
-    elif g_type == "mesh":
-        g_path = geometry["filepath"]
-        M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
-        mesh = trimesh.load_mesh(g_path)
-        verts = mesh.vertices
-        faces = mesh.faces
-
-        scene_meshes_verts = np.resize(scene_meshes_verts, (meshes_total_nb_verts + len(verts), 3))
-        scene_meshes_faces = np.resize(scene_meshes_faces, (meshes_total_nb_faces + len(faces), 3))
-        # NOTE: These should really be vectorized!
-        for i in range(len(verts)):
-            scene_meshes_verts[meshes_total_nb_verts + i] = np.array((verts[i, 0], verts[i, 1], verts[i, 2]))
-        for i in range(len(faces)):
-            scene_meshes_faces[meshes_total_nb_faces + i] = np.array((faces[i, 0] + meshes_total_nb_verts,
-                                                                      faces[i, 1] + meshes_total_nb_verts,
-                                                                      faces[i, 2] + meshes_total_nb_verts))
-        # NOTE: an opportunity to transform the verts of the mesh rather than transforming the ray later
-        mesh = geom.Mesh(geom_id, g_materials[0], meshes_total_nb_faces, len(faces), M, M_inv)
-        meshes_total_nb_verts += len(verts)
-        meshes_total_nb_faces += len(faces)
-        return mesh
-    else:
-        print("Unkown object type", g_type, ", skipping initialization")
-        geom_id -= 1  # we cancel the increment of geom_id since we didn't create any geometry
-        return None
-    
-def load_node(geometry, material_by_name, node_by_name, M_parent: tm.mat4 ):
-    M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)    
-    # For this node, keep a list of all the childern objects
-    objects = []
-    node_by_name[geometry["name"]] = []
-    
-    for child in geometry["children"]:
-        if child["type"] != "node" and child["type"] != "instance":
-            g = load_geometry(child, material_by_name, M)
-            objects.append((child["type"], g))  # each geometry is stored as a tuple (type, object)
-            node_by_name[geometry["name"]] += objects
-        elif child["type"] == "node":
-            objects += load_node(child, material_by_name, node_by_name, M)
-            node_by_name[geometry["name"]] += objects
-        elif child["type"] == "instance":
-            print("Instances are not allowed inside nodes, must be defined at root level")
+    return mat4_glm_to_np(M), mat4_glm_to_np(M_inv)
+
+def transformation_matrices(positions: np.ndarray, rotations: np.ndarray, scales: np.ndarray) -> (np.ndarray, np.ndarray):
+    ''' Transformation matrices of objects at the root of the scene, as load_geometry_transformation_matrix for all at once
+    Args:
+        positions (np.ndarray): (N, 3) translations
+        rotations (np.ndarray): (N, 3) rotations around x, y and z in degrees, applied in the order z, y, x
+        scales (np.ndarray): (N, 3) scale factors
+    Returns:
+        (np.ndarray, np.ndarray): (N, 4, 4) matrices M and their inverses M_inv
+    '''
+    c, s = np.cos(np.radians(rotations)), np.sin(np.radians(rotations))
+    zero, one = np.zeros(len(positions)), np.ones(len(positions))
+    rot_x = np.stack([one, zero, zero, zero, c[:, 0], -s[:, 0], zero, s[:, 0], c[:, 0]], axis=1).reshape(-1, 3, 3)
+    rot_y = np.stack([c[:, 1], zero, s[:, 1], zero, one, zero, -s[:, 1], zero, c[:, 1]], axis=1).reshape(-1, 3, 3)
+    rot_z = np.stack([c[:, 2], -s[:, 2], zero, s[:, 2], c[:, 2], zero, zero, zero, one], axis=1).reshape(-1, 3, 3)
+    rotation = rot_x @ rot_y @ rot_z
+    M = np.zeros((len(positions), 4, 4))
+    M[:, :3, :3] = rotation * scales[:, None, :]
+    M[:, :3, 3] = positions
+    M[:, 3, 3] = 1
+    # the inverse of translate * rotate * scale is scale^-1 * rotate^T * translate^-1
+    M_inv = np.zeros_like(M)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        M_inv[:, :3, :3] = rotation.transpose(0, 2, 1) / scales[:, :, None]
+    M_inv[:, :3, 3] = -np.einsum("nij,nj->ni", M_inv[:, :3, :3], positions)
+    M_inv[:, 3, 3] = 1
+    return M, M_inv
+
+class LoadContext:
+    ''' State of the loading of one scene: geometry ids, the primitives and mesh arrays of the scene, and the
+        names of its nodes, materials and mesh files
+
+        A context is created by each call of load_scene, so scenes can be loaded one after the other, or
+        from several threads at once, without any geometry of one leaking into the next.
+    Args:
+        scene_materials (list): materials of the scene json
+        mesh_cache (meshcache.MeshCache): cache to load the mesh files from, or None to always parse them
+    '''
+    def __init__(self, scene_materials: list, mesh_cache: meshcache.MeshCache = None):
+        # Loading materials, as a table of numpy columns indexed by material id
+        self.material_by_name = {} # material id by name
+        for material in scene_materials:
+            self.material_by_name[material["name"]] = len(self.material_by_name)
+        self.materials = {"id": np.arange(len(scene_materials), dtype=np.int32),
+                          "diffuse": np.array([material["diffuse"] for material in scene_materials], dtype=np.float32).reshape(-1, 3),
+                          "specular": np.array([material["specular"] for material in scene_materials], dtype=np.float32).reshape(-1, 3),
+                          "shininess": np.repeat(np.array([material.get("shininess", 0) for material in scene_materials],
+                                                          dtype=np.float32)[:, None], 3, axis=1)}
+        self.mesh_cache = mesh_cache
+        # primitives of each type, in the order in which they are loaded: blocks of numpy columns, followed by either
+        # records or rows that are not yet in a block
+        self.blocks = {"sphere": [], "plane": [], "box": [], "mesh": []}
+        self.records = {"sphere": [], "plane": [], "box": [], "mesh": []}
+        self.rows = {"sphere": [], "plane": [], "box": []}
+        self.geom_id = -1  # geometry ID counter
+        self.meshes_total_nb_verts = 0  # total number of mesh vertices in the scene
+        self.meshes_total_nb_faces = 0  # total number of mesh faces in the scene
+        self.meshes_total_nb_bvh_nodes = 0  # total number of mesh BVH nodes in the scene
+        # per-mesh arrays, concatenated once all the geometry is loaded
+        self.scene_meshes_verts = []
+        self.scene_meshes_faces = []
+        self.scene_meshes_bvh = []  # BVH nodes of each mesh
+        self.mesh_asset_by_path = {}  # faces and BVH ranges of each mesh file already loaded, shared by all its instances
+        self.node_by_name = {}  # dictionary of geometries by name (for instances)
+
+    def add(self, g_type: str, record: dict):
+        ''' Add a primitive loaded as a record, by load_geometry, load_node or load_instance '''
+        self.flush_rows(g_type)
+        self.records[g_type].append(record)
+
+    def add_row(self, geometry):
+        ''' Add a sphere, plane or box at the root of the scene, as load_geometry would load it, but as a row of
+            values whose matrices are computed with those of the next rows (see flush_rows)
+        '''
+        g_type = geometry["type"]
+        if self.records[g_type]:
+            self.flush_records(g_type)
+        g_materials = [ self.material_by_name[material_name] for material_name in geometry.get("materials",[]) ]
+        self.geom_id += 1
+        if g_type == "sphere":
+            values = (self.geom_id, g_materials[0], geometry.get("radius",1))
+        elif g_type == "plane":
+            two_materials = len(g_materials) > 1
+            values = (self.geom_id, two_materials, g_materials[0], g_materials[1] if two_materials else g_materials[0],
+                      geometry.get("normal",[0,1,0]))
+        else:
+            values = (self.geom_id, g_materials[0], geometry.get("min",[-1,-1,-1]), geometry.get("max",[1,1,1]))
+        g_s = geometry.get("scale", [1, 1, 1])
+        if type(g_s) == float or type(g_s) == int:
+            g_s = [g_s, g_s, g_s]
+        rows = self.rows[g_type]
+        rows.append(values + (geometry.get("position", [0, 0, 0]), geometry.get("rotation", [0, 0, 0]), g_s))
+        if len(rows) >= ROW_BLOCK:
+            self.flush_rows(g_type)
+
+    def add_run(self, run: JsonRun):
+        ''' Add the spheres, planes or boxes of a run of objects like the last one added by add_row, as add_row would add
+            each of them, but from the numpy arrays of the run (see JsonStream.elements)
+        '''
+        g_type = run.like["type"]
+        self.flush_rows(g_type)  # the rows before the run, the object it follows included
+        members = run.members()
+        n = len(run.values)
+        def member(key: str, default: list) -> np.ndarray:
+            return members[key] if key in members else np.tile(default, (n, 1))
+        names = members.get("materials", np.zeros((n, 0), dtype=object))
+        g_materials = np.array([self.material_by_name[name.decode()] for name in names.ravel()], dtype=np.int64).reshape(names.shape)
+        ids = np.arange(self.geom_id + 1, self.geom_id + 1 + n)
+        self.geom_id += n
+        if g_type == "sphere":
+            values = (ids, g_materials[:, 0], members.get("radius", np.ones(n)))
+        elif g_type == "plane":
+            two_materials = g_materials.shape[1] > 1
+            values = (ids, np.full(n, two_materials), g_materials[:, 0], g_materials[:, 1 if two_materials else 0],
+                      member("normal", [0, 1, 0]))
         else:
-            print("Unkown object type", child["type"], ", skipping initialization")
-
-    return objects
-
-def load_instance(geometry, node_by_name):
-    # instances are loaded off the root, so will have an identiy matrix as parent
-    M, M_inv = load_geometry_transformation_matrix(geometry, tm.mat4( np.eye(4) ) ) 
-    objects = []
-    node = node_by_name[geometry["ref"]]
-    for obj_type, obj in node:
-        if obj is not None:
-            if obj_type == "sphere":
-                new_obj = geom.Sphere(obj.id, obj.material, obj.position, obj.radius, M @ obj.M, obj.M_inv @ M_inv )                                      
-            elif obj_type == "plane":
-                new_obj = geom.Plane(obj.id, obj.two_materials, obj.material1, obj.material2, obj.position, obj.normal, M @ obj.M, obj.M_inv @ M_inv )            
-            elif obj_type == "box":
-                new_obj = geom.AABox(obj.id, obj.material, obj.minpos, obj.maxpos, M @ obj.M, obj.M_inv @ M_inv )  
-            elif obj_type == "mesh":
-                new_obj = geom.Mesh(obj.id, obj.material, obj.vert_start, obj.nb_verts, obj.face_start, obj.nb_faces,  M @ obj.M, obj.M_inv @ M_inv )                          
-            objects.append((obj_type, new_obj))
-
-    return objects
\ No newline at end of file
+            values = (ids, g_materials[:, 0], member("min", [-1, -1, -1]), member("max", [1, 1, 1]))
+        g_s = member("scale", [1, 1, 1]).reshape(n, -1) * np.ones(3)  # a single number scales the 3 axes
+        self.add_block(g_type, values + (member("position", [0, 0, 0]), member("rotation", [0, 0, 0]), g_s))
+
+    def flush_rows(self, g_type: str):
+        rows = self.rows.get(g_type)
+        if not rows:
+            return
+        self.add_block(g_type, [np.array(column) for column in zip(*rows)])
+        self.rows[g_type] = []
+
+    def add_block(self, g_type: str, columns: list):
+        ''' Add primitives given as numpy columns of their ROW_MEMBERS, followed by their positions, rotations and scales '''
+        block = dict(zip(ROW_MEMBERS[g_type], columns))
+        for key in ROW_FLOATS[g_type]:
+            block[key] = np.asarray(block[key], dtype=np.float32)
+        M, M_inv = transformation_matrices(*(np.asarray(column, dtype=np.float64).reshape(-1, 3) for column in columns[-3:]))
+        block["M"], block["M_inv"] = M.astype(np.float32), M_inv.astype(np.float32)  # the precision of the render kernel, half the memory
+        self.blocks[g_type].append(block)
+
+    def flush_records(self, g_type: str):
+        if len(self.records[g_type]) == 0:
+            return
+        self.blocks[g_type].append(record_columns(self.records[g_type]))
+        self.records[g_type] = []
+
+    def columns(self, g_type: str) -> (dict, int):
+        ''' Numpy columns of the primitives of a type, with their materials expanded (see primitive_columns), and their number '''
+        self.flush_rows(g_type)
+        self.flush_records(g_type)
+        blocks = self.blocks[g_type]
+        return concatenate_columns(blocks, self.materials), sum(len(block["id"]) for block in blocks)
+
+    def mesh_arrays(self) -> (np.ndarray, np.ndarray, dict):
+        ''' Vertices, faces and BVH nodes of all the meshes of the scene, as uploaded by the Scene '''
+        meshes_verts = np.concatenate([np.empty((0, 3), dtype=np.float32)] + self.scene_meshes_verts)
+        meshes_faces = np.concatenate([np.empty((0, 3), dtype=np.int32)] + self.scene_meshes_faces)
+        meshes_bvh = {key: np.concatenate([value[:0]] + [nodes[key] for nodes in self.scene_meshes_bvh])
+                      for key, value in bvh.empty_bvh().items()}
+        return meshes_verts, meshes_faces, meshes_bvh
+
+    def load_geometry(self, geometry, M_parent: np.ndarray ):
+        # Elements common to all objects: name, type, and material(s)
+        g_type = geometry["type"]
+        g_materials = [ self.material_by_name[material_name] for material_name in geometry.get("materials",[]) ]
+
+        self.geom_id += 1
+
+        if g_type == "sphere":
+            g_radius = geometry.get("radius",1)
+            M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
+            return {"id": self.geom_id, "material": g_materials[0], "radius": g_radius, "M": M, "M_inv": M_inv}
+        elif g_type == "plane":
+            g_normal = geometry.get("normal",[0,1,0])
+            M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
+            two_materials = True if len(g_materials) > 1 else False
+            mat1 = g_materials[0]
+            mat2 = g_materials[1] if two_materials else g_materials[0]
+            return {"id": self.geom_id, "two_materials": two_materials, "material1": mat1, "material2": mat2,
+                    "normal": g_normal, "M": M, "M_inv": M_inv}
+        elif g_type == "box":
+            minpos = geometry.get("min",[-1,-1,-1])
+            maxpos = geometry.get("max",[1,1,1])
+            M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
+            return {"id": self.geom_id, "material": g_materials[0], "minpos": minpos, "maxpos": maxpos, "M": M, "M_inv": M_inv}
+        elif g_type == "mesh":
+            g_path = geometry["filepath"]
+            M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)
+            # all the meshes loaded from the same file share the same vertices, faces and BVH (bottom level),
+            # only their transformation differs and they each get an entry in the scene BVH (top level)
+            asset_key = os.path.realpath(g_path)
+            if asset_key in self.mesh_asset_by_path:
+                return dict(self.mesh_asset_by_path[asset_key], id=self.geom_id, material=g_materials[0], M=M, M_inv=M_inv)
+            # faces are stored in the order in which the leaves of the mesh BVH reference them
+            if self.mesh_cache is not None:
+                verts, faces, mesh_bvh = self.mesh_cache.load(g_path)
+            else:
+                verts, faces, mesh_bvh = meshcache.parse_mesh(g_path)
+            bvh_start = self.meshes_total_nb_bvh_nodes
+            leaves = mesh_bvh["count"] > 0
+            mesh_bvh = dict(mesh_bvh, left_first=mesh_bvh["left_first"] + np.where(leaves, self.meshes_total_nb_faces, bvh_start).astype(np.int32))
+
+            # vertex indices are offset to index the global vertex array
+            self.scene_meshes_verts.append(verts)
+            self.scene_meshes_faces.append((faces + self.meshes_total_nb_verts).astype(np.int32))
+            self.scene_meshes_bvh.append(mesh_bvh)
+            # NOTE: an opportunity to transform the verts of the mesh rather than transforming the ray later
+            self.mesh_asset_by_path[asset_key] = {"faces_ids_start": self.meshes_total_nb_faces, "faces_ids_count": len(faces),
+                                                  "bvh_start": bvh_start, "bvh_count": len(mesh_bvh["count"])}
+            mesh = dict(self.mesh_asset_by_path[asset_key], id=self.geom_id, material=g_materials[0], M=M, M_inv=M_inv)
+            self.meshes_total_nb_verts += len(verts)
+            self.meshes_total_nb_faces += len(faces)
+            self.meshes_total_nb_bvh_nodes += len(mesh_bvh["count"])
+            return mesh
+        else:
+            print("Unkown object type", g_type, ", skipping initialization")
+            self.geom_id -= 1  # we cancel the increment of geom_id since we didn't create any geometry
+            return None
+
+    def load_node(self, geometry, M_parent: np.ndarray ):
+        M, M_inv = load_geometry_transformation_matrix(geometry, M_parent)    
+        # For this node, keep a list of all the childern objects
+        objects = []
+
+        for child in geometry["children"]:
+            if child["type"] != "node" and child["type"] != "instance":
+                g = self.load_geometry(child, M)
+                objects.append((child["type"], g))  # each geometry is stored as a tuple (type, object)
+            elif child["type"] == "node":
+                objects += self.load_node(child, M)
+            elif child["type"] == "instance":
+                print("Instances are not allowed inside nodes, must be defined at root level")
+            else:
+                print("Unkown object type", child["type"], ", skipping initialization")
+
+        self.node_by_name[geometry["name"]] = objects
+        return objects
+
+    def load_instance(self, geometry):
+        # instances are loaded off the root, so will have an identiy matrix as parent
+        M, M_inv = load_geometry_transformation_matrix(geometry, np.eye(4) ) 
+        objects = []
+        node = self.node_by_name[geometry["ref"]]
+        for obj_type, obj in node:
+            if obj is not None:
+                # only the transformation differs, instanced meshes share the faces and BVH of the original
+                new_obj = dict(obj, M=M @ obj["M"], M_inv=obj["M_inv"] @ M_inv)
+                objects.append((obj_type, new_obj))
+
+        return objects
+
+def estimate_cost(infile: str, image_scale_factor: float = 1.0) -> float:
+    ''' Rough relative cost of rendering a scene, from its json file only (meshes are not loaded)
+    Args:
+        infile (str): path to the scene json file
+        image_scale_factor (float): scale factor for image resolution
+    Returns:
+        float: rays traced (pixels x samples x (1 + lights), for the camera and shadow rays) times the
+        intersection tests per ray (all the planes, and the depth of the BVH over the other primitives
+        and of the BVH of each mesh, whose number of faces is guessed from the size of its file)
+
+        Only the order of the costs matters, e.g., to render the longest scenes of a batch first.
+    '''
+    if bundle.is_bundle(infile):
+        return bundle.estimate_cost(infile, image_scale_factor)
+    data = read_json(infile)
+    width, height = data.get("resolution", [1280, 720])
+    pixels = int(image_scale_factor * width) * int(image_scale_factor * height)
+    samples = max(1, data.get("AA_samples", 1))
+    rays = pixels * samples * (1 + len(data.get("lights", [])))
+
+    counts = {"plane": 0, "bounded": 0, "mesh_depth": 0.0}
+    count_by_name = {}  # counts of the named nodes, for their instances
+    def count(geometry) -> dict:
+        c = {"plane": 0, "bounded": 0, "mesh_depth": 0.0}
+        if geometry["type"] == "node":
+            for child in geometry.get("children", []):
+                for key, value in count(child).items():
+                    c[key] += value
+        elif geometry["type"] == "instance":
+            c = dict(count_by_name.get(geometry.get("ref"), c))
+        elif geometry["type"] == "plane":
+            c["plane"] = 1
+        elif geometry["type"] in ("sphere", "box", "mesh"):
+            c["bounded"] = 1
+            if geometry["type"] == "mesh":
+                path = geometry.get("filepath", "")
+                nb_faces = os.path.getsize(path) / 50 if os.path.exists(path) else 1  # about 50 bytes per face in an obj file
+                c["mesh_depth"] = np.log2(2 + nb_faces)
+        if "name" in geometry and geometry["type"] != "instance":
+            count_by_name[geometry["name"]] = c
+        return c
+    for geometry in data.get("objects", []):
+        for key, value in count(geometry).items():
+            counts[key] += value
+    return rays * (counts["plane"] + np.log2(2 + counts["bounded"]) + counts["mesh_depth"])
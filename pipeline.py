@@ -0,0 +1,67 @@
+import multiprocessing
+import queue
+import time
+import traceback
+
+# The render kernels hold the GIL while they run, so scenes are parsed ahead in another process rather than a
+# thread.  Scenes are plain numpy columns until they are uploaded to Taichi ndarrays (see Scene.bind), so they are
+# sent back to the renderer as they are, and the loader process never starts a Taichi runtime.
+
+def load_scenes(scene_file_names: list, image_scale_factor: float, mesh_cache_dir: str, scenes: multiprocessing.Queue):
+    ''' Load the scenes one after the other into a queue, until it is full '''
+    import parser  # imported here so that the mesh cache is set in the loader process
+    import meshcache
+    if mesh_cache_dir is not None:
+        parser.mesh_cache = meshcache.MeshCache(mesh_cache_dir)
+    for scene_file_name in scene_file_names:
+        try:
+            start = time.perf_counter()
+            loaded = parser.load_scene(scene_file_name, image_scale_factor=image_scale_factor)
+            scenes.put((scene_file_name, loaded, time.perf_counter() - start))
+        except Exception:
+            scenes.put((scene_file_name, None, traceback.format_exc()))
+            return
+    if parser.mesh_cache is not None:
+        parser.mesh_cache.report()
+
+class SceneLoader:
+    ''' Iterate over the scenes of a batch, loaded by a background process while the previous ones render
+    Args:
+        scene_file_names (list): json files of the scenes, in the order in which they are rendered
+        image_scale_factor (float): scale factor for image resolution
+        mesh_cache_dir (str): directory of the mesh cache, or None to always parse mesh files
+        depth (int): number of scenes loaded ahead of the one being rendered
+
+        Every scene is rendered by the same kernel (see scene.render_tiles), so the scenes can come in any
+        order and of any size without compiling it again, and each scene is only uploaded when it is first
+        rendered.
+    '''
+    def __init__(self, scene_file_names: list, image_scale_factor: float, mesh_cache_dir: str, depth: int = 1):
+        self.scene_file_names = scene_file_names
+        context = multiprocessing.get_context("spawn")
+        self.scenes = context.Queue(maxsize=max(1, depth))
+        self.process = context.Process(target=load_scenes, daemon=True,
+                                       args=(scene_file_names, image_scale_factor, mesh_cache_dir, self.scenes))
+        self.process.start()
+
+    def __iter__(self):
+        for _ in self.scene_file_names:
+            start = time.perf_counter()
+            while True:
+                try:
+                    scene_file_name, loaded, load_sec = self.scenes.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    if not self.process.is_alive():
+                        raise RuntimeError("the scene loader process exited before loading all the scenes")
+            if loaded is None:
+                raise RuntimeError(f"could not load {scene_file_name}:\n{load_sec}")
+            # the render waits for the loader when it is slower than the render of the previous scene
+            print(f"pipeline name={scene_file_name} load_sec={load_sec:.2f} wait_sec={time.perf_counter() - start:.2f}", flush=True)
+            yield scene_file_name, loaded
+
+    def close(self):
+        ''' Stop loading, when the batch ends early '''
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
@@ -0,0 +1,63 @@
+import sys
+import threading
+import time
+
+class ProgressReporter:
+    ''' Report the progress of a render (pixels/sec and ETA) from a background thread
+
+        The render kernels count the pixels they finish in the Scene.progress counter (once per
+        sample), and the host publishes that count with update() between launches, which
+        Scene.render_samples_in_chunks keeps about one interval apart.  The Taichi
+        runtime can only be used from the main thread, so the reporter thread never reads the
+        counter itself, it only formats the last published count at a fixed interval.
+
+        Each report is a single line of key=value pairs, e.g.,
+        progress name=Sphere pixels=179200/358400 pixels_per_sec=616448.0 eta_sec=0.3
+    '''
+    def __init__(self, name: str, total_pixels: int, interval: float = 1.0, stream=sys.stdout, initial_pixels: int = 0):
+        self.name = name
+        self.total_pixels = total_pixels
+        self.interval = interval  # seconds between two reports
+        self.stream = stream
+        self.initial_pixels = initial_pixels  # pixels already rendered when started, e.g., by a resumed render
+        self.pixels = initial_pixels
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop the reporter thread and write the final report '''
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report()
+
+    def update(self, pixels: int):
+        ''' Publish the number of pixels rendered so far (as read from Scene.progress) '''
+        with self.lock:
+            self.pixels = pixels
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        with self.lock:
+            pixels = self.pixels
+        elapsed = time.perf_counter() - self.start_time
+        pixels_per_sec = (pixels - self.initial_pixels) / elapsed if elapsed > 0 else 0.0
+        eta = (self.total_pixels - pixels) / pixels_per_sec if pixels_per_sec > 0 else float('inf')
+        print(f"progress name={self.name} pixels={pixels}/{self.total_pixels} "
+              f"pixels_per_sec={pixels_per_sec:.1f} eta_sec={eta:.1f}", file=self.stream, flush=True)
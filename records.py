@@ -0,0 +1,89 @@
+import numpy as np
+
+import taichi as ti
+from taichi.lang.matrix import MatrixType
+from taichi.lang.struct import StructType
+
+# Ndarrays can not hold Taichi dataclasses, so the primitives given to the render kernels as ndarrays are packed in
+# rows of float32 values, one per element, with the members of their dataclass in order (nested dataclasses such as
+# the materials inline) and the integers and booleans bit cast to float32.  The kernels read them back with the
+# function returned by reader.
+
+def row_size(dtype) -> int:
+    ''' Number of float32 values of a row of the given Taichi type '''
+    if isinstance(dtype, StructType):
+        return sum(row_size(member) for member in dtype.members.values())
+    if isinstance(dtype, MatrixType):
+        return dtype.n * dtype.m if dtype.ndim == 2 else dtype.n
+    return 1
+
+def is_float(dtype) -> bool:
+    return (dtype.dtype if isinstance(dtype, MatrixType) else dtype) in (ti.f32, ti.f64)
+
+def pack(columns: dict, dtype, nb: int) -> np.ndarray:
+    ''' Rows of the first nb elements of numpy columns (see parser.primitive_columns)
+    Args:
+        columns (dict): one numpy array per member of the dataclass, with nested dictionaries for nested dataclasses
+        dtype (StructType): Taichi dataclass of the elements
+        nb (int): number of elements, the columns may be longer
+    Returns:
+        np.ndarray: (max(1, nb), row_size(dtype)) float32 rows, a single row of zeros when there are no elements
+            since ndarrays can not be empty
+    '''
+    rows = np.zeros((max(1, nb), row_size(dtype)), dtype=np.float32)
+    if nb > 0:
+        pack_members(columns, dtype, nb, rows, 0)
+    return rows
+
+def pack_members(columns: dict, dtype: StructType, nb: int, rows: np.ndarray, offset: int) -> int:
+    for name, member in dtype.members.items():
+        if isinstance(member, StructType):
+            offset = pack_members(columns[name], member, nb, rows, offset)
+            continue
+        values = np.asarray(columns[name][:nb]).reshape(nb, -1)
+        if is_float(member):
+            rows[:nb, offset:offset + values.shape[1]] = values
+        else:
+            rows[:nb, offset:offset + values.shape[1]] = values.astype(np.int32).view(np.float32)
+        offset += values.shape[1]
+    return offset
+
+def reader(dtype, offset: int = 0):
+    ''' Taichi function reading the element i of an ndarray of rows packed by pack, as read(rows, i) -> dtype '''
+    if isinstance(dtype, StructType):
+        readers = []
+        for name, member in dtype.members.items():
+            readers.append((name, reader(member, offset)))
+            offset += row_size(member)
+
+        @ti.func
+        def read_struct(rows: ti.template(), i):
+            return dtype(**{name: read(rows, i) for name, read in ti.static(readers)})
+        return read_struct
+
+    if isinstance(dtype, MatrixType):
+        if dtype.ndim == 2:
+            readers = [[reader(dtype.dtype, offset + r * dtype.m + c) for c in range(dtype.m)] for r in range(dtype.n)]
+
+            @ti.func
+            def read_matrix(rows: ti.template(), i):
+                return ti.Matrix([[read(rows, i) for read in ti.static(row)] for row in ti.static(readers)])
+            return read_matrix
+
+        readers = [reader(dtype.dtype, offset + c) for c in range(dtype.n)]
+
+        @ti.func
+        def read_vector(rows: ti.template(), i):
+            return ti.Vector([read(rows, i) for read in ti.static(readers)])
+        return read_vector
+
+    if is_float(dtype):
+        @ti.func
+        def read_float(rows: ti.template(), i):
+            return rows[i, offset]
+        return read_float
+
+    @ti.func
+    def read_int(rows: ti.template(), i):
+        return ti.cast(ti.bit_cast(rows[i, offset], ti.i32), dtype)
+    return read_int
@@ -0,0 +1,112 @@
+import taichi as ti
+import taichi.math as tm
+
+# pixel samplers, selected at run time by the render kernel
+SAMPLER_RANDOM = 0      # independent uniform offsets, from a counter based generator
+SAMPLER_STRATIFIED = 1  # one jittered offset per cell of a grid over the pixel
+SAMPLER_HALTON = 2      # Halton sequence in bases 2 and 3, randomly shifted per pixel
+SAMPLER_SOBOL = 3       # first two dimensions of the Sobol sequence, Owen scrambled per pixel
+SAMPLER_BY_NAME = {"random": SAMPLER_RANDOM, "stratified": SAMPLER_STRATIFIED,
+                   "halton": SAMPLER_HALTON, "sobol": SAMPLER_SOBOL}
+
+@ti.func
+def hash_u32(v: ti.u32) -> ti.u32:
+    ''' PCG hash of a 32 bit integer, every bit of the result depends on every bit of v '''
+    state = v * ti.u32(747796405) + ti.u32(2891336453)
+    word = ((state >> ((state >> ti.u32(28)) + ti.u32(4))) ^ state) * ti.u32(277803737)
+    return (word >> ti.u32(22)) ^ word
+
+@ti.func
+def hash_combine(a: ti.u32, b: ti.u32) -> ti.u32:
+    return hash_u32(a ^ (b + ti.u32(0x9e3779b9) + (a << ti.u32(6)) + (a >> ti.u32(2))))
+
+@ti.func
+def u32_to_unit_float(v: ti.u32) -> float:
+    ''' Float in [0, 1) from the 24 high bits of v, which are all exactly representable '''
+    return ti.cast(v >> ti.u32(8), float) * (1.0 / 16777216.0)
+
+@ti.func
+def reverse_bits(v: ti.u32) -> ti.u32:
+    v = ((v >> ti.u32(1)) & ti.u32(0x55555555)) | ((v & ti.u32(0x55555555)) << ti.u32(1))
+    v = ((v >> ti.u32(2)) & ti.u32(0x33333333)) | ((v & ti.u32(0x33333333)) << ti.u32(2))
+    v = ((v >> ti.u32(4)) & ti.u32(0x0f0f0f0f)) | ((v & ti.u32(0x0f0f0f0f)) << ti.u32(4))
+    v = ((v >> ti.u32(8)) & ti.u32(0x00ff00ff)) | ((v & ti.u32(0x00ff00ff)) << ti.u32(8))
+    return (v >> ti.u32(16)) | (v << ti.u32(16))
+
+@ti.func
+def owen_scramble(v: ti.u32, seed: ti.u32) -> ti.u32:
+    ''' Nested uniform (Owen) scrambling of the bits of v, with the hash based permutation of Laine and Karras
+        as improved by Vegdahl.  Each bit is flipped depending on the bits above it, so the scrambled points
+        keep the stratification of the sequence.
+    '''
+    v = reverse_bits(v)
+    v ^= v * ti.u32(0x3d20adea)
+    v += seed
+    v *= (seed >> ti.u32(16)) | ti.u32(1)
+    v ^= v * ti.u32(0x05526c56)
+    v ^= v * ti.u32(0x53a22864)
+    return reverse_bits(v)
+
+@ti.func
+def sobol_2d(index: ti.u32) -> tm.uvec2:
+    ''' First two dimensions of the Sobol sequence, as 32 bit fixed point values '''
+    # dimension 0 is the van der Corput sequence, dimension 1 has the direction numbers of polynomial x + 1
+    v = ti.u32(1) << ti.u32(31)
+    y = ti.u32(0)
+    i = index
+    while i != ti.u32(0):
+        if i & ti.u32(1):
+            y ^= v
+        i >>= ti.u32(1)
+        v ^= v >> ti.u32(1)
+    return tm.uvec2(reverse_bits(index), y)
+
+@ti.func
+def radical_inverse(index: ti.i32, base: ti.i32) -> float:
+    ''' Digits of index in the given base mirrored around the decimal point '''
+    inv_base = 1.0 / base
+    f = inv_base
+    r = 0.0
+    i = index
+    while i > 0:
+        r += f * (i % base)
+        i //= base
+        f *= inv_base
+    return r
+
+@ti.func
+def sample_pixel(sampler: ti.i32, seed: ti.i32, pixel: ti.i32, sample: ti.i32, nb_samples: ti.i32) -> tm.vec2:
+    ''' Offset of a sample in its pixel
+    Args:
+        sampler (int): one of the SAMPLER_* constants
+        seed (int): seed of the render
+        pixel (int): index of the pixel in the image, which decorrelates the sequences of neighbouring pixels
+        sample (int): index of the sample in the pixel, from 0 to nb_samples - 1
+        nb_samples (int): number of samples of the pixel, used by the stratified sampler
+    Returns:
+        tm.vec2: offset in [0, 1)^2
+
+        The offset only depends on the arguments (there is no generator state), so a sample is the
+        same whichever thread, launch or process takes it.
+    '''
+    pixel_seed = hash_combine(hash_u32(ti.cast(seed, ti.u32)), ti.cast(pixel, ti.u32))
+    offset = tm.vec2(0.0, 0.0)
+    if sampler == SAMPLER_STRATIFIED:
+        nx = ti.max(1, ti.cast(ti.sqrt(ti.cast(nb_samples, float)), ti.i32))
+        ny = (ti.max(1, nb_samples) + nx - 1) // nx
+        # shifted per pixel, so that the cells left out when nb_samples < nx * ny differ between pixels
+        cell = ti.cast((ti.cast(sample, ti.u32) + pixel_seed) % ti.cast(nx * ny, ti.u32), ti.i32)
+        h = hash_combine(pixel_seed, ti.cast(sample, ti.u32))
+        jitter = tm.vec2(u32_to_unit_float(h), u32_to_unit_float(hash_u32(h)))
+        offset = (tm.vec2(cell % nx, cell // nx) + jitter) / tm.vec2(nx, ny)
+    elif sampler == SAMPLER_HALTON:
+        shift = tm.vec2(u32_to_unit_float(pixel_seed), u32_to_unit_float(hash_u32(pixel_seed)))
+        offset = tm.fract(tm.vec2(radical_inverse(sample + 1, 2), radical_inverse(sample + 1, 3)) + shift)
+    elif sampler == SAMPLER_SOBOL:
+        p = sobol_2d(ti.cast(sample, ti.u32))
+        offset = tm.vec2(u32_to_unit_float(owen_scramble(p.x, pixel_seed)),
+                         u32_to_unit_float(owen_scramble(p.y, hash_u32(pixel_seed))))
+    else:
+        h = hash_combine(pixel_seed, ti.cast(sample, ti.u32))
+        offset = tm.vec2(u32_to_unit_float(h), u32_to_unit_float(hash_u32(h)))
+    return offset
@@ -1,36 +1,384 @@
 import geometry as geom
+import helperclasses as hc
+import accumulation
+import bvh
+import records
+import sampler
 from helperclasses import Ray, Intersection
-from camera import Camera
+from camera import Camera, CameraParams
 
+import hashlib
 import numpy as np
+import time
+from pyglm import glm
 
 import taichi as ti
 import taichi.math as tm
 
 shadow_epsilon = 10**(-2)
 
-@ti.data_oriented
+# primitive types referenced by the leaves of the scene BVH
+PRIM_SPHERE = 0
+PRIM_AABOX = 1
+PRIM_MESH = 2
+
+# counters of a render, in its counters ndarray
+COUNTER_PROGRESS = 0  # number of pixels rendered so far, one per pixel and sample
+COUNTER_SAMPLED_PIXELS = 1  # number of pixels sampled by the last render_tiles
+COUNTER_NEXT_TILE = 2  # work queue of render_tiles, next tile to render
+NB_COUNTERS = 3
+
+@ti.dataclass
+class SceneParams:
+    ''' Scene settings read by the render kernel at run time, so that all the scenes share the kernel '''
+    jitter: ti.i32
+    seed: ti.i32  # seed of the sampler, a sample is a function of the seed, its pixel and its index
+    sampler: ti.i32  # sampler of the jittered offsets, one of sampler.SAMPLER_*
+    samples: ti.i32  # number of samples per pixel of the full render, used by the stratified sampler
+    ambient: tm.vec3
+    nb_lights: ti.i32
+    nb_spheres: ti.i32
+    nb_planes: ti.i32
+    nb_aaboxes: ti.i32
+    nb_meshes: ti.i32
+    nb_bvh_prims: ti.i32
+
+# The scene and its accumulation buffer are given to the render kernels as ndarray arguments rather than held in fields.
+# The offline cache keys a kernel that reads fields by their shapes and by the ids of all the fields allocated before
+# them, so that the kernel of a scene was compiled again whenever it was rendered in another batch or at another
+# resolution.  The shapes of ndarrays are read at run time instead: a single kernel renders every scene, and it is
+# compiled once for all runs.
+ROWS = ti.types.ndarray(dtype=ti.f32, ndim=2)  # elements of a dataclass packed in rows, see records.py
+VERTS = ti.types.ndarray(dtype=tm.vec3, ndim=1)
+FACES = ti.types.ndarray(dtype=tm.ivec3, ndim=1)
+PRIMS = ti.types.ndarray(dtype=tm.ivec2, ndim=1)  # primitive type and index
+ACCUM = ti.types.ndarray(dtype=ti.types.vector(3, ti.i64), ndim=2)  # sum of the samples, in fixed point
+ACCUM_SQ = ti.types.ndarray(dtype=ti.i64, ndim=2)  # sum of the squared luminance of the samples, in fixed point
+SAMPLE_COUNT = ti.types.ndarray(dtype=ti.i32, ndim=2)  # number of samples of each pixel
+COUNTERS = ti.types.ndarray(dtype=ti.i64, ndim=1)  # the COUNTER_* of the render
+
+read_light = records.reader(hc.Light)
+read_sphere = records.reader(geom.Sphere)
+read_plane = records.reader(geom.Plane)
+read_aabox = records.reader(geom.AABox)
+read_mesh = records.reader(geom.Mesh)
+
+# ndarrays of a scene, given as a single argument to the render kernel and as a template to the Taichi functions
+SceneArrays = ti.types.argpack(lights=ROWS, spheres=ROWS, planes=ROWS, aaboxes=ROWS, meshes=ROWS,
+                               meshes_verts=VERTS, meshes_faces=FACES, meshes_bvh=ROWS, bvh_nodes=ROWS, bvh_prims=PRIMS)
+
+def to_ndarray(values: np.ndarray, dtype, element_ndim: int = 0):
+    ''' Ndarray holding numpy values, whose last element_ndim dimensions are those of the elements of dtype
+        Ndarrays can not be empty, so that of no values holds a single element of zeros, which is never read.
+    '''
+    if values.shape[0] == 0:
+        values = np.zeros((1,) + values.shape[1:], dtype=values.dtype)
+    array = ti.ndarray(dtype, shape=values.shape[:values.ndim - element_ndim])
+    array.from_numpy(values)
+    return array
+
+@ti.func
+def morton_decode(i: ti.i32) -> tm.ivec2:
+    ''' Pixel coordinates of the i-th pixel of a tile in Morton (Z) order, the bits of i alternate between x and y '''
+    p = tm.ivec2(i, i >> 1) & 0x55555555
+    p = (p | (p >> 1)) & 0x33333333
+    p = (p | (p >> 2)) & 0x0f0f0f0f
+    p = (p | (p >> 4)) & 0x00ff00ff
+    p = (p | (p >> 8)) & 0x0000ffff
+    return p
+
+@ti.func
+def luminance(colour: tm.vec3) -> float:
+    return tm.dot(colour, tm.vec3(0.2126, 0.7152, 0.0722))
+
+@ti.func
+def to_fixed_point(value):
+    return ti.cast(ti.round(value * accumulation.ACCUM_SCALE), ti.i64)
+
+@ti.kernel
+def render_tiles( params: SceneParams, camera: CameraParams, scene: SceneArrays,
+                  accum: ACCUM, accum_sq: ACCUM_SQ, sample_count: SAMPLE_COUNT, counters: COUNTERS,
+                  iteration_count: int, first_sample: int, nb_samples: int, tile_size: int, first_tile: int, last_tile: int,
+                  nb_workers: int, adaptive_threshold: float, adaptive_min_samples: int ):
+    ''' Render several samples per pixel of a range of tiles in a single launch
+    Args:
+        params (SceneParams): settings of the scene
+        camera (CameraParams): camera of the scene
+        scene (SceneArrays): ndarrays of the primitives of the scene
+        accum, accum_sq, sample_count (ndarray): accumulation buffer of the render, of shape (width, height)
+        counters (ndarray): the COUNTER_* of the render
+        iteration_count (int): iteration count of the first sample, the accumulation buffer is cleared when it is 1
+        first_sample (int): index of the first sample of the render, the sample indices of a pixel start there and
+            continue with its sample count, they key the sampler along with the seed and the pixel
+        nb_samples (int): number of samples per pixel to render
+        tile_size (int): width and height of the square tiles, a power of two
+        first_tile (int): first tile to render, tiles are numbered row by row
+        last_tile (int): tile after the last one to render
+        nb_workers (int): number of parallel workers taking tiles from the queue
+        adaptive_threshold (float): pixels with at least adaptive_min_samples samples are only sampled while the
+            standard error of their luminance is above this threshold, all pixels are sampled if it is 0
+        adaptive_min_samples (int): number of samples of a pixel before its error is estimated, at least 2
+
+        The cost of a tile depends on what it sees, so rather than splitting the tiles evenly
+        between the threads, each worker takes the next tile from a shared atomic counter until
+        there are none left.  All the samples of a pixel are taken by the same worker, so they
+        are summed locally and added to the accumulation buffer without any atomic operation.
+    '''
+    nb_tiles_x = (camera.width + tile_size - 1) // tile_size
+    counters[COUNTER_NEXT_TILE] = first_tile
+    counters[COUNTER_SAMPLED_PIXELS] = 0
+    ti.loop_config(block_dim=1)
+    for worker in range(nb_workers):
+        tile = ti.cast(ti.atomic_add(counters[COUNTER_NEXT_TILE], 1), ti.i32)
+        while tile < last_tile:
+            x0 = (tile % nb_tiles_x) * tile_size
+            y0 = (tile // nb_tiles_x) * tile_size
+            tile_sampled_pixels = 0
+            # pixels are visited in Morton order, so that consecutive rays are close to each other
+            for i in range(tile_size * tile_size):
+                p = morton_decode(i)
+                x = x0 + p.x
+                y = y0 + p.y
+                count = 0  # samples of the pixel so far, the buffer is started over on the first iteration
+                if iteration_count > 1 and x < camera.width and y < camera.height:
+                    count = sample_count[x,y]
+                sample = x < camera.width and y < camera.height and nb_samples > 0
+                if sample and adaptive_threshold > 0.0 and count >= adaptive_min_samples:
+                    mean = luminance(ti.cast(accum[x,y], float)) / (count * accumulation.ACCUM_SCALE)
+                    mean_sq = ti.cast(accum_sq[x,y], float) / (count * accumulation.ACCUM_SCALE)
+                    variance = ti.max(mean_sq - mean * mean, 0.0) * count / (count - 1)
+                    sample = ti.sqrt(variance / count) > adaptive_threshold
+                if sample:
+                    samples_sum = ti.Vector([0, 0, 0], dt=ti.i64)
+                    samples_sum_sq = ti.cast(0, ti.i64)
+                    for s in range(nb_samples):
+                        offset = tm.vec2(0, 0)
+                        if params.jitter != 0:
+                            offset = sampler.sample_pixel(params.sampler, params.seed, y * camera.width + x,
+                                                          first_sample + count + s, params.samples)
+                        ray = camera.create_ray( x, y, offset )
+                        intersect = intersect_scene(scene, params, ray, 0, float('inf'))
+                        sample_colour = tm.vec3(0, 0, 0) # background colour
+                        if intersect.is_hit:
+                            sample_colour = compute_shading(scene, params, intersect, ray)
+                        samples_sum += to_fixed_point(sample_colour)
+                        samples_sum_sq += to_fixed_point(luminance(sample_colour) ** 2)
+                    if count == 0:
+                        accum[x,y] = samples_sum
+                        accum_sq[x,y] = samples_sum_sq
+                    else:
+                        accum[x,y] += samples_sum
+                        accum_sq[x,y] += samples_sum_sq
+                    sample_count[x,y] = count + nb_samples
+                    tile_sampled_pixels += 1
+            ti.atomic_add(counters[COUNTER_PROGRESS], ti.cast(tile_sampled_pixels * nb_samples, ti.i64))
+            ti.atomic_add(counters[COUNTER_SAMPLED_PIXELS], ti.cast(tile_sampled_pixels, ti.i64))
+            tile = ti.cast(ti.atomic_add(counters[COUNTER_NEXT_TILE], 1), ti.i32)
+
+@ti.kernel
+def read_rows( y0: int, accum: ACCUM, accum_sq: ACCUM_SQ, sample_count: SAMPLE_COUNT,
+               accum_rows: ti.types.ndarray(), accum_sq_rows: ti.types.ndarray(), sample_count_rows: ti.types.ndarray() ):
+    ''' Copy the accumulation buffer of the rows y0 to y0 + height, where height is the second dimension of the *_rows arrays '''
+    for x, y in ti.ndrange(accum_rows.shape[0], accum_rows.shape[1]):
+        for c in ti.static(range(3)):
+            accum_rows[x,y,c] = accum[x,y0 + y][c]
+        accum_sq_rows[x,y] = accum_sq[x,y0 + y]
+        sample_count_rows[x,y] = sample_count[x,y0 + y]
+
+@ti.func
+def intersect_scene(scene: ti.template(), params: SceneParams, ray: Ray, t_min: float, t_max: float) -> Intersection:
+    best = Intersection() # default is no intersection (is_hit = False)
+    ti.loop_config(serialize=True)
+    for i in range(params.nb_planes):
+        hit = geom.intersectPlane(read_plane(scene.planes, i), ray, t_min, t_max )
+        if hit.is_hit: best = hit; t_max = hit.t # keep best hit only
+
+    # walk the BVH with a small fixed stack, nearest child first
+    inv_dir = 1.0 / ray.direction
+    stack = ti.Vector([0] * bvh.BVH_STACK_SIZE, dt=ti.i32)
+    stack_t = ti.Vector([0.0] * bvh.BVH_STACK_SIZE, dt=float)  # entry distance of each stacked node
+    stack_size = 0
+    root = bvh.read_node(scene.bvh_nodes, 0)
+    root_t = bvh.intersectBounds(root.bbox_min, root.bbox_max, ray.origin, inv_dir, t_min, t_max)
+    if params.nb_bvh_prims > 0 and root_t < float('inf'):
+        stack[0] = 0; stack_t[0] = root_t; stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = bvh.read_node(scene.bvh_nodes, stack[stack_size])
+        if stack_t[stack_size] > t_max:
+            continue # a closer hit was found since this node was stacked
+        if node.count > 0:
+            for j in range(node.left_first, node.left_first + node.count):
+                prim = scene.bvh_prims[j]
+                hit = Intersection()
+                if prim[0] == PRIM_SPHERE:
+                    hit = geom.intersectSphere(read_sphere(scene.spheres, prim[1]), ray, t_min, t_max )
+                elif prim[0] == PRIM_AABOX:
+                    hit = geom.intersectAABox(read_aabox(scene.aaboxes, prim[1]), ray, t_min, t_max )
+                else:
+                    hit = geom.intersectMesh(read_mesh(scene.meshes, prim[1]), scene.meshes_verts, scene.meshes_faces, scene.meshes_bvh, ray, t_min, t_max)
+                if hit.is_hit: best = hit; t_max = hit.t
+        else:
+            left = bvh.read_node(scene.bvh_nodes, node.left_first)
+            right = bvh.read_node(scene.bvh_nodes, node.left_first + 1)
+            t_left = bvh.intersectBounds(left.bbox_min, left.bbox_max, ray.origin, inv_dir, t_min, t_max)
+            t_right = bvh.intersectBounds(right.bbox_min, right.bbox_max, ray.origin, inv_dir, t_min, t_max)
+            # push the farther child first so that the nearer one is visited next
+            near, far = node.left_first, node.left_first + 1
+            if t_right < t_left:
+                near, far = far, near
+                t_left, t_right = t_right, t_left
+            if t_right < float('inf'):
+                stack[stack_size] = far; stack_t[stack_size] = t_right; stack_size += 1
+            if t_left < float('inf'):
+                stack[stack_size] = near; stack_t[stack_size] = t_left; stack_size += 1
+    return best
+
+@ti.func
+def occluded_scene(scene: ti.template(), params: SceneParams, ray: Ray, t_min: float, t_max: float) -> bool:
+    ''' Any-hit query for shadow rays, true as soon as something blocks the ray between t_min and t_max '''
+    is_hit = False
+    ti.loop_config(serialize=True)
+    for i in range(params.nb_planes):
+        if not is_hit:
+            is_hit = geom.occludePlane(read_plane(scene.planes, i), ray, t_min, t_max)
+
+    # any hit will do, so children are visited in any order
+    inv_dir = 1.0 / ray.direction
+    stack = ti.Vector([0] * bvh.BVH_STACK_SIZE, dt=ti.i32)
+    stack_size = 0
+    if params.nb_bvh_prims > 0:
+        stack_size = 1
+    while stack_size > 0 and not is_hit:
+        stack_size -= 1
+        node = bvh.read_node(scene.bvh_nodes, stack[stack_size])
+        if bvh.intersectBounds(node.bbox_min, node.bbox_max, ray.origin, inv_dir, t_min, t_max) < float('inf'):
+            if node.count > 0:
+                for j in range(node.left_first, node.left_first + node.count):
+                    prim = scene.bvh_prims[j]
+                    if prim[0] == PRIM_SPHERE:
+                        is_hit = geom.occludeSphere(read_sphere(scene.spheres, prim[1]), ray, t_min, t_max)
+                    elif prim[0] == PRIM_AABOX:
+                        is_hit = geom.occludeAABox(read_aabox(scene.aaboxes, prim[1]), ray, t_min, t_max)
+                    else:
+                        is_hit = geom.occludeMesh(read_mesh(scene.meshes, prim[1]), scene.meshes_verts, scene.meshes_faces, scene.meshes_bvh, ray, t_min, t_max)
+                    if is_hit: break
+            else:
+                stack[stack_size] = node.left_first; stack[stack_size + 1] = node.left_first + 1; stack_size += 2
+    return is_hit
+
+@ti.func
+def compute_shading(scene: ti.template(), params: SceneParams, intersect: Intersection, ray: Ray) -> tm.vec3:
+    sample_colour = tm.vec3(0, 0, 0)
+
+    # Ambient shading
+    sample_colour += params.ambient * intersect.mat.diffuse
+
+    ti.loop_config(serialize=True) 
+    for l in range(params.nb_lights):
+
+        light = read_light(scene.lights, l)
+    
+        light_dir = tm.vec3(0, 0, 0)
+        attenuation = 0.0
+        distance_to_light = 0.0
+
+        if light.ltype == 0:
+            # Directional light: vector is already normalized direction toward light
+            light_dir = light.vector
+            attenuation = 1.0
+            distance_to_light = float('inf')
+        else:
+            # Point light: vector is position, compute direction
+            light_vector = light.vector - intersect.position
+            distance_to_light = tm.length(light_vector)
+            light_dir = light_vector.normalized()
+            
+            kq = light.attenuation.x
+            kl = light.attenuation.y
+            kc = light.attenuation.z
+            attenuation = 1.0 / (kc + kl * distance_to_light + kq * distance_to_light * distance_to_light)
+        
+        normal = intersect.normal.normalized()
+        view_dir = (-ray.direction).normalized()
+        
+        diffuse_factor = tm.max(0.0, normal.dot(light_dir))
+        diffuse = intersect.mat.diffuse * light.colour * diffuse_factor * attenuation
+        
+        specular = tm.vec3(0, 0, 0)
+        if tm.length(intersect.mat.specular) > 0.0:
+            half_vector = (view_dir + light_dir).normalized()
+            spec_factor = tm.max(0.0, normal.dot(half_vector))
+            spec_factor = tm.pow(spec_factor, intersect.mat.shininess.x)
+            specular = intersect.mat.specular * light.colour * spec_factor * attenuation
+        
+        # TODO: Objective 6: Implement shadow rays
+        
+        #check for shadows if the surface is facing the light
+        if diffuse_factor > 0.0:
+            #create shadow ray from surface point toward light
+            shadow_ray = Ray(intersect.position, light_dir)
+            
+            if not occluded_scene(scene, params, shadow_ray, shadow_epsilon, distance_to_light):
+                sample_colour += diffuse + specular
+
+    return sample_colour
+
+render_threads = None  # CPU threads of the Taichi runtime (its cpu_max_num_threads), set along with ti.init, None on GPUs
+
+def compile_kernels():
+    ''' Compile the kernels of a render (or load them from the offline cache) without any scene, they are the same for all scenes
+        Besides render_tiles and read_rows, this compiles the Taichi kernels copying the ndarrays of a scene from and to numpy.
+    '''
+    arrays = {name: to_ndarray(np.zeros((0, records.row_size(dtype)), dtype=np.float32), ti.f32)
+              for name, dtype in (("lights", hc.Light), ("spheres", geom.Sphere), ("planes", geom.Plane), ("aaboxes", geom.AABox),
+                                  ("meshes", geom.Mesh), ("meshes_bvh", bvh.BVHNode), ("bvh_nodes", bvh.BVHNode))}
+    scene_arrays = SceneArrays(meshes_verts=to_ndarray(np.zeros((0, 3), dtype=np.float32), tm.vec3, 1),
+                               meshes_faces=to_ndarray(np.zeros((0, 3), dtype=np.int32), tm.ivec3, 1),
+                               bvh_prims=to_ndarray(np.zeros((0, 2), dtype=np.int32), tm.ivec2, 1), **arrays)
+    pixels = {"accum": to_ndarray(np.zeros((1, 1, 3), dtype=np.int64), ti.types.vector(3, ti.i64), 1),
+              "accum_sq": to_ndarray(np.zeros((1, 1), dtype=np.int64), ti.i64),
+              "sample_count": to_ndarray(np.zeros((1, 1), dtype=np.int32), ti.i32)}
+    counters = to_ndarray(np.zeros(NB_COUNTERS, dtype=np.int64), ti.i64)
+    render_tiles(SceneParams(), CameraParams(), scene_arrays, pixels["accum"], pixels["accum_sq"], pixels["sample_count"], counters,
+                 1, 0, 0, 1, 0, 0, 1, 0.0, 2)
+    read_rows(0, pixels["accum"], pixels["accum_sq"], pixels["sample_count"],
+              np.zeros((1, 1, 3), dtype=np.int64), np.zeros((1, 1), dtype=np.int64), np.zeros((1, 1), dtype=np.int32))
+    for array in pixels.values():
+        array.fill(0)
+        array.to_numpy()
+    counters.fill(0)
+    int(counters[COUNTER_PROGRESS])
+
 class Scene:
     def __init__(self,
                  jitter: bool,
                  samples: int,
+                 sampler_name: str,
                  camera: Camera,
                  ambient: tm.vec3,
-                 lights: ti.template(),
+                 lights: dict,
                  nb_lights: int,
-                 spheres: ti.template(),
+                 spheres: dict,
                  nb_spheres: int,
-                 planes: ti.template(),
+                 planes: dict,
                  nb_planes: int,
-                 aaboxes: ti.template(),
+                 aaboxes: dict,
                  nb_aaboxes: int,
-                 meshes: ti.template(),
+                 meshes: dict,
                  nb_meshes: int,
                  meshes_verts: np.array,
                  meshes_faces: np.array,
+                 meshes_bvh: dict,
+                 scene_bvh: tuple = None,
                  ):
+        ''' Scene to render, its primitives are given as numpy columns of their Taichi dataclass (see parser.primitive_columns)
+            The BVH over the primitives is built unless scene_bvh gives its nodes and primitives (bvh_nodes and bvh_prims),
+            as saved in a bundle (see bundle.py).
+        '''
         self.jitter = jitter  # should rays be jittered
         self.samples = samples  # number of rays per pixel
+        self.sampler_name = sampler_name  # sampler of the jittered offsets, a key of sampler.SAMPLER_BY_NAME
         self.camera = camera
         self.ambient = ambient  # ambient lighting
         self.lights = lights  # all lights in the scene
@@ -43,106 +391,280 @@ class Scene:
         self.nb_planes = nb_planes
         self.nb_aaboxes = nb_aaboxes
         self.nb_meshes = nb_meshes
+        self.meshes_verts = meshes_verts
+        self.meshes_faces = meshes_faces
+        self.meshes_bvh = meshes_bvh
 
-        self.meshes_verts = ti.Vector.field(3, shape=(max(1, meshes_verts.shape[0])), dtype=float)
-        self.meshes_verts.from_numpy(meshes_verts)
-        self.meshes_faces = ti.Vector.field(3, shape=(max(1, meshes_faces.shape[0])), dtype=int)
-        self.meshes_faces.from_numpy(meshes_faces)
+        if scene_bvh is None:
+            self.build_bvh(meshes_bvh)
+        else:
+            self.bvh_nodes, self.bvh_prims = scene_bvh
 
-        self.image = ti.Vector.field( n=3, dtype=float, shape=(self.camera.width, self.camera.height) )
+        self.seed = 0  # seed of the sampler
+        self.first_sample = 0  # index of the first sample of the render, to render a range of samples (see accumulation.py)
+        self.tile_size = 16  # width and height of the tiles taken by the render workers, a power of two
+        self.adaptive_threshold = 0.0  # standard error of the luminance below which pixels stop being sampled, 0 to disable
+        self.adaptive_min_samples = 8  # number of samples of each pixel before its error is estimated
+        self.arrays = None  # SceneArrays of the scene, uploaded when it is first bound
+        self.pixels = None  # ndarrays of the accumulation.BUFFER_ARRAYS of the render, of shape (width, height)
+        self.counters = None  # ndarray of the COUNTER_* of the render
 
-        self.offsets = ti.field(dtype=ti.f32, shape=((self.samples - 1) * (self.samples - 1) + 1, 2))
+    def build_bvh(self, meshes_bvh: dict):
+        ''' Build the BVH over the world space bounds of all bounded primitives (spheres, boxes and meshes)
+        Args:
+            meshes_bvh (dict): numpy columns of the BVH nodes of all meshes, used for the bounds of each mesh
 
+            Planes are infinite and are not part of the BVH, they are tested separately.
+        '''
+        bounds_min, bounds_max, prims = [], [], []
+        if self.nb_spheres > 0:
+            spheres = self.spheres
+            r = spheres["radius"][:self.nb_spheres, None] * np.ones(3)
+            bounds = bvh.transform_bounds(-r, r, spheres["M"][:self.nb_spheres])
+            bounds_min.append(bounds[0]); bounds_max.append(bounds[1])
+            prims.append(np.stack((np.full(self.nb_spheres, PRIM_SPHERE), np.arange(self.nb_spheres)), axis=1))
+        if self.nb_aaboxes > 0:
+            aaboxes = self.aaboxes
+            bounds = bvh.transform_bounds(aaboxes["minpos"][:self.nb_aaboxes], aaboxes["maxpos"][:self.nb_aaboxes],
+                                          aaboxes["M"][:self.nb_aaboxes])
+            bounds_min.append(bounds[0]); bounds_max.append(bounds[1])
+            prims.append(np.stack((np.full(self.nb_aaboxes, PRIM_AABOX), np.arange(self.nb_aaboxes)), axis=1))
+        if self.nb_meshes > 0:
+            meshes = self.meshes
+            roots = meshes["bvh_start"][:self.nb_meshes]  # the root of each mesh BVH bounds the whole mesh
+            bounds = bvh.transform_bounds(meshes_bvh["bbox_min"][roots], meshes_bvh["bbox_max"][roots], meshes["M"][:self.nb_meshes])
+            bounds_min.append(bounds[0]); bounds_max.append(bounds[1])
+            prims.append(np.stack((np.full(self.nb_meshes, PRIM_MESH), np.arange(self.nb_meshes)), axis=1))
 
-    @ti.kernel
-    def render( self, iteration_count: int ):
-        for x,y in ti.ndrange(self.camera.width, self.camera.height):
-            if (y == x) and x%10 == 0: print(".",end='')
-            ray = self.camera.create_ray( x, y, self.jitter )
-            intersect = self.intersect_scene(ray, 0, float('inf'))
-            sample_colour = tm.vec3(0, 0, 0) # background colour
-            if intersect.is_hit:
-                sample_colour = self.compute_shading(intersect, ray)
-            self.image[x,y] += (sample_colour - self.image[x,y]) / iteration_count
-        print() # end of line after one dot per 10 rows
-
-
-    @ti.func
-    def intersect_scene(self, ray: Ray, t_min: float, t_max: float) -> Intersection:
-        best = Intersection() # default is no intersection (is_hit = False)        
-        ti.loop_config(serialize=True) 
-        for i in range(self.nb_spheres):
-            hit = geom.intersectSphere(self.spheres[i], ray, t_min, t_max )
-            if hit.is_hit: best = hit; t_max = hit.t # keep best hit only
-        ti.loop_config(serialize=True) 
-        for i in range(self.nb_planes):
-            hit = geom.intersectPlane(self.planes[i], ray, t_min, t_max )
-            if hit.is_hit: best = hit; t_max = hit.t                
-        ti.loop_config(serialize=True) 
-        for i in range(self.nb_aaboxes):
-            hit = geom.intersectAABox(self.aaboxes[i], ray, t_min, t_max )
-            if hit.is_hit: best = hit; t_max = hit.t
-        ti.loop_config(serialize=True) 
-        for i in range(self.nb_meshes):
-            hit = geom.intersectMesh(self.meshes[i], self.meshes_verts, self.meshes_faces, ray, t_min, t_max)
-            if hit.is_hit: best = hit; t_max = hit.t
-        return best
-
-    @ti.func
-    def compute_shading(self, intersect: Intersection, ray: Ray) -> tm.vec3:
-        sample_colour = tm.vec3(0, 0, 0)
-
-        # Ambient shading
-        sample_colour += self.ambient * intersect.mat.diffuse
-
-        ti.loop_config(serialize=True) 
-        for l in range(self.nb_lights):
-
-            light = self.lights[l]
-        
-            light_dir = tm.vec3(0, 0, 0)
-            attenuation = 0.0
-            distance_to_light = 0.0
-
-            if light.ltype == 0:
-                # Directional light: vector is already normalized direction toward light
-                light_dir = light.vector
-                attenuation = 1.0
-                distance_to_light = float('inf')
+        if len(prims) > 0:
+            nodes, order = bvh.build_bvh(np.concatenate(bounds_min), np.concatenate(bounds_max))
+            prims = np.concatenate(prims)[order]
+        else:
+            nodes, prims = bvh.empty_bvh(), np.zeros((0, 2))
+        self.bvh_nodes = nodes
+        self.bvh_prims = prims.astype(np.int32)  # primitive type and index
+
+    def bind(self):
+        ''' Upload the scene to its ndarrays and allocate its cleared accumulation buffer, unless it is already done '''
+        if self.arrays is None:
+            self.arrays = SceneArrays(
+                lights=to_ndarray(records.pack(self.lights, hc.Light, self.nb_lights), ti.f32),
+                spheres=to_ndarray(records.pack(self.spheres, geom.Sphere, self.nb_spheres), ti.f32),
+                planes=to_ndarray(records.pack(self.planes, geom.Plane, self.nb_planes), ti.f32),
+                aaboxes=to_ndarray(records.pack(self.aaboxes, geom.AABox, self.nb_aaboxes), ti.f32),
+                meshes=to_ndarray(records.pack(self.meshes, geom.Mesh, self.nb_meshes), ti.f32),
+                meshes_verts=to_ndarray(self.meshes_verts.astype(np.float32, copy=False).reshape(-1, 3), tm.vec3, 1),
+                meshes_faces=to_ndarray(self.meshes_faces.astype(np.int32, copy=False).reshape(-1, 3), tm.ivec3, 1),
+                meshes_bvh=to_ndarray(records.pack(self.meshes_bvh, bvh.BVHNode, self.meshes_bvh["count"].shape[0]), ti.f32),
+                bvh_nodes=to_ndarray(records.pack(self.bvh_nodes, bvh.BVHNode, self.bvh_nodes["count"].shape[0]), ti.f32),
+                bvh_prims=to_ndarray(self.bvh_prims.astype(np.int32, copy=False).reshape(-1, 2), tm.ivec2, 1))
+        if self.pixels is None:
+            shape = (self.camera.width, self.camera.height)
+            self.pixels = {"accum": ti.ndarray(ti.types.vector(3, ti.i64), shape=shape),
+                           "accum_sq": ti.ndarray(ti.i64, shape=shape),
+                           "sample_count": ti.ndarray(ti.i32, shape=shape)}
+            for array in self.pixels.values():
+                array.fill(0)
+            self.counters = ti.ndarray(ti.i64, shape=NB_COUNTERS)
+            self.counters.fill(0)
+
+    def release(self):
+        ''' Free the ndarrays of the scene once its render is over, e.g., when its outputs are saved
+            The accumulation buffer is lost, the scene is uploaded again with a cleared buffer if it is rendered again.
+        '''
+        self.arrays = None
+        self.pixels = None
+        self.counters = None
+
+    def pixels_to_numpy(self, name: str) -> np.ndarray:
+        ''' Per pixel state of the render, one of accumulation.BUFFER_ARRAYS, of shape (width, height, ...) '''
+        self.bind()  # cleared when the scene was never rendered
+        return self.pixels[name].to_numpy()
+
+    def rows_to_numpy(self, y0: int, y1: int) -> dict:
+        ''' Accumulation buffer of the rows y0 to y1 (excluded), only copying those rows out of its ndarrays
+        Returns:
+            dict: arrays of accumulation.BUFFER_ARRAYS, of shape (width, y1 - y0, ...)
+        '''
+        self.bind()
+        width = self.camera.width
+        rows = {"accum": np.zeros((width, y1 - y0, 3), dtype=np.int64),
+                "accum_sq": np.zeros((width, y1 - y0), dtype=np.int64),
+                "sample_count": np.zeros((width, y1 - y0), dtype=np.int32)}
+        if y1 > y0:
+            read_rows(y0, self.pixels["accum"], self.pixels["accum_sq"], self.pixels["sample_count"],
+                      rows["accum"], rows["accum_sq"], rows["sample_count"])
+        return rows
+
+    def image_to_numpy(self) -> np.ndarray:
+        ''' The rendered image, of shape (width, height, 3) '''
+        return accumulation.resolve(self.pixels_to_numpy("accum"), self.pixels_to_numpy("sample_count"))
+
+    def accumulation_buffer(self, name: str) -> dict:
+        ''' The accumulation buffer of the samples rendered so far, with the metadata needed to merge it (see accumulation.save)
+        Args:
+            name (str): name of the scene, usually its file name, which the merged image is named after
+        '''
+        buffer = {name: self.pixels_to_numpy(name) for name in accumulation.BUFFER_ARRAYS}
+        nb_samples = int(buffer["sample_count"].max(initial=0))
+        return dict(buffer, seed=self.seed, samples=self.samples, sampler=self.sampler_name if self.jitter else "none",
+                    scene=name, sample_range=(self.first_sample, self.first_sample + nb_samples))
+
+    def restore(self, buffer: dict, progress: int):
+        ''' Continue the render from an accumulation buffer, e.g., from a checkpoint (see checkpoint.py)
+        Args:
+            buffer (dict): arrays of accumulation.BUFFER_ARRAYS, of shape (width, height, ...)
+            progress (int): progress counter of the render when the buffer was saved
+        '''
+        self.bind()
+        for name, array in self.pixels.items():
+            array.from_numpy(buffer[name])
+        self.counters[COUNTER_PROGRESS] = progress
+
+    def content_hash(self) -> str:
+        ''' Hash of the primitives, camera and render settings of the scene, which all change the samples of the render '''
+        h = hashlib.sha256()
+        def update(columns):
+            if isinstance(columns, dict):
+                for key in sorted(columns):
+                    h.update(key.encode())
+                    update(columns[key])
             else:
-                # Point light: vector is position, compute direction
-                light_vector = light.vector - intersect.position
-                distance_to_light = tm.length(light_vector)
-                light_dir = light_vector.normalized()
-                
-                kq = light.attenuation.x
-                kl = light.attenuation.y
-                kc = light.attenuation.z
-                attenuation = 1.0 / (kc + kl * distance_to_light + kq * distance_to_light * distance_to_light)
-            
-            normal = intersect.normal.normalized()
-            view_dir = (-ray.direction).normalized()
-            
-            diffuse_factor = tm.max(0.0, normal.dot(light_dir))
-            diffuse = intersect.mat.diffuse * light.colour * diffuse_factor * attenuation
-            
-            specular = tm.vec3(0, 0, 0)
-            if tm.length(intersect.mat.specular) > 0.0:
-                half_vector = (view_dir + light_dir).normalized()
-                spec_factor = tm.max(0.0, normal.dot(half_vector))
-                spec_factor = tm.pow(spec_factor, intersect.mat.shininess.x)
-                specular = intersect.mat.specular * light.colour * spec_factor * attenuation
-            
-            # TODO: Objective 6: Implement shadow rays
-            
-            #check for shadows if the surface is facing the light
-            if diffuse_factor > 0.0:
-                #create shadow ray from surface point toward light
-                shadow_ray = Ray(intersect.position, light_dir)
-                
-                shadow_hit = self.intersect_scene(shadow_ray, shadow_epsilon, distance_to_light)
-                
-                if not shadow_hit.is_hit:
-                    sample_colour += diffuse + specular
-
-        return sample_colour
+                columns = np.ascontiguousarray(columns)
+                h.update(f"{columns.dtype}{columns.shape}".encode())
+                h.update(columns.tobytes())
+        for columns in (self.lights, self.spheres, self.planes, self.aaboxes, self.meshes,
+                        self.meshes_verts, self.meshes_faces, self.meshes_bvh):
+            update(columns)
+        camera = self.camera
+        settings = (camera.width, camera.height, tuple(camera.eye_position), tuple(camera.lookat), tuple(camera.up), camera.fovy,
+                    tuple(self.ambient), self.jitter, self.samples, self.sampler_name, self.seed, self.first_sample,
+                    self.adaptive_threshold, self.adaptive_min_samples)
+        h.update(repr(settings).encode())
+        return h.hexdigest()
+
+    def sample_count_to_numpy(self) -> np.ndarray:
+        ''' Number of samples taken in each pixel, of shape (width, height) '''
+        return self.pixels_to_numpy("sample_count")
+
+    @property
+    def progress(self) -> int:
+        ''' Number of pixels rendered so far, one per pixel and sample '''
+        if self.counters is None:
+            return 0  # never rendered, or released
+        return int(self.counters[COUNTER_PROGRESS])
+
+    def set_camera_pose(self, eye_position: glm.vec3, lookat: glm.vec3, up: glm.vec3, fovy: float = None):
+        ''' Move the camera between two renders, see Camera.set_pose '''
+        self.camera.set_pose(eye_position, lookat, up, fovy)
+
+    def render( self, iteration_count: int ):
+        self.render_samples(iteration_count, 1)
+
+    def compile( self ):
+        ''' Upload the scene and compile the render kernel (or load it from the offline cache) without rendering anything '''
+        self.render_samples(1, 0)
+
+    def nb_tiles(self) -> (int, int):
+        ''' Number of tiles along x and y '''
+        return (-(-self.camera.width // self.tile_size), -(-self.camera.height // self.tile_size))
+
+    def samples_per_launch( self, batch: int ) -> int:
+        ''' Number of samples per pixel to render in each launch, at most batch
+            Converged pixels are only found between launches, so with adaptive sampling a launch takes no more
+            than adaptive_min_samples, the samples of a pixel before its error is first estimated.
+        '''
+        if self.adaptive_threshold > 0:
+            return min(batch, self.adaptive_min_samples)
+        return batch
+
+    def render_samples( self, iteration_count: int, nb_samples: int, tiles: (int, int) = None ) -> int:
+        ''' Render several samples per pixel in a single launch, see render_tiles
+        Args:
+            iteration_count (int): iteration count of the first sample, the pixels rendered are cleared when it is 1
+            nb_samples (int): number of samples per pixel
+            tiles ((int, int)): range of tiles to render, numbered row by row, all the tiles if None
+        Returns:
+            int: number of pixels that were sampled, fewer than all of them with adaptive sampling
+        '''
+        self.bind()
+        nb_tiles_x, nb_tiles_y = self.nb_tiles()
+        first_tile, last_tile = (0, nb_tiles_x * nb_tiles_y) if tiles is None else tiles
+        nb_workers = max(1, last_tile - first_tile)
+        if render_threads is not None:
+            nb_workers = min(nb_workers, render_threads)  # each worker is a CPU thread, more would only find the queue empty
+        self.launch(iteration_count, nb_samples, first_tile, last_tile, nb_workers, self.adaptive_threshold)
+        return int(self.counters[COUNTER_SAMPLED_PIXELS])
+
+    def params( self ) -> SceneParams:
+        ''' Scene settings given to every launch of the render kernel '''
+        # settings such as the sampler and the camera can be changed between renders, they are read at each launch
+        return SceneParams(jitter=int(self.jitter), seed=self.seed, sampler=sampler.SAMPLER_BY_NAME[self.sampler_name],
+                           samples=self.samples, ambient=self.ambient,
+                           nb_lights=self.nb_lights, nb_spheres=self.nb_spheres, nb_planes=self.nb_planes,
+                           nb_aaboxes=self.nb_aaboxes, nb_meshes=self.nb_meshes,
+                           nb_bvh_prims=self.bvh_prims.shape[0])
+
+    def launch( self, iteration_count: int, nb_samples: int, first_tile: int, last_tile: int, nb_workers: int, adaptive_threshold: float ):
+        ''' Launch render_tiles on the bound scene, see its arguments '''
+        render_tiles(self.params(), self.camera.params(), self.arrays,
+                     self.pixels["accum"], self.pixels["accum_sq"], self.pixels["sample_count"], self.counters,
+                     iteration_count, self.first_sample, nb_samples, self.tile_size, first_tile, last_tile, nb_workers,
+                     adaptive_threshold, self.adaptive_min_samples)
+
+    def render_samples_in_chunks( self, iteration_count: int, nb_samples: int, chunk_sec: float, on_chunk=None ) -> int:
+        ''' Render several samples per pixel as render_samples, in launches of ranges of tiles taking about chunk_sec each
+        Args:
+            iteration_count (int): iteration count of the first sample, see render_samples
+            nb_samples (int): number of samples per pixel
+            chunk_sec (float): duration of each launch, all the tiles are rendered in a single launch if 0 or less
+            on_chunk (function): called with the progress counter after each launch, e.g., ProgressReporter.update
+        Returns:
+            int: number of pixels that were sampled, fewer than all of them with adaptive sampling
+
+            The progress counter can only be read between launches, so the launch of all the tiles is split to
+            publish the progress while it renders, whatever the number of samples.  Each range of tiles is sized
+            after the rate of the previous one, and has at least one tile per render thread.
+        '''
+        if chunk_sec <= 0:
+            nb_sampled_pixels = self.render_samples(iteration_count, nb_samples)
+            if on_chunk is not None:
+                on_chunk(self.progress)
+            return nb_sampled_pixels
+        nb_tiles_x, nb_tiles_y = self.nb_tiles()
+        min_tiles = render_threads or 1
+        chunk = min_tiles
+        first_tile = 0
+        nb_sampled_pixels = 0
+        while first_tile < nb_tiles_x * nb_tiles_y:
+            last_tile = min(first_tile + chunk, nb_tiles_x * nb_tiles_y)
+            start = time.perf_counter()
+            nb_sampled_pixels += self.render_samples(iteration_count, nb_samples, (first_tile, last_tile))  # waits for the launch
+            elapsed = time.perf_counter() - start
+            if on_chunk is not None:
+                on_chunk(self.progress)
+            # grown by at most 4 times, so that a range of cheap tiles does not make the next launch far too long
+            rate_chunk = int((last_tile - first_tile) * chunk_sec / max(elapsed, 1e-6))
+            chunk = max(min_tiles, min(rate_chunk, 4 * (last_tile - first_tile)))
+            first_tile = last_tile
+        return nb_sampled_pixels
+
+    def profile_tiles( self ) -> np.ndarray:
+        ''' Render one sample per pixel with one launch per tile, to measure the time spent in each tile
+        Returns:
+            np.ndarray: (nb_tiles_y, nb_tiles_x) render time of each tile in seconds, on a single thread
+
+            The accumulation buffer is overwritten by this sample, and the progress counter is left unchanged.
+        '''
+        self.bind()
+        nb_tiles_x, nb_tiles_y = self.nb_tiles()
+        progress = self.progress
+        timings = np.zeros(nb_tiles_x * nb_tiles_y)
+        ti.sync()
+        for tile in range(timings.size):
+            start = time.perf_counter()
+            self.launch(1, 1, tile, tile + 1, 1, 0.0)
+            ti.sync()
+            timings[tile] = time.perf_counter() - start
+        self.counters[COUNTER_PROGRESS] = progress
+        return timings.reshape(nb_tiles_y, nb_tiles_x)
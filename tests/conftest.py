@@ -0,0 +1,14 @@
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))  # the modules of the renderer are at the top of the repository
+
+@pytest.fixture(scope="session")
+def taichi_cpu():
+    import taichi as ti
+    ti.init(ti.cpu)
+    yield ti
+    ti.reset()
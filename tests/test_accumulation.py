@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import accumulation
+import parser
+from conftest import ROOT
+
+SCENE = str(ROOT / "scenes" / "AACheckerPlane.json")
+NB_SAMPLES = 32
+
+def render_range(first_sample: int, last_sample: int, tmp_path) -> dict:
+    ''' Accumulation buffer of the samples [first_sample, last_sample) of every pixel, saved and loaded as by main.py --sample-range and merge.py '''
+    full_scene = parser.load_scene(SCENE, image_scale_factor=0.05)
+    full_scene.samples = NB_SAMPLES
+    full_scene.first_sample = first_sample
+    full_scene.render_samples_in_chunks(1, last_sample - first_sample, 0)
+    path = tmp_path / f"{first_sample}_{last_sample}.npz"
+    accumulation.save(path, full_scene.accumulation_buffer("AACheckerPlane.json"))
+    return accumulation.load(path)
+
+def test_sample_ranges_merge_to_the_full_render(taichi_cpu, tmp_path):
+    full = render_range(0, NB_SAMPLES, tmp_path)
+    merged = accumulation.merge([render_range(5, NB_SAMPLES, tmp_path), render_range(0, 5, tmp_path)])
+    assert merged["sample_range"] == (0, NB_SAMPLES)
+    for name in accumulation.BUFFER_ARRAYS:
+        assert np.array_equal(merged[name], full[name])
+    merged_image = accumulation.resolve(merged["accum"], merged["sample_count"])
+    assert merged_image.tobytes() == accumulation.resolve(full["accum"], full["sample_count"]).tobytes()
+
+def test_overlapping_ranges_are_rejected_and_gaps_reported(taichi_cpu, tmp_path, capsys):
+    first = render_range(0, 5, tmp_path)
+    with pytest.raises(ValueError, match="overlapping"):
+        accumulation.merge([first, dict(first, sample_range=(4, 9))])
+    merged = accumulation.merge([first, dict(first, sample_range=(6, 11))])
+    assert merged["sample_range"] == (0, 11)
+    assert "leave gaps" in capsys.readouterr().out
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+import taichi as ti
+import taichi.math as tm
+
+import bvh
+import geometry as geom
+import helperclasses as hc
+import parser
+import scene
+from conftest import ROOT
+
+def walk(nodes: dict):
+    ''' Nodes reachable from the root, as (node index, depth), each parent before its children '''
+    reached = [(0, 0)]
+    for i, depth in reached:
+        if nodes["count"][i] == 0 and len(nodes["count"]) > 1:
+            reached += [(nodes["left_first"][i], depth + 1), (nodes["left_first"][i] + 1, depth + 1)]
+    return reached
+
+def check_bvh(nodes: dict, order: np.ndarray, bbox_min: np.ndarray, bbox_max: np.ndarray) -> int:
+    ''' Assert that every primitive is in exactly one leaf and that the bounds of every node contain its children, returns the depth '''
+    reached = walk(nodes)
+    assert sorted(i for i, _ in reached) == list(range(len(nodes["count"])))  # every node is used once
+    in_leaves = []
+    for i, _ in reached:
+        node_min, node_max = nodes["bbox_min"][i], nodes["bbox_max"][i]
+        if nodes["count"][i] > 0:
+            prims = order[nodes["left_first"][i]:nodes["left_first"][i] + nodes["count"][i]]
+            in_leaves.append(prims)
+            children_min, children_max = bbox_min[prims], bbox_max[prims]
+        else:
+            children = [nodes["left_first"][i], nodes["left_first"][i] + 1]
+            children_min, children_max = nodes["bbox_min"][children], nodes["bbox_max"][children]
+        assert (node_min <= children_min).all() and (children_max <= node_max).all()
+    assert np.array_equal(np.sort(np.concatenate(in_leaves)), np.arange(len(bbox_min)))
+    return max(depth for _, depth in reached)
+
+@pytest.mark.parametrize("layout", ["random", "same_centroid"])
+def test_every_primitive_is_in_one_leaf_within_the_bounds_of_its_nodes(layout):
+    rng = np.random.default_rng(1)
+    if layout == "random":
+        bbox_min = rng.uniform(-10, 10, (1000, 3))
+        bbox_max = bbox_min + rng.uniform(0, 2, (1000, 3))
+    else:  # no split of the surface area heuristic, nodes are split in halves
+        bbox_min, bbox_max = np.full((50, 3), -1.0), np.full((50, 3), 1.0)
+    nodes, order = bvh.build_bvh(bbox_min, bbox_max)
+    check_bvh(nodes, order, bbox_min, bbox_max)
+    assert nodes["count"].max() <= bvh.BVH_MAX_LEAF_SIZE
+
+def test_depth_fits_the_traversal_stack():
+    ''' Primitives spaced exponentially along an axis make an unbalanced tree deeper than the stack, unless its depth is bounded '''
+    bbox_min = np.zeros((200, 3))
+    bbox_min[:, 0] = 2.0 ** (np.arange(200) - 100)
+    unbounded, _ = bvh.build_bvh(bbox_min, bbox_min, max_depth=1000)
+    assert max(depth for _, depth in walk(unbounded)) > bvh.BVH_STACK_SIZE - 1
+
+    nodes, order = bvh.build_bvh(bbox_min, bbox_min)
+    assert check_bvh(nodes, order, bbox_min, bbox_min) <= bvh.BVH_STACK_SIZE - 1
+
+@ti.kernel
+def trace(params: scene.SceneParams, arrays: scene.SceneArrays, origins: ti.types.ndarray(dtype=tm.vec3, ndim=1),
+          directions: ti.types.ndarray(dtype=tm.vec3, ndim=1), bvh_t: ti.types.ndarray(dtype=ti.f32, ndim=1),
+          brute_force_t: ti.types.ndarray(dtype=ti.f32, ndim=1)):
+    for i in range(origins.shape[0]):
+        ray = hc.Ray(origins[i], directions[i])
+        hit = scene.intersect_scene(arrays, params, ray, 0, float('inf'))
+        bvh_t[i] = ti.select(hit.is_hit, hit.t, float('inf'))
+
+        t_max = float('inf')  # nearest hit of all the primitives, each intersected in turn
+        for j in range(params.nb_planes):
+            hit = geom.intersectPlane(scene.read_plane(arrays.planes, j), ray, 0, t_max)
+            if hit.is_hit: t_max = hit.t
+        for j in range(params.nb_spheres):
+            hit = geom.intersectSphere(scene.read_sphere(arrays.spheres, j), ray, 0, t_max)
+            if hit.is_hit: t_max = hit.t
+        for j in range(params.nb_meshes):
+            hit = geom.intersectMesh(scene.read_mesh(arrays.meshes, j), arrays.meshes_verts, arrays.meshes_faces,
+                                     arrays.meshes_bvh, ray, 0, t_max)
+            if hit.is_hit: t_max = hit.t
+        brute_force_t[i] = t_max
+
+def test_bvh_finds_the_nearest_hit(taichi_cpu, tmp_path):
+    ''' The BVH traversal finds the same nearest hits as intersecting every primitive, with scaled and rotated primitives '''
+    rng = np.random.default_rng(2)
+    objects = [{"type": "plane", "position": [0, -12, 0], "rotation": [10, 0, 5], "materials": ["m"]}]
+    for position, rotation, scale in zip(rng.uniform(-10, 10, (300, 3)), rng.uniform(0, 360, (300, 3)), rng.uniform(0.2, 2, (300, 3))):
+        objects.append({"type": "sphere", "position": position.tolist(), "rotation": rotation.tolist(),
+                        "scale": scale.tolist(), "radius": 0.5, "materials": ["m"]})
+    for position, scale in ((-4, 3), (5, 0.5)):
+        objects.append({"name": f"torus{position}", "type": "mesh", "filepath": str(ROOT / "meshes" / "torus.obj"),
+                        "position": [position, 0, 0], "rotation": [30, 0, 0], "scale": [scale, 2 * scale, scale], "materials": ["m"]})
+    scene_file = tmp_path / "scaled.json"
+    scene_file.write_text(json.dumps({"resolution": [8, 8], "camera": {"position": [0, 0, 30], "lookAt": [0, 0, 0], "up": [0, 1, 0], "fovy": 45},
+                                      "materials": [{"name": "m", "diffuse": [1, 1, 1], "specular": [0, 0, 0]}],
+                                      "objects": objects, "lights": []}))
+    full_scene = parser.load_scene(str(scene_file))
+    full_scene.bind()
+
+    nb_rays = 4096
+    origins = rng.uniform(-15, 15, (nb_rays, 3)).astype(np.float32)
+    directions = rng.uniform(-10, 10, (nb_rays, 3)) - origins
+    directions = (directions / np.linalg.norm(directions, axis=1, keepdims=True)).astype(np.float32)
+    bvh_t, brute_force_t = np.zeros(nb_rays, dtype=np.float32), np.zeros(nb_rays, dtype=np.float32)
+    trace(full_scene.params(), full_scene.arrays, origins, directions, bvh_t, brute_force_t)
+    assert np.isfinite(brute_force_t).sum() > nb_rays // 2
+    assert np.array_equal(bvh_t, brute_force_t)
@@ -0,0 +1,35 @@
+import os
+import stat
+
+import checkpoint
+import parser
+from conftest import ROOT
+
+SCENE = str(ROOT / "scenes" / "AACheckerPlane.json")
+
+def render(full_scene, first_iteration: int, last_iteration: int, batch: int):
+    ''' Render the iterations [first_iteration, last_iteration) in launches of batch samples, as main.py does '''
+    for iteration in range(first_iteration, last_iteration, batch):
+        full_scene.render_samples_in_chunks(iteration, min(batch, last_iteration - iteration), 0)
+
+def test_resumed_render_is_the_same_as_an_uninterrupted_one(taichi_cpu, tmp_path):
+    full_scene = parser.load_scene(SCENE, image_scale_factor=0.05)
+    render(full_scene, 1, full_scene.samples + 1, 3)
+    uninterrupted = full_scene.image_to_numpy()
+
+    # interrupted after 2 launches, then continued by another scene loaded from the same file
+    interrupted = parser.load_scene(SCENE, image_scale_factor=0.05)
+    render(interrupted, 1, 7, 3)
+    path = checkpoint.checkpoint_path(SCENE, str(tmp_path))
+    checkpoint.save(path, interrupted.accumulation_buffer(SCENE), 7, interrupted.content_hash(), interrupted.progress)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    resumed = parser.load_scene(SCENE, image_scale_factor=0.05)
+    saved = checkpoint.load(path)
+    assert saved["scene_hash"] == resumed.content_hash()
+    resumed.restore(saved, saved["progress"])
+    assert resumed.progress == interrupted.progress
+    render(resumed, saved["iteration"], resumed.samples + 1, 3)
+    assert resumed.image_to_numpy().tobytes() == uninterrupted.tobytes()
+    assert resumed.progress == full_scene.progress
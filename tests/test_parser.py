@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+import parser
+from conftest import ROOT
+
+def columns(full_scene) -> dict:
+    ''' Columns of the primitives of a scene, by type and member, nested members included '''
+    flat = {}
+    def add(prefix: str, members: dict):
+        for key, value in members.items():
+            if isinstance(value, dict):
+                add(f"{prefix}{key}.", value)
+            else:
+                flat[prefix + key] = value
+    for name in ("spheres", "planes", "aaboxes", "meshes"):
+        add(f"{name}.", getattr(full_scene, name))
+    return flat
+
+def scene_text(objects: list, **dumps_args) -> str:
+    materials = [{"name": name, "diffuse": [1, 1, 1], "specular": [0, 0, 0]} for name in ("a", "b", "c", "é")]
+    return json.dumps({"resolution": [8, 8], "camera": {"position": [0, 0, 30], "lookAt": [0, 0, 0], "up": [0, 1, 0], "fovy": 45},
+                       "materials": materials, "objects": objects, "lights": []}, **dumps_args)
+
+def mixed_objects(material_names: list) -> list:
+    ''' Spheres, planes and boxes in long runs, broken by named objects, other members and scales of another kind '''
+    rng = np.random.default_rng(3)
+    objects = []
+    for i in range(3000):
+        position, rotation = rng.uniform(-10, 10, 3).tolist(), rng.uniform(0, 360, 3).tolist()
+        materials = [material_names[i % len(material_names)]]
+        if i % 1000 < 600:
+            scale = float(rng.uniform(0.5, 2)) if i % 1000 < 300 else rng.uniform(0.5, 2, 3).tolist()
+            objects.append({"type": "sphere", "position": position, "rotation": rotation, "scale": scale,
+                            "radius": float(rng.uniform(0.1, 1)), "materials": materials})
+        elif i % 1000 < 800:
+            objects.append({"type": "plane", "position": position, "normal": [0, 1, 0], "materials": materials + ["a"]})
+        else:
+            objects.append({"type": "box", "position": position, "rotation": rotation, "min": [-1, -2, -1], "max": [1, 2, 1],
+                            "materials": materials})
+        if i % 700 == 0:
+            objects.append({"name": f"named{i}", "type": "sphere", "radius": 0.5, "materials": ["b"]})
+    return objects
+
+@pytest.mark.parametrize("material_names, dumps_args", [(["a", "b", "c"], {}), (["a", "b", "é"], {"indent": 2, "ensure_ascii": False})])
+def test_runs_load_the_columns_of_each_object(tmp_path, material_names, dumps_args):
+    ''' A strict json scene, read in runs, loads as the same scene read by json5 one object at a time '''
+    text = scene_text(mixed_objects(material_names), **dumps_args)
+    _, objects = parser.read_scene_json(text)
+    runs = [run for run in objects if isinstance(run, parser.JsonRun)]
+    assert sum(len(run.values) for run in runs) > 1500
+
+    strict, lenient = tmp_path / "strict.json", tmp_path / "lenient.json"
+    strict.write_text(text, encoding="utf-8")
+    lenient.write_text(text + "\n// not strict json, read by json5\n", encoding="utf-8")
+    from_runs, from_json5 = columns(parser.load_scene(str(strict))), columns(parser.load_scene(str(lenient)))
+    assert from_runs.keys() == from_json5.keys()
+    for key, column in from_runs.items():
+        assert column.dtype == from_json5[key].dtype and np.array_equal(column, from_json5[key]), key
+
+@pytest.mark.parametrize("number", ["1-2", "0.5.5", "true"])
+def test_a_run_stops_at_values_that_are_not_numbers(tmp_path, number):
+    objects = [{"type": "sphere", "position": [i, 0, 0], "radius": 0.5, "materials": ["a"]} for i in range(1000)]
+    text = scene_text(objects)
+    radius = text.index('"radius": 0.5', len(text) // 2)
+    scene_file = tmp_path / "scene.json"
+    scene_file.write_text(text[:radius] + f'"radius": {number}' + text[radius + len('"radius": 0.5'):])
+    if number == "true":
+        assert parser.load_scene(str(scene_file)).spheres["radius"].tolist().count(1.0) == 1  # a json bool reads as 1
+    else:
+        with pytest.raises(ValueError):
+            parser.load_scene(str(scene_file))
+
+def test_instances_copy_named_geometry_and_nodes_with_their_transformation(tmp_path):
+    ''' Instances of named geometry at the root and of nodes, whose children (nested nodes included) are each listed once '''
+    torus = str(ROOT / "meshes" / "torus.obj")
+    objects = [{"name": "ball", "type": "sphere", "position": [1, 2, 3], "radius": 0.5, "materials": ["a"]},
+               {"name": "stack", "type": "node", "position": [0, 1, 0], "children": [
+                   {"type": "box", "position": [0, 0, 0], "materials": ["a"]},
+                   {"name": "inner", "type": "node", "children": [
+                       {"type": "plane", "normal": [0, 0, 1], "materials": ["a", "b"]},
+                       {"type": "mesh", "filepath": torus, "materials": ["b"]}]}]},
+               {"name": "ball2", "type": "instance", "ref": "ball", "position": [10, 0, 0]},
+               {"name": "stack2", "type": "instance", "ref": "stack", "position": [0, 0, -5], "scale": [2, 2, 2]}]
+    scene_file = tmp_path / "instances.json"
+    scene_file.write_text(scene_text(objects))
+    full_scene = parser.load_scene(str(scene_file))
+    assert (full_scene.nb_spheres, full_scene.nb_aaboxes, full_scene.nb_planes, full_scene.nb_meshes) == (2, 2, 2, 2)
+
+    translate = np.eye(4, dtype=np.float32)
+    translate[:3, 3] = [10, 0, 0]
+    spheres = full_scene.spheres
+    assert np.allclose(spheres["M"][1], translate @ spheres["M"][0]) and spheres["radius"][1] == 0.5
+    planes = full_scene.planes
+    assert planes["two_materials"].all() and np.array_equal(planes["normal"][1], [0, 0, 1])
+    meshes = full_scene.meshes
+    for key in ("faces_ids_start", "faces_ids_count", "bvh_start", "bvh_count"):
+        assert meshes[key][0] == meshes[key][1]  # the instance shares the faces and BVH of the mesh
+    assert np.allclose(meshes["M"][1] @ meshes["M_inv"][1], np.eye(4), atol=1e-5)
+    assert np.allclose(meshes["M"][1][:3, 3], 2 * meshes["M"][0][:3, 3] + [0, 0, -5])
@@ -0,0 +1,25 @@
+import numpy as np
+
+import parser
+import scene
+from conftest import ROOT
+
+def test_chunked_render_reports_intermediate_progress(taichi_cpu, monkeypatch):
+    ''' A batch rendered in several launches publishes the progress after each of them, and renders the same image as a single launch '''
+    monkeypatch.setattr(scene, "render_threads", 1)
+    full_scene = parser.load_scene(str(ROOT / "scenes" / "Plane.json"), image_scale_factor=0.25)
+    nb_samples = 4
+    total = full_scene.camera.width * full_scene.camera.height * nb_samples
+
+    full_scene.render_samples_in_chunks(1, nb_samples, 0)
+    single_launch = full_scene.image_to_numpy()
+    start = full_scene.progress
+
+    reported = []
+    full_scene.render_samples_in_chunks(1, nb_samples, 1e-9, reported.append)  # the smallest ranges, one tile per thread
+    counts = [count - start for count in reported]
+    nb_tiles_x, nb_tiles_y = full_scene.nb_tiles()
+    assert len(counts) == nb_tiles_x * nb_tiles_y
+    assert all(a < b for a, b in zip(counts, counts[1:]))
+    assert 0 < counts[0] < total and counts[-1] == total
+    assert np.array_equal(full_scene.image_to_numpy(), single_launch)
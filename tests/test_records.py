@@ -0,0 +1,41 @@
+import numpy as np
+import taichi as ti
+import taichi.math as tm
+
+import geometry as geom
+import parser
+import records
+from conftest import ROOT
+
+read_plane = records.reader(geom.Plane)
+
+@ti.kernel
+def read_planes(rows: ti.types.ndarray(dtype=ti.f32, ndim=2), ids: ti.types.ndarray(dtype=tm.ivec4, ndim=1),
+                diffuse: ti.types.ndarray(dtype=tm.vec3, ndim=1), normal: ti.types.ndarray(dtype=tm.vec3, ndim=1),
+                M_inv: ti.types.ndarray(dtype=tm.mat4, ndim=1)):
+    for i in range(rows.shape[0]):
+        plane = read_plane(rows, i)
+        ids[i] = tm.ivec4(plane.id, ti.cast(plane.two_materials, ti.i32), plane.material1.id, plane.material2.id)
+        diffuse[i] = plane.material2.diffuse
+        normal[i] = plane.normal
+        M_inv[i] = plane.M_inv
+
+def test_packed_rows_read_back_as_columns(taichi_cpu):
+    ''' The members of primitives packed by records.pack, nested dataclasses, integers and booleans included, read back as they were '''
+    full_scene = parser.load_scene(str(ROOT / "scenes" / "AACheckerPlane.json"))
+    planes, nb = full_scene.planes, full_scene.nb_planes
+    rows = records.pack(planes, geom.Plane, nb)
+    assert rows.shape == (nb, records.row_size(geom.Plane))
+
+    ids = np.zeros((nb, 4), dtype=np.int32)
+    diffuse, normal = np.zeros((nb, 3), dtype=np.float32), np.zeros((nb, 3), dtype=np.float32)
+    M_inv = np.zeros((nb, 4, 4), dtype=np.float32)
+    read_planes(rows, ids, diffuse, normal, M_inv)
+    assert np.array_equal(ids, np.stack((planes["id"], planes["two_materials"], planes["material1"]["id"], planes["material2"]["id"]), axis=1))
+    assert np.array_equal(diffuse, planes["material2"]["diffuse"])
+    assert np.array_equal(normal, planes["normal"])
+    assert np.array_equal(M_inv, planes["M_inv"])
+
+def test_no_elements_pack_a_single_row_of_zeros():
+    rows = records.pack({}, geom.Sphere, 0)
+    assert rows.shape == (1, records.row_size(geom.Sphere)) and not rows.any()